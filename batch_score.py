@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+"""Batched scoring of catalogue rows with NumPy.
+
+`Workflow.filter` scores one row at a time in Python. When NumPy is
+installed, `filter_stores` instead packs the folded search forms of the
+catalogue into byte-string arrays once per snapshot and tests the
+startswith, capitals, atom, initials and substring rules of each query
+word against every candidate row in a few vectorized passes. Rows none
+of those rules accept are left to `Workflow._filter_item` for the
+fuzzy and all-chars rules, so scores, rules and ranking are exactly
+those of `Workflow.filter`.
+
+Without NumPy, `available` is False and callers use `Workflow.filter`.
+NumPy takes longer to import than most queries take to answer, so it
+is only imported once a query has enough candidates to batch.
+"""
+
+import heapq
+from importlib.util import find_spec
+from workflow import (
+    MATCH_ALLCHARS, MATCH_ATOM, MATCH_CAPITALS, MATCH_FUZZY, MATCH_INITIALS_CONTAIN, MATCH_INITIALS_STARTSWITH,
+    MATCH_STARTSWITH, MATCH_SUBSTRING
+)
+
+available = find_spec('numpy') is not None
+np = None
+
+# Fewer candidates than this are scored faster one at a time
+MIN_BATCH = 256
+
+# Rules tried one row at a time, after the batched ones
+ROW_RULES = MATCH_FUZZY | MATCH_ALLCHARS
+
+class Columns:
+    """The folded search forms of a catalogue snapshot as NumPy arrays."""
+
+    def __init__(self, catalogue):
+        keys = [catalogue.search_key(pos).folded for pos in range(len(catalogue))]
+        self.lower = np.array([key.lower.encode('utf-8') for key in keys])
+        self.capitals = np.array([key.capitals.encode('ascii') for key in keys])
+        # a space on each side of every atom, to match whole atoms
+        self.atoms = np.array([(' ' + ' '.join(key.atoms) + ' ').encode('ascii') for key in keys])
+        self.initials = np.array([key.initials.encode('ascii') for key in keys])
+        self.value_length = np.array([len(key.value) for key in keys], dtype=float)
+        self.capitals_length = np.array([len(key.capitals) for key in keys], dtype=float)
+        self.initials_length = np.array([len(key.initials) for key in keys], dtype=float)
+
+    def take(self, positions):
+        """Get the columns of the rows at `positions`, in that order."""
+        rows = Columns.__new__(Columns)
+        for name, column in vars(self).items():
+            setattr(rows, name, column[positions])
+        return rows
+
+# Columns of the last catalogue, kept across queries by the daemon
+_columns = None
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+def get_columns(catalogue):
+    global _columns
+    if _columns is None or _columns[0] != (catalogue.datadir, catalogue.stamp):
+        _columns = ((catalogue.datadir, catalogue.stamp), Columns(catalogue))
+    return _columns[1]
+
+def score_word(rows, word, match_on):
+    """Get the scores and rules of the batched rules for one query word.
+
+    Mirrors the order and scores of `Workflow._filter_item`; a score of
+    0 means none of them accepts the row."""
+    word_bytes = word.encode('ascii')
+    length = len(word)
+    tests = [
+        (MATCH_STARTSWITH, lambda: np.char.startswith(rows.lower, word_bytes),
+         lambda: 100.0 - rows.value_length / length),
+        (MATCH_CAPITALS, lambda: np.char.startswith(rows.capitals, word_bytes),
+         lambda: 100.0 - rows.capitals_length / length),
+        (MATCH_ATOM, lambda: np.char.find(rows.atoms, b' ' + word_bytes + b' ') >= 0,
+         lambda: 100.0 - rows.value_length / length),
+        (MATCH_INITIALS_STARTSWITH, lambda: np.char.startswith(rows.initials, word_bytes),
+         lambda: 100.0 - rows.initials_length / length),
+        (MATCH_INITIALS_CONTAIN, lambda: np.char.find(rows.initials, word_bytes) >= 0,
+         lambda: 95.0 - rows.initials_length / length),
+        (MATCH_SUBSTRING, lambda: np.char.find(rows.lower, word_bytes) >= 0,
+         lambda: 90.0 - rows.value_length / length),
+    ]
+    conditions = []
+    scores = []
+    rules = []
+    for rule, test, score in tests:
+        if match_on & rule:
+            conditions.append(test())
+            scores.append(score())
+            rules.append(rule)
+    if not conditions:
+        return np.zeros(len(rows.lower)), np.zeros(len(rows.lower), dtype=int)
+    return np.select(conditions, scores, 0.0), np.select(conditions, rules, 0)
+
+def can_score(wf, query, positions):
+    """Whether `filter_stores` should score `query` against `positions`."""
+    return (available and query.isascii() and len(positions) >= MIN_BATCH
+            and wf.settings.get('__workflow_diacritic_folding', True))
+
+def filter_stores(wf, query, catalogue, positions, match_on, max_results=0, group=None):
+    """Score the rows at `positions` against `query` like `Workflow.filter`.
+
+    `query` must be ASCII. Returns the `(pos, score, rule)` list
+    `wf.filter(query, positions, key=catalogue.search_key,
+    include_score=True, ...)` would."""
+    words = [word.lower() for word in (word.strip() for word in query.strip().split(' ')) if word]
+    if not words:
+        return positions
+    load_numpy()
+    indices = np.asarray(positions, dtype=np.intp)
+    rows = get_columns(catalogue).take(indices)
+    total = np.zeros(len(positions))
+    rule = np.zeros(len(positions), dtype=int)
+    alive = rows.value_length > 0
+    for word in words:
+        scores, rules = score_word(rows, word, match_on)
+        if match_on & ROW_RULES:
+            # the batched rules missed these, so only the row rules can match
+            missed = alive & (scores == 0)
+            if not match_on & MATCH_FUZZY:
+                # which takes the chars of `word` in order
+                missed &= np.isin(indices, catalogue.match_chars(word))
+            for i in np.flatnonzero(missed):
+                score, row_rule = wf._filter_item(catalogue.search_key(positions[i]), word, match_on & ROW_RULES, True)
+                scores[i], rules[i] = score, row_rule or 0
+        alive &= scores != 0
+        total += scores
+        rule = rules
+    def matches():
+        for i in np.flatnonzero(alive & (total != 0)):
+            pos = positions[i]
+            score = float(total[i])
+            match = (pos, score, int(rule[i]))
+            sort_key = (100.0 / score, catalogue.search_key(pos).lower, score)
+            if group:
+                sort_key = (group(match),) + sort_key
+            yield (sort_key, match)
+    if max_results:
+        results = heapq.nsmallest(max_results, matches())
+    else:
+        results = sorted(matches())
+    return [match for _, match in results]
@@ -0,0 +1,207 @@
+# encoding: utf-8
+
+"""Benchmark the script filter from query to JSON feedback.
+
+Runs `python3 filter.py <query>` the way Alfred does, in a copy of the
+workflow with its own data and cache dirs, and times each run until the
+feedback JSON is written. The catalogue is the bundled stores.json,
+scaled up with made-up merchants to each size asked for, and the p50
+and p95 latency of every query shape is reported per size.
+
+The bundled stores have no categories, so every store is given one
+from CATEGORIES. The stores are already up to date and their logos
+marked as failed, so no run starts a background update or download.
+The kept prefixes are removed before each run, so the times are those
+of a first keystroke.
+
+    python3 benchmarks/script_filter.py [--sizes 10000 50000] [--runs N]
+                                        [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BRAND = 'american'
+
+SIZES = (10000, 50000)
+
+RUNS = 20
+
+# Query shapes and the query run for each
+QUERIES = {
+    'empty': '',
+    'one char': 'n',
+    'full name': 'Nordstrom Rack',
+    'category word': 'electronics',
+    'promoted': ':prm',
+    'favorites': ':fav',
+    'misspelling': 'nordstorm',
+}
+
+CATEGORIES = (
+    'Electronics', 'Clothing', 'Shoes', 'Travel', 'Home & Garden', 'Beauty', 'Health',
+    'Sports & Outdoors', 'Toys', 'Food & Drink', 'Office Supplies', 'Pets', 'Jewelry',
+)
+
+# Favorite stores of the copy, as every FAVORITE_EVERY-th store
+FAVORITE_EVERY = 100
+
+SYLLABLES = (
+    'ba', 'ca', 'da', 'el', 'fi', 'go', 'ha', 'in', 'jo', 'ka', 'lu', 'ma', 'ne', 'or',
+    'pa', 'qui', 'ro', 'sa', 'te', 'um', 'va', 'wi', 'xo', 'ya', 'zen', 'ster', 'ton', 'ly',
+)
+
+def load_stores():
+    """Get the stores of the bundled stores.json that have a rebate."""
+    with open(os.path.join(ROOT, 'stores.json')) as f:
+        return [store for store in json.load(f)['response'] if 'rebate' in store]
+
+def made_up_name(rng, words):
+    """Make up a merchant name, sometimes followed by a word of a real one."""
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+    if rng.random() < 0.5:
+        name += ' ' + rng.choice(words)
+    return name
+
+def scale_stores(stores, size, seed=0):
+    """Get `size` stores: `stores` followed by made-up merchants modeled on them."""
+    from search_index import normalize
+    rng = random.Random(seed)
+    words = sorted({word for store in stores for word in store['name'].split()})
+    scaled = []
+    for i in range(size):
+        if i < len(stores):
+            store = dict(stores[i])
+        else:
+            model = rng.choice(stores)
+            name = made_up_name(rng, words)
+            store = dict(model, id=10_000_000 + i, name=name, synonyms=normalize(name))
+        store['categories'] = [{'name': rng.choice(CATEGORIES)}]
+        scaled.append(store)
+    return scaled
+
+def copy_workflow(dst):
+    """Copy the workflow to `dst` with the icon a brand switch would add."""
+    from brands import BRANDS
+    shutil.copytree(ROOT, dst, ignore=shutil.ignore_patterns('.git', '__pycache__', 'benchmarks', 'workflow-build'))
+    icon = os.path.join(ROOT, BRANDS[BRAND]['favicon'])
+    if os.path.exists(icon):
+        shutil.copy2(icon, os.path.join(dst, 'icon.png'))
+    else:
+        # the script filter only checks that there is one
+        open(os.path.join(dst, 'icon.png'), 'wb').close()
+
+def get_env(tmp):
+    env = dict(os.environ,
+               alfred_workflow_bundleid='com.schwark.mileageshopping.benchmark',
+               alfred_workflow_data=os.path.join(tmp, 'data'),
+               alfred_workflow_cache=os.path.join(tmp, 'cache'),
+               alfred_version='5.0')
+    env.pop('USE_DAEMON', None)
+    env.pop('MAX_RESULTS', None)
+    return env
+
+def seed(env, stores):
+    """Save `stores` as the up to date catalogue of BRAND in the data dir of `env`."""
+    from common import brand_key, save_catalogue
+    from workflow import Workflow
+    saved = dict(os.environ)
+    os.environ.update(env)
+    try:
+        wf = Workflow()
+        save_catalogue(wf, stores, BRAND)
+        wf.store_data(brand_key('last_update', BRAND), datetime.datetime.now())
+        wf.store_data('current_brand', BRAND.encode('utf-8'))
+        wf.store_data('favorites', [store['id'] for store in stores[::FAVORITE_EVERY]])
+        wf.cache_data('logo_failures', [store['id'] for store in stores])
+        wf.settings['__workflow_autoupdate'] = False
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+def run_query(workflow_dir, env, query):
+    """Run the script filter for `query` and get its wall time in seconds and its items."""
+    for path in glob.glob(os.path.join(env['alfred_workflow_cache'], 'prefixes.*')):
+        os.remove(path)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, 'filter.py', query], cwd=workflow_dir, env=env,
+                            capture_output=True, check=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stdout)['items']
+
+def percentile(times, p):
+    """Get the `p` percentile of `times` by nearest rank."""
+    times = sorted(times)
+    return times[max(0, math.ceil(p / 100.0 * len(times)) - 1)]
+
+def bench_size(stores, size, runs):
+    with tempfile.TemporaryDirectory() as tmp:
+        workflow_dir = os.path.join(tmp, 'workflow')
+        copy_workflow(workflow_dir)
+        env = get_env(tmp)
+        seed(env, scale_stores(stores, size))
+        results = {}
+        for shape, query in QUERIES.items():
+            # the first run also compiles the modules of the copy
+            _, items = run_query(workflow_dir, env, query)
+            times = [run_query(workflow_dir, env, query)[0] for _ in range(runs)]
+            results[shape] = {
+                'query': query,
+                'items': len(items),
+                'p50_ms': round(percentile(times, 50) * 1000, 2),
+                'p95_ms': round(percentile(times, 95) * 1000, 2),
+            }
+            print(f'{size:>7} {shape:<14} {query!r:<18} {results[shape]["p50_ms"]:>8.1f} '
+                  f'{results[shape]["p95_ms"]:>8.1f} {len(items):>6}', flush=True)
+        return results
+
+def compare(results, path):
+    """Print the p50 and p95 of `results` relative to the results saved in `path`."""
+    with open(path) as f:
+        before = json.load(f)['sizes']
+    print(f'\nrelative to {path}')
+    for size, shapes in results.items():
+        for shape, result in shapes.items():
+            old = before.get(size, {}).get(shape)
+            if old:
+                print(f'{size:>7} {shape:<14} p50 {result["p50_ms"] / old["p50_ms"]:>6.2f}x '
+                      f'p95 {result["p95_ms"] / old["p95_ms"]:>6.2f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='stores in the catalogue')
+    parser.add_argument('--runs', type=int, default=RUNS, help='timed runs per query')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    stores = load_stores()
+    print(f'{"stores":>7} {"shape":<14} {"query":<18} {"p50 ms":>8} {"p95 ms":>8} {"items":>6}')
+    results = {str(size): bench_size(stores, size, args.runs) for size in args.sizes}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'runs': args.runs,
+                'sizes': results,
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+"""Check the import time of the script filter against a budget.
+
+Alfred starts `filter.py` on every keystroke, so everything it imports
+is paid for on every keystroke. This imports `filter` in fresh
+interpreters with `-X importtime`, takes the fastest of RUNS imports,
+and fails if it is over BUDGET_MS or if a module only rarely used
+branches need was imported.
+
+    python3 benchmarks/startup.py [--runs N] [--budget MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time of `filter` allowed, in milliseconds: about
+# twice what it takes on an idle machine, as timings vary a lot
+BUDGET_MS = 100
+
+RUNS = 10
+
+# Modules the per-keystroke path must not import
+LAZY_MODULES = (
+    'command',
+    'concurrent.futures',
+    'http.client',
+    'numpy',
+    'urllib.request',
+    'uuid',
+    'workflow.web',
+)
+
+def import_times(env):
+    """Import `filter` once and get the cumulative import time of each module, in microseconds."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import filter'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--budget', type=float, default=BUDGET_MS, help='milliseconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   alfred_workflow_bundleid='com.schwark.mileageshopping',
+                   alfred_workflow_data=os.path.join(tmp, 'data'),
+                   alfred_workflow_cache=os.path.join(tmp, 'cache'),
+                   alfred_version='5.0')
+        runs = [import_times(env) for _ in range(args.runs)]
+
+    best = min(times['filter'] for times in runs) / 1000.0
+    print(f'import filter: {best:.1f} ms (best of {args.runs}, budget {args.budget:g} ms)')
+    failed = best > args.budget
+    imported = sorted(name for name in LAZY_MODULES if name in runs[0])
+    for name in imported:
+        print(f'imported {name}, which should only be imported where it is needed')
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
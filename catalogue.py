@@ -0,0 +1,458 @@
+# encoding: utf-8
+
+import os
+import re
+import json
+import mmap
+import hashlib
+import time
+import struct
+from array import array
+from bisect import bisect_right
+from workflow import SearchKey, Workflow
+from workflow.util import atomic_writer
+from search_index import get_categories, search_key_for_store
+
+# Bump whenever the file layout changes
+CATALOGUE_VERSION = 5
+CATALOGUE_FILE = 'catalogue.bin'
+DETAILS_FILE = 'catalogue-{stamp}.details'
+
+MAGIC = b'AECATLG\0'
+# magic, version, number of sections, number of stores, stamp
+HEADER = struct.Struct('<8sHHIQ')
+# name, kind, offset, size
+SECTION = struct.Struct('<16sB7xQQ')
+
+# Section kinds
+STRINGS = ord('S')  # uint32 offsets followed by newline-terminated utf-8 strings
+INT64 = ord('q')
+FLOAT64 = ord('d')
+UINT8 = ord('B')
+UINT64 = ord('Q')
+TEXT = ord('T')
+
+# Bits of the `flags` column
+ELEVATION = 1
+DIRECT = 2
+MOBILE = 4
+# Set on rows of stores that left the API until the next full rewrite
+DELETED = 8
+
+# Columns the script filter reads; `search`, `capitals`, `atoms` (space
+# separated) and `initials` are the forms of the diacritic-folded `key`
+# `Workflow.filter` tests
+STRING_COLUMNS = ('name', 'key', 'search', 'capitals', 'atoms', 'initials', 'click_url', 'currency',
+                  'categories', 'synonyms')
+NUMBER_COLUMNS = (('id', INT64), ('value', FLOAT64), ('bonus', FLOAT64), ('flags', UINT8),
+                  ('digest', UINT64))
+# Fixed-width columns that can be rewritten in place
+PATCHABLE_COLUMNS = ('value', 'bonus', 'flags', 'digest')
+# Kind of every section of the file
+SECTION_KINDS = dict([(name, STRINGS) for name in STRING_COLUMNS] + list(NUMBER_COLUMNS) +
+                     [('details', UINT64), ('details_file', TEXT)])
+
+class StaleCatalogue(Exception):
+    """The catalogue file was replaced since the catalogue was mapped."""
+
+def parse_value(val):
+    if isinstance(val, (int, float)):
+        return float(val)
+    try:
+        return float(str(val).replace('%', ''))
+    except ValueError:
+        return 0.0
+
+def format_value(val):
+    """Render a rebate value the way the API sent it, i.e. 5 rather than 5.0."""
+    return int(val) if val.is_integer() else val
+
+def search_forms(key):
+    """Get the SearchKey `Workflow.filter` compares ASCII queries against."""
+    return SearchKey(Workflow.fold_to_ascii(key.strip()))
+
+def encode_store(store):
+    """Get the details file line of a raw API store."""
+    return json.dumps(store, separators=(',', ':')).encode('utf-8') + b'\n'
+
+def store_digest(line):
+    """Get a 64-bit digest of a details line, to tell whether a store changed."""
+    return int.from_bytes(hashlib.blake2b(line, digest_size=8).digest(), 'little')
+
+def store_columns(store, line):
+    """Get the column values of a raw API store and its details `line`."""
+    rebate = store.get('rebate') or {}
+    key = search_key_for_store(store)
+    forms = search_forms(key)
+    flags = 0
+    if rebate.get('isElevation', False):
+        flags |= ELEVATION
+    if store.get('isDirect', False):
+        flags |= DIRECT
+    if store.get('flags', {}).get('tracksMobile', False):
+        flags |= MOBILE
+    synonyms = store.get('synonyms') or ''
+    if isinstance(synonyms, list):
+        synonyms = ','.join(synonyms)
+    return {
+        'id': store['id'],
+        'name': store['name'],
+        'key': key,
+        'search': forms.lower,
+        'capitals': forms.capitals,
+        'atoms': ' '.join(forms.atoms),
+        'initials': forms.initials,
+        'click_url': store.get('clickUrl', ''),
+        'value': parse_value(rebate.get('value', 0)),
+        'currency': rebate.get('currency', ''),
+        'bonus': float(store.get('bonus_percentage', 0)),
+        'categories': get_categories(store),
+        'synonyms': synonyms,
+        'flags': flags,
+        'digest': store_digest(line)
+    }
+
+def pack_strings(values):
+    """Pack strings as an offset table followed by newline-terminated utf-8.
+
+    Terminating every string with a newline lets the blob be searched
+    in place with a regular expression that doesn't cross rows."""
+    offsets = array('I', [0])
+    blob = bytearray()
+    for value in values:
+        blob += value.replace('\n', ' ').encode('utf-8') + b'\n'
+        offsets.append(len(blob))
+    return offsets.tobytes() + bytes(blob)
+
+def new_columns():
+    columns = {name: [] for name in STRING_COLUMNS}
+    columns.update({name: array(chr(kind)) for name, kind in NUMBER_COLUMNS})
+    return columns
+
+def write_catalogue(datadir, stores):
+    """Write a catalogue of raw API `stores` to `datadir`.
+
+    The full store dicts go to a details file, one JSON document per
+    line, read only when a caller needs a whole store. The columns the
+    script filter reads go to a single binary file with fixed offsets,
+    which readers memory-map rather than deserialize. The details file
+    is named after the snapshot stamp so a reader never pairs columns
+    with details of another snapshot."""
+    stamp = time.time_ns()
+    columns = new_columns()
+    details = array('Q')
+    details_file = DETAILS_FILE.format(stamp=stamp)
+    with atomic_writer(os.path.join(datadir, details_file), 'wb') as f:
+        offset = 0
+        for store in stores:
+            line = encode_store(store)
+            f.write(line)
+            details.extend((offset, offset + len(line)))
+            offset += len(line)
+            for name, value in store_columns(store, line).items():
+                columns[name].append(value)
+    write_columns(datadir, columns, details, details_file, stamp)
+    remove_stale_details(datadir, details_file)
+    return load_catalogue(datadir)
+
+def append_stores(catalogue, stores):
+    """Write a copy of `catalogue` with raw API `stores` added as new rows.
+
+    Existing rows keep their positions, so an index of the catalogue
+    only needs the new rows added. Their details are appended to the
+    current details file."""
+    columns = catalogue.columns()
+    details = array('Q', catalogue.details)
+    with open(catalogue.details_path, 'ab') as f:
+        offset = f.tell()
+        for store in stores:
+            line = encode_store(store)
+            f.write(line)
+            details.extend((offset, offset + len(line)))
+            offset += len(line)
+            for name, value in store_columns(store, line).items():
+                columns[name].append(value)
+    write_columns(catalogue.datadir, columns, details, catalogue.details_file, time.time_ns())
+    return load_catalogue(catalogue.datadir)
+
+def patch_catalogue(catalogue, stores, removed=()):
+    """Update rows of `catalogue` in place.
+
+    `stores` maps positions to raw API stores whose changes are confined
+    to PATCHABLE_COLUMNS; their details are appended to the details
+    file. Rows at the `removed` positions are marked DELETED. Positions
+    and the snapshot stamp don't change, so indexes stay valid, and
+    processes that have the catalogue mapped see the new values.
+
+    Raises StaleCatalogue, and changes nothing, if the catalogue file
+    isn't the one `catalogue` was mapped from anymore."""
+    path = os.path.join(catalogue.datadir, CATALOGUE_FILE)
+    with open(path, 'r+b') as f:
+        if not catalogue.is_mapped_from(f):
+            raise StaleCatalogue(f'{path} was replaced')
+        details = {}
+        if stores:
+            with open(catalogue.details_path, 'ab') as details_file:
+                offset = details_file.tell()
+                for pos, store in stores.items():
+                    line = encode_store(store)
+                    details_file.write(line)
+                    details[pos] = (offset, offset + len(line), store_columns(store, line))
+                    offset += len(line)
+        mm = mmap.mmap(f.fileno(), 0)
+        try:
+            for pos, (start, end, values) in details.items():
+                for name in PATCHABLE_COLUMNS:
+                    kind, offset, _ = catalogue.sections[name]
+                    fmt = '<' + chr(kind)
+                    struct.pack_into(fmt, mm, offset + pos * struct.calcsize(fmt), values[name])
+                struct.pack_into('<QQ', mm, catalogue.sections['details'][1] + pos * 16, start, end)
+            kind, offset, _ = catalogue.sections['flags']
+            for pos in removed:
+                mm[offset + pos] |= DELETED
+            mm.flush()
+        finally:
+            mm.close()
+
+def write_columns(datadir, columns, details, details_file, stamp):
+    """Write the binary column file of a catalogue snapshot."""
+    sections = [(name, STRINGS, pack_strings(columns[name])) for name in STRING_COLUMNS]
+    sections += [(name, kind, columns[name].tobytes()) for name, kind in NUMBER_COLUMNS]
+    sections.append(('details', UINT64, details.tobytes()))
+    sections.append(('details_file', TEXT, details_file.encode('utf-8')))
+
+    # lay sections out after the header and section table, 8-byte aligned
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, kind, data in sections:
+        offset += -offset % 8
+        table.append((name, kind, offset, data))
+        offset += len(data)
+    with atomic_writer(os.path.join(datadir, CATALOGUE_FILE), 'wb') as f:
+        f.write(HEADER.pack(MAGIC, CATALOGUE_VERSION, len(sections), len(details) // 2, stamp))
+        for name, kind, offset, data in table:
+            f.write(SECTION.pack(name.encode('ascii'), kind, offset, len(data)))
+        for name, kind, offset, data in table:
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(data)
+
+def remove_stale_details(datadir, keep):
+    for filename in os.listdir(datadir):
+        if filename.startswith('catalogue-') and filename.endswith('.details') and filename != keep:
+            try:
+                os.unlink(os.path.join(datadir, filename))
+            except OSError:
+                pass
+
+def is_valid_section(mm, count, name, kind, offset, size):
+    """Whether the section `name` fits in the mapped file `mm` and holds `count` rows."""
+    if kind != SECTION_KINDS.get(name) or offset + size > len(mm):
+        return False
+    if kind == STRINGS:
+        # the offsets of the strings, and then the strings up to the last one
+        table = (count + 1) * 4
+        return size >= table and struct.unpack_from('<I', mm, offset + count * 4)[0] <= size - table
+    if kind == TEXT:
+        return True
+    rows = 2 * count if name == 'details' else count
+    return size == rows * struct.calcsize(chr(kind))
+
+def load_catalogue(datadir):
+    """Map the catalogue in `datadir`, or return None if there isn't a usable one."""
+    try:
+        with open(os.path.join(datadir, CATALOGUE_FILE), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+    except (OSError, ValueError):
+        return None
+    if len(mm) < HEADER.size:
+        return None
+    magic, version, nsections, count, stamp = HEADER.unpack_from(mm)
+    if magic != MAGIC or version != CATALOGUE_VERSION or len(mm) < HEADER.size + nsections * SECTION.size:
+        return None
+    sections = {}
+    for i in range(nsections):
+        name, kind, offset, size = SECTION.unpack_from(mm, HEADER.size + i * SECTION.size)
+        name = name.rstrip(b'\0').decode('ascii', 'replace')
+        # a truncated or corrupt file is rebuilt like one of another version
+        if not is_valid_section(mm, count, name, kind, offset, size):
+            return None
+        sections[name] = (kind, offset, size)
+    if sections.keys() != SECTION_KINDS.keys():
+        return None
+    return Catalogue(datadir, mm, count, stamp, sections, (stat.st_dev, stat.st_ino))
+
+class StringColumn:
+    """Read-only sequence of the strings of a STRINGS section."""
+
+    def __init__(self, mm, count, offset, size):
+        self.mm = mm
+        self.count = count
+        table = (count + 1) * 4
+        self.offsets = memoryview(mm)[offset:offset + table].cast('I')
+        self.start = offset + table
+        self.end = offset + size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, pos):
+        if pos < 0 or pos >= self.count:
+            raise IndexError(pos)
+        return self.mm[self.start + self.offsets[pos]:self.start + self.offsets[pos + 1] - 1].decode('utf-8')
+
+    def __iter__(self):
+        for pos in range(self.count):
+            yield self[pos]
+
+    def search(self, pattern, positions=None):
+        """Get the sorted positions of the strings `pattern` (bytes regex) matches.
+
+        The regex runs over the mapped bytes directly, so no row is
+        decoded. With sorted `positions` only those rows are searched."""
+        offsets = self.offsets
+        if positions is not None:
+            start = self.start
+            return [pos for pos in positions
+                    if pattern.search(self.mm, start + offsets[pos], start + offsets[pos + 1] - 1)]
+        positions = []
+        pos = -1
+        for match in pattern.finditer(self.mm, self.start, self.end):
+            hit = bisect_right(offsets, match.start() - self.start) - 1
+            if hit != pos:
+                positions.append(hit)
+                pos = hit
+        return positions
+
+class FlagColumn:
+    """Read-only sequence of one bit of the `flags` column."""
+
+    def __init__(self, flags, bit):
+        self.flags = flags
+        self.bit = bit
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, pos):
+        return bool(self.flags[pos] & self.bit)
+
+class Catalogue:
+    """Memory-mapped, column-oriented view of the stores of a snapshot.
+
+    Rows are addressed by position. Columns decode a value only when it
+    is indexed. `row` builds the small store dict the script filter
+    displays; `store` loads the full API dict from the details file."""
+
+    def __init__(self, datadir, mm, count, stamp, sections, identity=None):
+        self.datadir = datadir
+        self.identity = identity
+        self.mm = mm
+        self.count = count
+        self.stamp = stamp
+        self.sections = sections
+        view = memoryview(mm)
+        for name, (kind, offset, size) in sections.items():
+            if kind == STRINGS:
+                column = StringColumn(mm, count, offset, size)
+            elif kind == TEXT:
+                column = mm[offset:offset + size].decode('utf-8')
+            else:
+                column = view[offset:offset + size].cast(chr(kind))
+            setattr(self, name, column)
+        self.details_path = os.path.join(datadir, self.details_file)
+        self.elevation = FlagColumn(self.flags, ELEVATION)
+        self.direct = FlagColumn(self.flags, DIRECT)
+        self.mobile = FlagColumn(self.flags, MOBILE)
+        self.deleted = FlagColumn(self.flags, DELETED)
+        self.search_keys = {}
+
+    def __len__(self):
+        return self.count
+
+    def live_positions(self):
+        """Get the positions of the rows that aren't marked deleted."""
+        deleted = self.deleted
+        return [pos for pos in range(self.count) if not deleted[pos]]
+
+    def columns(self):
+        """Copy every column into lists and arrays `write_columns` accepts."""
+        columns = {name: list(getattr(self, name)) for name in STRING_COLUMNS}
+        columns.update({name: array(chr(kind), getattr(self, name)) for name, kind in NUMBER_COLUMNS})
+        return columns
+
+    def is_mapped_from(self, f):
+        """Whether the open catalogue file `f` is the one this catalogue was mapped from."""
+        stat = os.fstat(f.fileno())
+        header = os.pread(f.fileno(), HEADER.size, 0)
+        return ((stat.st_dev, stat.st_ino) == self.identity and len(header) == HEADER.size
+                and HEADER.unpack(header)[3:] == (self.count, self.stamp))
+
+    def position_of(self, column, value):
+        """Get the position of the first live row whose `column` equals `value`."""
+        for pos, other in enumerate(getattr(self, column)):
+            if other == value and not self.deleted[pos]:
+                return pos
+        return None
+
+    def match_chars(self, word, positions=None):
+        """Get the positions whose search text has all chars of `word` in order.
+
+        That is what MATCH_ALLCHARS accepts, and every other
+        `Workflow.filter` rule only accepts a subset of it, so the result
+        holds every row that can match an ASCII `word`. With sorted
+        `positions` only those rows are searched."""
+        word = word.lower().encode('ascii')
+        pattern = b'[^\n]*?'.join(re.escape(word[i:i + 1]) for i in range(len(word)))
+        return self.search.search(re.compile(pattern), positions)
+
+    def search_key(self, pos):
+        """Get the SearchKey of the row at `pos` for `Workflow.filter`.
+
+        The forms of the folded key are read from their columns rather
+        than worked out again, and the key is kept for the next query."""
+        key = self.search_keys.get(pos)
+        if key is None:
+            value = self.key[pos]
+            key = folded = SearchKey(Workflow.fold_to_ascii(value), self.search[pos], self.capitals[pos],
+                                     self.atoms[pos].split(' '), self.initials[pos])
+            if not value.isascii():
+                key = SearchKey(value, folded=folded)
+            self.search_keys[pos] = key
+        return key
+
+    def row(self, pos):
+        """Get the display fields of the store at `pos` as a store dict."""
+        categories = self.categories[pos]
+        store = {
+            'id': self.id[pos],
+            'name': self.name[pos],
+            'clickUrl': self.click_url[pos],
+            'rebate': {
+                'value': format_value(self.value[pos]),
+                'currency': self.currency[pos],
+                'isElevation': self.elevation[pos]
+            },
+            'bonus_percentage': self.bonus[pos],
+            'categories': [{'name': c} for c in categories.split(', ')] if categories else [],
+            'isDirect': self.direct[pos],
+            'flags': {'tracksMobile': self.mobile[pos]}
+        }
+        return store
+
+    def store(self, pos):
+        """Load the full API dict of the store at `pos`."""
+        with open(self.details_path, 'rb') as f:
+            return self.read_store(f, pos)
+
+    def stores(self, positions=None):
+        """Iterate over the full API dicts of `positions` (default all live rows)."""
+        with open(self.details_path, 'rb') as f:
+            for pos in (self.live_positions() if positions is None else positions):
+                yield self.read_store(f, pos)
+
+    def read_store(self, f, pos):
+        """Load the full API dict of the store at `pos` from the open details file `f`."""
+        start, end = self.details[2 * pos], self.details[2 * pos + 1]
+        f.seek(start)
+        return json.loads(f.read(end - start))
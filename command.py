@@ -1,16 +1,16 @@
 # encoding: utf-8
 
 import datetime
-from multiprocessing.sharedctypes import Value
 import sys
 import re
 import argparse
 from os.path import exists
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
 from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, web, PasswordNotFound
-from workflow.util import run_applescript
-from common import get_logo_file, get_stored_data, get_stores, get_bonus_percentage
+from workflow.util import LockFile, run_applescript
+from common import LOGO_RETRY_INTERVAL, get_catalogue, get_current_brand, get_logo_file, get_logos_dir, get_stored_data, get_stores, get_bonus_percentage, update_all_stores
 from brands import get_brand_config, BRANDS
+from logos import sync_logos
 import os
 import plistlib
 
@@ -26,18 +26,18 @@ log = None
 
 def find_store_by_url(wf, store_url):
     """Find store from store URL."""
-    stores = get_stores()
-    if not stores:
+    catalogue = get_stores()
+    if not catalogue:
         return None
     
     # Remove quotes if present
     store_url = store_url.strip('"')
     
     # Find store with matching URL
-    for store in stores:
-        if store.get('clickUrl') == store_url:
-            return store
-    return None
+    pos = catalogue.position_of('click_url', store_url)
+    if pos is None:
+        return None
+    return catalogue.row(pos)
 
 def update_brand(wf, brand_name):
     """Update all brand-related settings and files."""
@@ -90,32 +90,39 @@ def update_brand(wf, brand_name):
     return brand_config
 
 def get_logos(wf, stores):
-    """Download store logos."""
-    for store in stores:
-        if 'logoUrls' in store and '_120x60' in store['logoUrls']:
-            logo_url = store['logoUrls']['_120x60']
-            logo_file = get_logo_file(wf, store)
-            if not os.path.exists(logo_file):
-                # Get brand config for referer
-                brand_name = wf.stored_data('current_brand')
-                brand_config = get_brand_config(brand_name)
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
-                    'Referer': brand_config['url'] if brand_config else ''
-                }
-                try:
-                    r = web.get(logo_url, headers=headers)
-                    r.raise_for_status()
-                    with open(logo_file, 'wb') as f:
-                        f.write(r.content)
-                except Exception as e:
-                    print(f"Error downloading logo for {store['name']}: {e}")
+    """Download missing or changed store logos, several at a time."""
+    # Get brand config for referer
+    brand_name = get_current_brand(wf)
+    brand_config = get_brand_config(brand_name)
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+        'Referer': brand_config['url'] if brand_config else ''
+    }
+
+    def progress(done, total, url, error):
+        if error is not None:
+            wf.logger.error(f"Error downloading logo {url}: {error}")
+        if done % 50 == 0 or done == total:
+            wf.logger.info(f"Checked {done}/{total} logos")
+
+    meta = get_stored_data(wf, 'logo_meta') or {}
+    before = dict(meta)
+    downloaded, failed = sync_logos(get_logos_dir(wf), brand_name, stores, headers, meta, progress=progress)
+    # another download may have stored validators meanwhile, so only
+    # what this one changed is merged into what is stored now
+    with LockFile(wf.datafile('logo_meta')):
+        stored = get_stored_data(wf, 'logo_meta') or {}
+        stored.update((key, value) for key, value in meta.items() if before.get(key) != value)
+        wf.store_data('logo_meta', stored)
+    return downloaded, failed
 
 def main(wf):
     """Main workflow function."""
     parser = argparse.ArgumentParser()
     parser.add_argument('--update', action='store_true', help='Update store data')
+    parser.add_argument('--update-all', action='store_true', help='Update store data of every brand')
     parser.add_argument('--logos', action='store_true', help='Update store logos')
+    parser.add_argument('--logos-for', type=str, help='Download the logos of these comma-separated store ids')
     parser.add_argument('--reinit', action='store_true', help='Reinitialize workflow')
     parser.add_argument('--brand', type=str, help='Set current brand')
     parser.add_argument('--favorite', type=str, help='Add or remove store from favorites')
@@ -129,19 +136,42 @@ def main(wf):
         return
 
     if args.update:
-        stores = get_stores(force_update=True)
-        if stores:
-            wf.store_data('stores', stores)
+        catalogue = get_stores(force_update=True)
+        if catalogue:
             print("Store data updated successfully")
         else:
             print("Failed to update store data")
+    elif args.update_all:
+        results = update_all_stores(wf)
+        failed = sorted(brand for brand, result in results.items() if isinstance(result, Exception))
+        if failed:
+            print(f"Updated {len(results) - len(failed)} brands, failed: {', '.join(failed)}")
+        else:
+            print("Store data of all brands updated successfully")
     elif args.logos:
-        stores = get_stores(force_update=True)
-        if stores:
-            get_logos(wf, stores)
-            print("Store logos updated successfully")
+        catalogue = get_stores(force_update=True)
+        if catalogue:
+            downloaded, failed = get_logos(wf, catalogue.stores())
+            if failed:
+                print(f"Downloaded {downloaded} store logos, {len(failed)} failed")
+            else:
+                print("Store logos updated successfully")
         else:
             print("Failed to update store logos")
+    elif args.logos_for:
+        # only read the catalogue: updating it is the update job's
+        catalogue = get_catalogue(wf)
+        if catalogue is None:
+            return
+        store_ids = {int(store_id) for store_id in args.logos_for.split(',') if store_id}
+        positions = [pos for pos, store_id in enumerate(catalogue.id) if store_id in store_ids]
+        get_logos(wf, catalogue.stores(positions))
+        # remember the ones that still have no logo so the script filter
+        # doesn't keep asking for them
+        failed = set(wf.cached_data('logo_failures', max_age=LOGO_RETRY_INTERVAL) or [])
+        failed.update(store_id for store_id in store_ids
+                      if not get_logo_file(wf, {'id': store_id}))
+        wf.cache_data('logo_failures', sorted(failed))
     elif args.reinit:
         wf.clear_data()
         print("Workflow reinitialized")
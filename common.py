@@ -1,12 +1,45 @@
 # encoding: utf-8
 
 import os
-import json
-import time
 import random
+import itertools
 import datetime
-from workflow import ICON_WEB, Workflow, web
-from brands import BRANDS, get_brand_config
+from workflow import ICON_WEB, Workflow
+from brands import BRANDS
+from search_index import build_index
+from catalogue import CATALOGUE_FILE, load_catalogue, write_catalogue
+from logos import LOGOS_DIR, find_link
+from sync import sync_catalogue
+from jsonstream import JSONStream
+from merchants import ALL_BRANDS, merchant_stores
+
+# Stores older than this many seconds are refreshed
+UPDATE_INTERVAL = 24 * 60 * 60
+# Name of the background job that refreshes the stores of the current brand
+UPDATE_JOB = 'update'
+# Name of the background job that refreshes the stores of every brand
+UPDATE_ALL_JOB = 'update-all'
+# Name of the background job that fetches the logos of displayed stores
+LOGOS_JOB = 'logos'
+# Seconds before a logo that failed to download is tried again
+LOGO_RETRY_INTERVAL = 60 * 60
+# Seconds before a store update that failed is tried again in the background
+UPDATE_RETRY_INTERVAL = 15 * 60
+# Brand used until one is chosen
+DEFAULT_BRAND = 'american'
+# Each brand's catalogue lives in its own directory under this one
+BRANDS_DIR = 'brands'
+# Stores requested per page of the merchants API
+PAGE_SIZE = 500
+# Bytes of a response parsed at a time
+CHUNK_SIZE = 64 * 1024
+# Number of store updates kept in the change log
+CHANGE_LOG_SIZE = 100
+# API responses are cached in this directory of the cache dir, to ask
+# the API for the pages of stores only if they have changed
+HTTP_CACHE_DIR = 'http'
+# Bytes of API responses cached
+HTTP_CACHE_SIZE = 32 * 1024 * 1024
 
 def get_random_user_agent():
     """Get a random but realistic user agent string."""
@@ -45,13 +78,19 @@ def get_bonus_percentage(store):
         return 0
     return ((current - original) / original) * 100
 
-def get_stores_from_api(brand_config):
-    """Fetch stores from API."""
+def get_http_cache(wf):
+    """Get the cache of API responses."""
+    from workflow import web
+    return web.HTTPCache(wf.cachefile(HTTP_CACHE_DIR), max_size=HTTP_CACHE_SIZE)
+
+def get_api_request(brand_config):
+    """Get the URL, params and headers of the first page of stores of a brand."""
     params = {
         'brand_id': brand_config['brand_id'],
         'app_key': brand_config['app_key'],
         'app_id': brand_config['app_id'],
-        'limit': 2000,
+        'offset': 0,
+        'limit': PAGE_SIZE,
         'sort_by': 'name',
         'fields': 'name,type,id,clickUrl,synonyms,showRebate,rebate,logoUrls._120x60,relatedActiveMerchants,categories',
         'include_inactive': 0
@@ -69,80 +108,348 @@ def get_stores_from_api(brand_config):
         'Referer': brand_config['url'],
         'Accept-Language': 'en-US,en;q=0.9'
     }
+    return 'https://api.cartera.com/content/v4/merchants', params, headers
+
+def get_stores_from_api(wf, brand, session=None):
+    """Fetch the stores of `brand` from API, a page of PAGE_SIZE stores at a time.
+
+    Stores are yielded as soon as they are parsed from the response, so
+    a caller can use the first pages before the last one arrives and
+    no response is ever held in memory whole. The pages are requested
+    over the connections of `session`, a new `web.Session` by default."""
+    # not needed to answer queries, so only imported to fetch
+    from workflow import web
+    if session is None:
+        with web.Session(cache=get_http_cache(wf)) as session:
+            yield from get_stores_from_api(wf, brand, session)
+        return
+    url, params, headers = get_api_request(BRANDS[brand])
     
-    try:
-        r = web.get(url='https://api.cartera.com/content/v4/merchants', headers=headers, params=params)
+    total = None
+    pages = 0
+    while total is None or params['offset'] < total:
+        r = session.get(url=url, headers=headers, params=params, stream=True)
         r.raise_for_status()  # Raise an exception for bad status codes
+        pages += 1
         
-        if not r.content:
-            wf.logger.error("Empty response from API")
-            return None
-            
-        data = r.json()
-        if not isinstance(data, dict) or 'response' not in data:
-            wf.logger.error("Invalid response format from API")
-            return None
-            
-        return data['response']
-    except Exception as e:
-        wf.logger.error(f"Error fetching stores: {e}")
-        return None
-
-def get_stores(force_update=False):
-    """Get stores from cache or update if needed."""
-    wf = Workflow()
+        chunks = r.iter_content(CHUNK_SIZE)
+        page = JSONStream(chunks, 'response')
+        count = 0
+        for store in page:
+            count += 1
+            yield store
+        # read to the end of the body, so the next page reuses the connection
+        for _ in chunks:
+            pass
+        
+        total = (page.members.get('metadata') or {}).get('total')
+        wf.logger.debug(f"fetched stores {params['offset']}-{params['offset'] + count} of {total}")
+        if total is None and count == PAGE_SIZE:
+            # no total to go by, so keep going until a short page
+            total = params['offset'] + count + 1
+        if not count:
+            break
+        params['offset'] += count
     
-    # Check if we need to update
-    last_update = get_stored_data(wf, 'last_update') or 0
+    # the pages the next update asks for only if they have changed
+    wf.store_data(brand_key('pages', brand), pages)
+
+def is_api_unchanged(wf, brand, session):
+    """Check if none of the pages of stores of `brand` changed since they were fetched.
+
+    Every page of the last fetch is requested again from the HTTP cache
+    of `session`, which only downloads the pages that have changed. A
+    changed page is kept in the cache for the fetch that follows."""
+    pages = get_stored_data(wf, brand_key('pages', brand))
+    if not pages or session.cache is None:
+        return False
+    url, params, headers = get_api_request(BRANDS[brand])
+    for page in range(pages):
+        r = session.get(url=url, headers=headers, params=dict(params, offset=page * PAGE_SIZE), stream=True)
+        if not r.from_cache:
+            if r.status_code == 200:
+                r.content  # read to the end, which stores it
+            return False
+        r.raw.close()
+    return True
+
+def brand_key(key, brand):
+    """Get the name the stored data `key` of `brand` is saved under."""
+    return f'{key}.{brand}'
+
+def get_brand_dir(wf, brand):
+    """Get the directory of the catalogue of `brand`, creating it if need be."""
+    path = wf.datafile(os.path.join(BRANDS_DIR, brand))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_last_update(wf, brand=None):
+    """Get the time of the last store update of `brand` (default the current one) as a unix timestamp."""
+    last_update = get_stored_data(wf, brand_key('last_update', brand or get_current_brand(wf))) or 0
     if isinstance(last_update, datetime.datetime):
         last_update = int(last_update.timestamp())
+    return last_update
+
+def is_update_due(wf, brand=None):
+    """Check if the stored stores are more than UPDATE_INTERVAL old."""
     now = int(datetime.datetime.now().timestamp())
+    return now - get_last_update(wf, brand) > UPDATE_INTERVAL
+
+def is_updating():
+    """Check if a background update of the current brand's stores is running."""
+    from workflow.background import is_running
+    return is_running(UPDATE_JOB) or is_running(UPDATE_ALL_JOB)
+
+def has_update_failed(wf, brand=None):
+    """Check if the last update of `brand` (default the current one) failed less than UPDATE_RETRY_INTERVAL ago."""
+    key = brand_key('update_failed', brand or get_current_brand(wf))
+    return bool(wf.cached_data(key, max_age=UPDATE_RETRY_INTERVAL))
+
+def set_update_failed(wf, brand, failed=True):
+    """Remember whether the last update of `brand` failed."""
+    wf.cache_data(brand_key('update_failed', brand), True if failed else None)
+
+def update_stores_in_background(wf):
+    """Start `command.py --update` as a background job unless it or a logo download is running.
+
+    The update is started again by a later query once the download is
+    done, so the two jobs never run at once. After a failed update, as
+    when offline, it isn't retried for UPDATE_RETRY_INTERVAL."""
+    from workflow.background import run_in_background
+    if is_updating() or is_fetching_logos() or has_update_failed(wf):
+        return
+    run_in_background(UPDATE_JOB, ['/usr/bin/python3', wf.workflowfile('command.py'), '--update'])
+
+def is_fetching_logos():
+    """Check if a background logo download is running."""
+    from workflow.background import is_running
+    return is_running(LOGOS_JOB)
+
+def fetch_logos_in_background(wf, store_ids):
+    """Start `command.py --logos-for` for `store_ids` unless a download or an update is running."""
+    from workflow.background import run_in_background
+    if is_fetching_logos() or is_updating():
+        return
+    ids = ','.join(str(store_id) for store_id in store_ids)
+    run_in_background(LOGOS_JOB, ['/usr/bin/python3', wf.workflowfile('command.py'), '--logos-for', ids])
+
+def get_stores(force_update=False, brand=None):
+    """Get the store catalogue of `brand` (default the current one) from cache or update it if needed."""
+    wf = Workflow()
+    brand = brand or get_current_brand(wf)
     
     # Update if forced or more than 24 hours have passed
-    if force_update or now - last_update > 24 * 60 * 60:
+    if force_update or is_update_due(wf, brand):
         try:
-            # Get current brand
-            current_brand = get_stored_data(wf, 'current_brand')
-            if isinstance(current_brand, bytes):
-                current_brand = current_brand.decode('utf-8')
-            
-            # Get brand configuration
-            brand_config = BRANDS.get(current_brand)
-            if not brand_config:
-                raise ValueError(f"Invalid brand: {current_brand}")
-            
-            # Get stores from API
-            stores = get_stores_from_api(brand_config)
-            
-            # Calculate bonus percentage for each store
-            for store in stores:
-                store['bonus_percentage'] = get_bonus_percentage(store)
-            
-            # Store updated data
-            wf.store_data('stores', stores)
-            wf.store_data('last_update', datetime.datetime.now())
-            
-            return stores
-            
+            catalogue = update_stores(wf, brand)
+            save_merchant_table(wf)
+            return catalogue
         except Exception as e:
-            wf.logger.error(f"Error updating stores: {e}")
+            wf.logger.error(f"Error updating {brand} stores: {e}")
+            set_update_failed(wf, brand)
             # If update fails, try to return cached data
-            stores = get_stored_data(wf, 'stores')
-            if stores:
-                return stores
+            catalogue = get_catalogue(wf, brand)
+            if catalogue:
+                return catalogue
             raise
     
     # Return cached data if available
-    stores = get_stored_data(wf, 'stores')
-    if stores:
-        return stores
+    catalogue = get_catalogue(wf, brand)
+    if catalogue:
+        return catalogue
     
     # If no cached data, force an update
-    return get_stores(force_update=True)
+    return get_stores(force_update=True, brand=brand)
+
+def update_stores(wf, brand, session=None):
+    """Fetch the stores of `brand` and apply them to its catalogue.
+
+    If the API says none of its pages changed since the last update,
+    nothing is downloaded, parsed or written but the update time."""
+    from workflow import web
+    # Get brand configuration
+    brand_config = BRANDS.get(brand)
+    if not brand_config:
+        raise ValueError(f"Invalid brand: {brand}")
+    if session is None:
+        with web.Session(cache=get_http_cache(wf)) as session:
+            return update_stores(wf, brand, session)
+    
+    catalogue = get_catalogue(wf, brand)
+    if catalogue is not None and is_api_unchanged(wf, brand, session):
+        wf.logger.debug(f'{brand} stores unchanged')
+        wf.store_data(brand_key('last_update', brand), datetime.datetime.now())
+        set_update_failed(wf, brand, False)
+        return catalogue
+    
+    # Stream stores from API, calculating the bonus percentage of each
+    stores = (dict(store, bonus_percentage=get_bonus_percentage(store))
+              for store in get_stores_from_api(wf, brand, session))
+    
+    # Apply what changed to the catalogue and its search index
+    catalogue = sync_stores(wf, stores, brand)
+    wf.store_data(brand_key('last_update', brand), datetime.datetime.now())
+    set_update_failed(wf, brand, False)
+    return catalogue
+
+def update_all_stores(wf):
+    """Update the catalogues of every brand at once.
+
+    Returns a dict of each brand's updated catalogue, or of the error
+    that stopped its update."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from workflow import web
+    results = {}
+    # the brands share the connections to the API
+    with web.Session(max_connections=len(BRANDS), cache=get_http_cache(wf)) as session, \
+            ThreadPoolExecutor(max_workers=len(BRANDS)) as executor:
+        futures = {executor.submit(update_stores, wf, brand, session): brand for brand in BRANDS}
+        for future in as_completed(futures):
+            brand = futures[future]
+            error = future.exception()
+            if error is not None:
+                wf.logger.error(f"Error updating {brand} stores: {error}")
+                set_update_failed(wf, brand)
+            results[brand] = error or future.result()
+    save_merchant_table(wf)
+    return results
+
+def save_merchant_table(wf):
+    """Rebuild the cross-brand merchant table from the brands' catalogues.
+
+    Returns the table's catalogue, or None if no brand has stores yet."""
+    catalogues = {}
+    for brand in BRANDS:
+        catalogue = get_catalogue(wf, brand)
+        if catalogue is not None:
+            catalogues[brand] = catalogue
+    if not catalogues:
+        return None
+    return save_catalogue(wf, merchant_stores(catalogues), ALL_BRANDS)
+
+def catalogue_lock(wf, brand):
+    """Get the lock held while the catalogue of `brand` is written.
+
+    Updates of one brand in several processes, like a background update
+    and an `update-all`, take turns, so none patches rows of a catalogue
+    another replaced."""
+    from workflow.util import LockFile
+    return LockFile(os.path.join(get_brand_dir(wf, brand), CATALOGUE_FILE))
+
+def save_catalogue(wf, stores, brand):
+    """Write the catalogue snapshot and search index of `brand` for API `stores`."""
+    with catalogue_lock(wf, brand):
+        return write_brand_catalogue(wf, stores, brand)
+
+def write_brand_catalogue(wf, stores, brand):
+    """Write the catalogue of `brand` and its index, with its lock held."""
+    catalogue = write_catalogue(get_brand_dir(wf, brand), stores)
+    wf.store_data(brand_key('index', brand), build_index(catalogue.key, catalogue.stamp, catalogue.synonyms))
+    return catalogue
+
+def sync_stores(wf, stores, brand):
+    """Apply the changes in API `stores` to the catalogue and index, and log them.
+
+    Without a catalogue yet, the first page of stores is saved as soon as
+    it arrives so the script filter has something to show while the
+    rest loads. The catalogue is read, diffed and written with its lock
+    held."""
+    with catalogue_lock(wf, brand):
+        return locked_sync_stores(wf, stores, brand)
+
+def locked_sync_stores(wf, stores, brand):
+    catalogue = get_catalogue(wf, brand)
+    index = get_stored_data(wf, brand_key('index', brand))
+    first = None
+    if catalogue is None:
+        stores = iter(stores)
+        first = list(itertools.islice(stores, PAGE_SIZE))
+        if not first:
+            raise ValueError("No stores returned by the API")
+        catalogue = write_brand_catalogue(wf, first, brand)
+        index = get_stored_data(wf, brand_key('index', brand))
+        stores = itertools.chain(first, stores)
+    stamp = catalogue.stamp
+    catalogue, index, changes = sync_catalogue(get_brand_dir(wf, brand), catalogue, index, stores)
+    if first is not None:
+        changes = changes or {'time': datetime.datetime.now(), 'added': [], 'removed': [], 'rebates': []}
+        changes['added'][:0] = [(store['id'], store['name']) for store in first]
+    if changes is None:
+        wf.logger.debug(f'{brand} stores unchanged')
+        return catalogue
+    if catalogue.stamp != stamp:
+        wf.store_data(brand_key('index', brand), index)
+    wf.logger.info(f"{brand} stores: {len(changes['added'])} added, {len(changes['removed'])} removed, "
+                   f"{len(changes['rebates'])} rebates changed")
+    change_log = get_stored_data(wf, brand_key('changes', brand)) or []
+    change_log.append(changes)
+    wf.store_data(brand_key('changes', brand), change_log[-CHANGE_LOG_SIZE:])
+    return catalogue
+
+# Catalogues already mapped by this process, by data dir, with the
+# identity of the file they were mapped from
+_catalogues = {}
+
+def get_catalogue(wf, brand=None):
+    """Get the stored catalogue of `brand` (default the current one).
+
+    A long-running process (the daemon) reuses the mapping until the
+    file is replaced."""
+    brand = brand or get_current_brand(wf)
+    datadir = get_brand_dir(wf, brand)
+    try:
+        stat = os.stat(os.path.join(datadir, CATALOGUE_FILE))
+        identity = (stat.st_ino, stat.st_mtime_ns)
+    except OSError:
+        identity = None
+    cached = _catalogues.get(datadir)
+    if identity and cached and cached[0] == identity:
+        return cached[1]
+
+    catalogue = load_catalogue(datadir)
+    if catalogue is None and brand == get_current_brand(wf):
+        catalogue = migrate_catalogue(wf, brand)
+    elif catalogue is not None and identity:
+        _catalogues[datadir] = (identity, catalogue)
+    return catalogue
+
+def migrate_catalogue(wf, brand):
+    """Move the stores kept by older versions, for a single brand, to the catalogue of `brand`.
+
+    That is a catalogue in the data dir itself, or before that a pickled
+    `stores` blob."""
+    datadir = get_brand_dir(wf, brand)
+    legacy = load_catalogue(wf.datadir)
+    if legacy is not None:
+        os.replace(legacy.details_path, os.path.join(datadir, legacy.details_file))
+        os.replace(os.path.join(wf.datadir, CATALOGUE_FILE), os.path.join(datadir, CATALOGUE_FILE))
+        for key in ('index', 'last_update', 'changes'):
+            data = get_stored_data(wf, key)
+            if data is not None:
+                wf.store_data(brand_key(key, brand), data)
+                wf.store_data(key, None)
+        return load_catalogue(datadir)
+    stores = get_stored_data(wf, 'stores')
+    if stores:
+        catalogue = save_catalogue(wf, stores, brand)
+        wf.store_data('stores', None)
+        return catalogue
+    return None
+
+def get_current_brand(wf):
+    """Get the name of the current brand, or DEFAULT_BRAND if none has been set."""
+    current_brand = get_stored_data(wf, 'current_brand')
+    if isinstance(current_brand, bytes):
+        current_brand = current_brand.decode('utf-8')
+    return current_brand or DEFAULT_BRAND
+
+def get_logos_dir(wf):
+    return wf.datafile(LOGOS_DIR)
 
-def get_logo_file(wf, store):
-    filename = wf.datafile(str(store['id'])+'.jpg')
-    return filename
+def get_logo_file(wf, store, brand=None):
+    """Get the path of the store's logo for `brand` (default the current one), or None if it has none."""
+    brand = brand or get_current_brand(wf)
+    return find_link(get_logos_dir(wf), brand, store['id'])
 
 def get_stored_data(wf, key):
     """Retrieve stored data for the given key."""
@@ -0,0 +1,166 @@
+# encoding: utf-8
+
+"""Resident script filter server.
+
+When the `USE_DAEMON` workflow variable is set to 1, filter.py forwards
+its arguments over a Unix socket to this long-lived process, which
+keeps the interpreter, the imports and the mapped catalogue warm and
+answers with the feedback JSON. filter.py falls back to running the
+query itself whenever the daemon can't be reached, and starts one in
+the background. The daemon exits after IDLE_TIMEOUT seconds without a
+query.
+
+The client's environment is sent along with its arguments, and the
+daemon answers under it, so changes to the workflow variables (like
+`MAX_RESULTS`) apply to the next query rather than the next daemon.
+
+Only the standard library is imported at module level, so the client
+side stays cheap.
+"""
+
+import io
+import os
+import sys
+import json
+import signal
+import socket
+
+# Seconds without a query after which the daemon exits
+IDLE_TIMEOUT = 300
+# Seconds the client waits for the daemon before answering itself
+CLIENT_TIMEOUT = 2
+# Name of the background job running the daemon
+DAEMON_JOB = 'daemon'
+
+def is_enabled():
+    return os.environ.get('USE_DAEMON', '0') == '1'
+
+def socket_path():
+    """Get the path of the daemon socket, or None outside Alfred.
+
+    The socket lives in the (per-user) temp dir rather than the cache dir
+    because Unix socket paths are limited to about 100 bytes."""
+    import hashlib
+    import tempfile
+    cachedir = os.environ.get('alfred_workflow_cache')
+    if not cachedir:
+        return None
+    digest = hashlib.sha1(cachedir.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'ae-filter-{digest}.sock')
+
+def forward_query(args):
+    """Print the daemon's feedback for `args`.
+
+    Returns False, having printed nothing, if the daemon is disabled or
+    can't answer, in which case the caller must run the query itself."""
+    if not is_enabled() or any(arg.startswith('workflow:') for arg in args):
+        # magic arguments act on the calling process, so never forward them
+        return False
+    path = socket_path()
+    if not path or not os.path.exists(path):
+        return False
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(json.dumps({'args': args, 'env': dict(os.environ)}).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return False
+    response = b''.join(chunks)
+    if not response:
+        return False
+    sys.stdout.buffer.write(response)
+    sys.stdout.flush()
+    return True
+
+def start_daemon(wf):
+    """Start the daemon as a background job unless it is already running."""
+    from workflow.background import is_running, run_in_background
+    if not is_enabled() or is_running(DAEMON_JOB):
+        return
+    run_in_background(DAEMON_JOB, ['/usr/bin/python3', wf.workflowfile('daemon.py')])
+
+def answer(args, env=None):
+    """Run filter.py's main for `args` and return its feedback JSON.
+
+    The query runs with the client's environment `env` if given."""
+    import filter
+    from workflow import Workflow
+    argv = sys.argv
+    sys.argv = [argv[0]] + args
+    environ = dict(os.environ)
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+    out = io.StringIO()
+    try:
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            wf = Workflow(update_settings={
+                'github_slug': 'schwark/alfred-aadvantageshopping'
+            })
+            filter.log = wf.logger
+            wf.run(filter.main)
+        finally:
+            sys.stdout = stdout
+    finally:
+        sys.argv = argv
+        os.environ.clear()
+        os.environ.update(environ)
+    return out.getvalue().encode('utf-8')
+
+def handle(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    request = json.loads(b''.join(chunks))
+    conn.sendall(answer(request['args'], request.get('env')))
+
+def serve(wf):
+    """Answer queries until none arrive for IDLE_TIMEOUT seconds."""
+    path = socket_path()
+    if not path:
+        wf.logger.error('daemon: not running under Alfred')
+        return
+    if os.path.exists(path):
+        os.unlink(path)
+    # exit through the `finally` below so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+        os.chmod(path, 0o600)
+        sock.listen(8)
+        sock.settimeout(IDLE_TIMEOUT)
+        wf.logger.debug(f'daemon: listening on {path}')
+        try:
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    wf.logger.debug('daemon: idle, exiting')
+                    break
+                with conn:
+                    conn.settimeout(CLIENT_TIMEOUT)
+                    try:
+                        handle(conn)
+                    except Exception as e:
+                        wf.logger.error(f'daemon: error answering query: {e}')
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+if __name__ == '__main__':
+    from workflow import Workflow
+    wf = Workflow()
+    sys.exit(wf.run(serve))
@@ -1,18 +1,44 @@
 # encoding: utf-8
 
-import datetime
 import sys
+
+if __name__ == '__main__':
+    # Let the resident daemon answer if it is up, before paying for the
+    # imports below
+    import daemon
+    if daemon.forward_query(sys.argv[1:]):
+        sys.exit(0)
+
 import argparse
+import heapq
 import os
 from workflow import (
-    Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_SYNC
+    Workflow, ICON_WEB, ICON_BURN, ICON_SYNC,
+    MATCH_ALL, MATCH_ALLCHARS, MATCH_FUZZY, MATCH_SUBSTRING
 )
-from common import get_logo_file, get_stored_data, get_stores
+from common import (
+    LOGO_RETRY_INTERVAL, brand_key, fetch_logos_in_background, get_catalogue, get_logo_file, get_stored_data,
+    is_fetching_logos, is_update_due, is_updating, save_merchant_table, update_stores_in_background
+)
+from merchants import ALL_BRANDS
 from brands import BRANDS
-from command import update_brand
+from search_index import build_index, is_valid_index, lookup, lookup_fuzzy_word, lookup_synonym, lookup_word
+from prefix_cache import PrefixCache
+import batch_score
+from daemon import start_daemon
 
 log = None
 
+# Number of top results whose missing logos are fetched on demand
+LAZY_LOGOS = 20
+
+# Matching rules ranked after synonym matches
+WEAK_RULES = (MATCH_SUBSTRING, MATCH_FUZZY, MATCH_ALLCHARS)
+
+# Most stores shown for a query unless the MAX_RESULTS workflow variable
+# says otherwise (0 shows every match)
+MAX_RESULTS = 50
+
 # Configuration commands for the workflow
 config_commands = {
     'reinit': {
@@ -31,6 +57,14 @@ config_commands = {
         'icon': ICON_SYNC,
         'valid': True
     },
+    'update-all': {
+        'title': 'Update all brands',
+        'subtitle': 'Update the list of stores of every brand at once',
+        'args': '--update-all',
+        'autocomplete': 'update-all',
+        'icon': ICON_SYNC,
+        'valid': True
+    },
     'logos': {
         'title': 'Update logos',
         'subtitle': 'Update store logos',
@@ -69,16 +103,16 @@ def add_config_commands(wf, args, config_commands):
         if isinstance(current_brand, bytes):
             current_brand = current_brand.decode('utf-8')
             
-        for brand_key in matching_brands:
-            brand_info = BRANDS[brand_key]
+        for key in matching_brands:
+            brand_info = BRANDS[key]
             subtitle = f"Set {brand_info['name']} as current brand"
-            if brand_key == current_brand:
+            if key == current_brand:
                 subtitle = f"✓ {subtitle}"
             wf.add_item(
                 title=brand_info['name'],
                 subtitle=subtitle,
-                arg=f"--brand {brand_key}",
-                autocomplete=f"brand {brand_key}",
+                arg=f"--brand {key}",
+                autocomplete=f"brand {key}",
                 icon=brand_info['favicon'],
                 valid=True
             )
@@ -108,21 +142,15 @@ def parse_add_command(query):
     
     return {'name': name, 'url': url, 'tags': tags}
 
-def is_filtered_store(x, filters, favorites):
-    if ':fav' in filters and favorites and x['id'] not in favorites:
+def is_filtered_store(catalogue, pos, filters, favorites):
+    if catalogue.deleted[pos]:
         return False
-    if ':prm' in filters and not x['rebate']['isElevation']:
+    if ':fav' in filters and favorites and catalogue.id[pos] not in favorites:
+        return False
+    if ':prm' in filters and not catalogue.elevation[pos]:
         return False
     return True
 
-def get_categories(x):
-    categories = [c['name'] for c in (x['categories'] if 'categories' in x else [])]
-    return (', '.join(categories)) if categories else ''
-    
-def search_key_for_store(x):
-    categories = get_categories(x)
-    return x['name']+(' '+categories if categories else '')
-
 def get_subtitle(x, favorites):
     """Get subtitle for store item."""
     subtitle = []
@@ -132,12 +160,13 @@ def get_subtitle(x, favorites):
         subtitle.append('❤️')
     
     # Add rebate information
-    rebate = x['rebate']
-    if rebate['isElevation']:
+    rebate = x.get('rebate') or {}
+    value, currency = rebate.get('value', 0), rebate.get('currency', '')
+    if rebate.get('isElevation', False):
         bonus_pct = get_bonus_percentage(x)
-        subtitle.append(f"⚡ {rebate['value']} {rebate['currency']} (+{bonus_pct:.0f}% bonus)")
+        subtitle.append(f"⚡ {value} {currency} (+{bonus_pct:.0f}% bonus)")
     else:
-        subtitle.append(f"💰 {rebate['value']} {rebate['currency']}")
+        subtitle.append(f"💰 {value} {currency}")
     
     # Add categories if available
     if 'categories' in x and x['categories']:
@@ -154,41 +183,195 @@ def get_subtitle(x, favorites):
     
     return '  '.join(subtitle)
         
+def get_offers_subtitle(store):
+    """Get the subtitle prefix naming the portal with the best rebate and the others' rebates."""
+    best, others = store['offers'][0], store['offers'][1:]
+    subtitle = f"✈️ {BRANDS[best['brand']]['shop_name']}"
+    if others:
+        subtitle += ' (' + ', '.join(f"{BRANDS[offer['brand']]['shop_name']} {offer['value']} {offer['currency']}"
+                                      for offer in others) + ')'
+    return subtitle
+
+def get_max_results():
+    """Get the number of stores shown for a query, 0 meaning all of them."""
+    try:
+        return max(0, int(os.environ.get('MAX_RESULTS', MAX_RESULTS)))
+    except ValueError:
+        return MAX_RESULTS
+
 def get_bonus_percentage(store):
     """Get the pre-calculated bonus percentage for a store."""
     return store.get('bonus_percentage', 0)
 
-def get_query_stores(wf, query, stores, filters, favorites):
-    if stores is None:
+# Search index of the last catalogue, kept across queries by the daemon
+_index = None
+
+def get_search_index(wf, catalogue, brand):
+    """Get the search index for the brand's catalogue, rebuilding it if it is stale."""
+    global _index
+    if is_valid_index(_index, catalogue):
+        return _index
+    index = get_stored_data(wf, brand_key('index', brand))
+    if not is_valid_index(index, catalogue):
+        index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+        wf.store_data(brand_key('index', brand), index)
+    _index = index
+    return index
+
+def match_chars(catalogue, word, prefixes=None):
+    """Get the positions whose search text has the chars of `word`, narrowed by `prefixes` if given."""
+    return prefixes.match_chars(word) if prefixes else catalogue.match_chars(word)
+
+def fuzzy_words(index, word, prefixes=None):
+    """Get the positions with a token within typo reach of `word`, kept in `prefixes` if given."""
+    return prefixes.lookup_fuzzy_word(index, word) if prefixes else lookup_fuzzy_word(index, word)
+
+def match_all_chars(catalogue, query, prefixes=None):
+    """Get the sorted positions whose search text has the chars of every word of ASCII `query`."""
+    candidates = None
+    for word in query.split():
+        found = match_chars(catalogue, word, prefixes)
+        candidates = set(found) if candidates is None else candidates.intersection(found)
+        if not candidates:
+            break
+    return sorted(candidates or [])
+
+def get_candidate_stores(wf, query, catalogue, positions, index, prefixes=None):
+    """Get the positions that can match query, and the rules to match them on.
+
+    When the prefix index has hits, the candidates are the rows with the
+    chars of every word in order: a store any rule matches has them, the
+    prefix hits among them, so all are ranked by score together."""
+    if not query or not index:
+        return positions, MATCH_ALL
+    if lookup(index, query):
+        return (match_all_chars(catalogue, query, prefixes) if query.isascii() else positions), MATCH_ALL
+    if not query.isascii():
+        return positions, MATCH_ALL
+    # nothing indexed matches, so some word is a typo or only matches
+    # part of a word: look typos up in the index and search the mapped
+    # keys in place for the rest instead of scanning every row
+    candidates = None
+    for word in query.split():
+        found = lookup_word(index, word) | set(fuzzy_words(index, word, prefixes)) | set(match_chars(catalogue, word, prefixes))
+        candidates = found if candidates is None else candidates & found
+        if not candidates:
+            break
+    return sorted(candidates or []), MATCH_ALL | MATCH_FUZZY
+
+def is_weak_match(match):
+    """Whether a `(pos, score, rule)` match ranks after the synonym matches."""
+    return match[2] in WEAK_RULES
+
+def score_stores(wf, query, catalogue, positions, match_on=MATCH_ALL, max_results=0):
+    """Get the `(pos, score, rule)` of the stores at `positions` matching query, best first.
+
+    Many stores are scored in batches when NumPy is installed, which
+    gives the same results as `Workflow.filter`."""
+    if batch_score.can_score(wf, query, positions):
+        return batch_score.filter_stores(wf, query, catalogue, positions, match_on, max_results, is_weak_match)
+    return wf.filter(query, positions, key=catalogue.search_key, include_score=True, match_on=match_on,
+                     max_results=max_results, group=is_weak_match)
+
+def get_query_stores(wf, query, catalogue, filters, favorites, index=None, prefixes=None, max_results=0):
+    """Get the catalogue positions of the stores matching query and filters.
+
+    `prefixes` is the PrefixCache narrowing the rows searched in place.
+    With `max_results`, only that many of the best stores are ranked and
+    returned."""
+    if catalogue is None:
         wf.logger.error("No stores available")
         return []
         
-    filtered_stores = list(filter(lambda x: is_filtered_store(x,filters,favorites), stores))
+    positions = range(len(catalogue))
+    candidates, match_on = (get_candidate_stores(wf, query, catalogue, positions, index, prefixes)
+                            if ':prm' not in filters else (positions, MATCH_ALL))
+    filtered_stores = [pos for pos in candidates if is_filtered_store(catalogue, pos, filters, favorites)]
     
     # If :prm filter is present, sort by bonus percentage in descending order
     if ':prm' in filters:
         # First filter to only promotional stores
-        promo_stores = [store for store in filtered_stores if store['rebate']['isElevation']]
+        promo_stores = [pos for pos in filtered_stores if catalogue.elevation[pos]]
         # Sort by bonus percentage
+        if max_results:
+            return heapq.nlargest(max_results, promo_stores, key=lambda pos: catalogue.bonus[pos])
         promo_stores.sort(
-            key=get_bonus_percentage,
+            key=lambda pos: catalogue.bonus[pos],
             reverse=True
         )
         return promo_stores
     
-    # Otherwise use normal filtering
-    result = wf.filter(query, filtered_stores, key=lambda x: search_key_for_store(x))
+    # Otherwise use normal filtering; weak matches rank after the others,
+    # so a heap of max_results keeps the stores shown
+    result = score_stores(wf, query, catalogue, filtered_stores, match_on, max_results)
+    result = add_synonym_stores(query, catalogue, result, filters, favorites, index)
     # check to see if the first one is an exact match - if yes, remove all the other results
-    if result and query and 'name' in result[0] and result[0]['name'] and result[0]['name'].lower() == query.lower():
+    if result and query and catalogue.name[result[0]] and catalogue.name[result[0]].lower() == query.lower():
         result = result[0:1]
+    if max_results:
+        result = result[:max_results]
     return result
 
+def add_synonym_stores(query, catalogue, result, filters, favorites, index):
+    """Get the positions of scored `result` with the stores that have `query` as a synonym.
+
+    A synonym match ranks after the matches on the store name and
+    categories themselves, but before the weak substring, fuzzy and
+    all-chars ones."""
+    if not query:
+        # nothing was scored
+        return result
+    strong = [pos for pos, _, rule in result if rule not in WEAK_RULES]
+    weak = [pos for pos, _, rule in result if rule in WEAK_RULES]
+    if not index:
+        return strong + weak
+    found = set(strong)
+    synonyms = [pos for pos in lookup_synonym(index, query)
+                if pos not in found and is_filtered_store(catalogue, pos, filters, favorites)]
+    found.update(synonyms)
+    return strong + synonyms + [pos for pos in weak if pos not in found]
+
+def add_update_status(wf, stores):
+    """Refresh stale stores in the background and show that it is running.
+
+    Stale stores are still served; Alfred reruns the filter until the
+    update finishes so the results pick up the new stores."""
+    if not stores or is_update_due(wf):
+        update_stores_in_background(wf)
+    if is_updating():
+        wf.rerun = 0.5
+        wf.add_item('Refreshing stores…',
+                    'Showing cached stores until the update finishes' if stores else 'Fetching the list of stores',
+                    valid=False,
+                    icon=ICON_SYNC)
+
+def queue_missing_logos(wf, catalogue, positions, brand):
+    """Fetch the logos of the first LAZY_LOGOS shown stores in the background.
+
+    Alfred reruns the filter while the download runs so the icons show
+    up as they arrive. Returns the logo files found, by store id."""
+    logo_files = {}
+    missing = []
+    for pos in positions[:LAZY_LOGOS]:
+        store_id = catalogue.id[pos]
+        logo_file = get_logo_file(wf, {'id': store_id}, brand)
+        if logo_file:
+            logo_files[store_id] = logo_file
+        else:
+            missing.append(store_id)
+    if missing:
+        failed = set(wf.cached_data('logo_failures', max_age=LOGO_RETRY_INTERVAL) or [])
+        missing = [store_id for store_id in missing if store_id not in failed]
+    if missing:
+        fetch_logos_in_background(wf, missing)
+    if missing or is_fetching_logos():
+        wf.rerun = 0.5
+    return logo_files
+
 def main(wf):
-    # retrieve cached devices and scenes
-    last_update = get_stored_data(wf, 'last_update') or 0
-    if isinstance(last_update, datetime.datetime):
-        last_update = int(last_update.timestamp())
-    stores = get_stored_data(wf, 'stores')
+    # answer the next queries from a warm daemon if it is enabled
+    start_daemon(wf)
+
     favorites = get_stored_data(wf, 'favorites') or {}
     
     # Ensure default brand is set and icon.png exists
@@ -202,11 +385,16 @@ def main(wf):
         current_brand = current_brand.decode('utf-8')
     dst_icon = wf.workflowfile('icon.png')
     if not os.path.exists(dst_icon):
+        # command.py is heavy to import and only needed this once
+        from command import update_brand
         try:
             update_brand(wf, current_brand)
         except ValueError as e:
             log.error(f"Error updating brand: {e}")
     
+    # retrieve cached stores of the current brand
+    catalogue = get_catalogue(wf, current_brand)
+    
     # build argument parser to parse script args and collect their
     # values
     parser = argparse.ArgumentParser()
@@ -220,25 +408,50 @@ def main(wf):
     # Add config commands
     add_config_commands(wf, args, config_commands)
     
-    # Get stores for current brand
-    stores = get_stores()
+    # Refresh stores for current brand without blocking the results
+    add_update_status(wf, catalogue)
     
     # Extract filters and update query
     filters = [t for t in args.query.split()] if args.query else []
     filters = [t for t in filters if t.startswith(':')]
     query = " ".join(filter(lambda x: x[0]!=':', args.query.split())) if args.query else ""
     
-    # Get filtered stores
-    filtered_stores = get_query_stores(wf, query, stores, filters, favorites)
+    # :all searches the merchant table joining every brand's stores
+    brand = current_brand
+    if ':all' in filters:
+        brand = ALL_BRANDS
+        catalogue = get_catalogue(wf, ALL_BRANDS) or save_merchant_table(wf)
+    
+    # Get filtered stores, narrowing the rows searched from the last keystrokes
+    index = get_search_index(wf, catalogue, brand) if catalogue else None
+    prefixes = PrefixCache(wf, brand, catalogue) if catalogue else None
+    filtered_stores = get_query_stores(wf, query, catalogue, filters, favorites, index, prefixes,
+                                       get_max_results())
+    if prefixes:
+        prefixes.save()
     
-    # Add filtered stores to results
-    for store in filtered_stores:
+    # Fetch the logos of the top results if they aren't there yet
+    logo_files = {}
+    if catalogue and brand == current_brand:
+        logo_files = queue_missing_logos(wf, catalogue, filtered_stores, current_brand)
+    
+    # Add filtered stores to results, building only the rows shown; the
+    # merchant table keeps the brand and offers in the full stores
+    if brand == ALL_BRANDS:
+        stores = catalogue.stores(filtered_stores)
+    else:
+        stores = (catalogue.row(pos) for pos in filtered_stores)
+    for store in stores:
+        logo_file = logo_files.get(store['id']) or get_logo_file(wf, store, store.get('brand', current_brand))
+        subtitle = get_subtitle(store, favorites)
+        if 'offers' in store:
+            subtitle = f"{get_offers_subtitle(store)}  {subtitle}"
         wf.add_item(
             title=store['name'],
-            subtitle=get_subtitle(store, favorites),
+            subtitle=subtitle,
             arg=f'"{store["clickUrl"]}"',  # Quote the URL
             valid=True,
-            icon=get_logo_file(wf, store)
+            icon=logo_file
         )
     
     wf.send_feedback()
@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+import re
+import json
+import codecs
+
+WHITESPACE = re.compile(r'\s*')
+# Chars that may follow a complete JSON value
+DELIMITERS = ' \t\r\n,]}'
+
+decoder = json.JSONDecoder()
+
+class JSONStream:
+    """Incremental parser for a JSON object whose largest member is an array.
+
+    Chunks of the utf-8 body are fed in as they arrive. The elements of
+    the array under `key` are handed out one at a time as soon as they
+    are complete; every other member of the object is parsed whole into
+    `members`. Only the part of the body that hasn't been parsed yet is
+    kept in memory."""
+
+    def __init__(self, chunks, key):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.members = {}
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.done = False
+
+    def read(self):
+        """Append the next chunk to the buffer. Returns False at the end of the body."""
+        if self.done:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            self.buf = self.buf[self.pos:] + self.text.decode(b'', final=True)
+        else:
+            self.buf = self.buf[self.pos:] + self.text.decode(chunk)
+        self.pos = 0
+        return True
+
+    def skip(self, chars=''):
+        """Skip whitespace and then one of `chars` if given, returning the char skipped."""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                break
+            if not self.read():
+                raise ValueError('unexpected end of JSON body')
+        if not chars:
+            return None
+        char = self.buf[self.pos]
+        if char not in chars:
+            raise ValueError(f'expected one of {chars!r} at {char!r}')
+        self.pos += 1
+        return char
+
+    def peek(self):
+        """Get the next char that isn't whitespace, without consuming it."""
+        self.skip()
+        return self.buf[self.pos]
+
+    def value(self):
+        """Parse the next complete JSON value."""
+        self.skip()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+                continue
+            # a number may go on in the next chunk, so only take one
+            # that is followed by a delimiter
+            if not isinstance(value, (dict, list, str)) and \
+                    (end == len(self.buf) or self.buf[end] not in DELIMITERS) and self.read():
+                continue
+            self.pos = end
+            return value
+
+    def read_more(self):
+        """Read until the unparsed part of the buffer has doubled.
+
+        Growing geometrically keeps reparsing a value split over many
+        small chunks linear. Returns False if the body had ended."""
+        want = 2 * (len(self.buf) - self.pos) + 1
+        grew = False
+        while len(self.buf) - self.pos < want and self.read():
+            grew = True
+        return grew
+
+    def __iter__(self):
+        """Iterate over the elements of the array, then finish parsing the object."""
+        self.skip('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            name = self.value()
+            self.skip(':')
+            if name == self.key:
+                self.skip('[')
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.skip(',]') == ']':
+                            break
+            else:
+                self.members[name] = self.value()
+            if self.skip(',}') == '}':
+                return
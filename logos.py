@@ -0,0 +1,281 @@
+# encoding: utf-8
+
+"""Store logo downloads.
+
+The path helpers are used by the script filter on every keystroke, so
+asyncio and the networking modules are only imported by the code that
+downloads. Downloads run concurrently in one event loop, and each new
+image is then scaled to a square thumbnail, which Alfred shows in its
+place.
+"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+import urllib.parse
+
+# Number of logos downloaded at once
+MAX_WORKERS = 8
+# Attempts per logo before giving up
+RETRIES = 3
+# Seconds to wait before the first retry, doubled for every other one
+BACKOFF = 0.5
+# Seconds before a connection or read times out
+TIMEOUT = 20
+# Redirects followed per logo
+MAX_REDIRECTS = 3
+# Seconds after which a temporary file nothing wrote to is left over,
+# even if a process has the pid in its name: a download writes more
+# often than every read times out
+STALE_PARTIAL_AGE = TIMEOUT * RETRIES
+
+# Logos are stored once per image under OBJECTS_DIR, named by content
+# hash, and linked from <brand>/<store id>.<ext>, the extension of the
+# file linked to. Their thumbnails are under THUMBS_DIR, by the same hash.
+LOGOS_DIR = 'logos'
+OBJECTS_DIR = 'objects'
+THUMBS_DIR = 'thumbs'
+# Extensions images are stored under, most common link first; others
+# are stored as .jpg
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.gif', '.jpeg')
+
+# Cartera logo URLs end in the SHA-1 of the image
+CONTENT_HASH = re.compile(r'/([0-9a-f]{40})\.\w+$')
+
+log = logging.getLogger(__name__)
+
+class DownloadError(Exception):
+    """A logo could not be downloaded."""
+
+    def __init__(self, message, retry=False):
+        super().__init__(message)
+        self.retry = retry
+
+def logo_hash(url):
+    """Get the hash a logo is stored under: the one in its URL, or one of the URL."""
+    match = CONTENT_HASH.search(url)
+    if match:
+        return match.group(1)
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def is_immutable(url):
+    """Whether the URL names its content, so a stored copy never goes stale."""
+    return CONTENT_HASH.search(url) is not None
+
+def object_path(logos_dir, url):
+    ext = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+    if ext not in IMAGE_EXTENSIONS:
+        ext = '.jpg'
+    return os.path.join(logos_dir, OBJECTS_DIR, logo_hash(url) + ext)
+
+def thumbnail_path(logos_dir, url):
+    return os.path.join(logos_dir, THUMBS_DIR, logo_hash(url) + '.png')
+
+def link_path(logos_dir, brand, store_id, ext):
+    return os.path.join(logos_dir, brand, f'{store_id}{ext}')
+
+def find_link(logos_dir, brand, store_id):
+    """Get the path of the brand's logo for `store_id`, or None if it has none."""
+    for ext in IMAGE_EXTENSIONS:
+        link = link_path(logos_dir, brand, store_id, ext)
+        if os.path.exists(link):
+            return link
+    return None
+
+def link_logo(logos_dir, brand, store_id, url):
+    """Point the brand's logo for `store_id` at the thumbnail of `url`, or at its image if it has none.
+
+    The link is named with the extension of the file it points at, and
+    a link to another file of the store is removed."""
+    path = thumbnail_path(logos_dir, url)
+    if not os.path.exists(path):
+        path = object_path(logos_dir, url)
+    ext = os.path.splitext(path)[1]
+    link = link_path(logos_dir, brand, store_id, ext)
+    target = os.path.relpath(path, os.path.dirname(link))
+    if not (os.path.islink(link) and os.readlink(link) == target):
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        tmp = f'{link}.{os.getpid()}.tmp'
+        os.symlink(target, tmp)
+        os.replace(tmp, link)
+    for other in IMAGE_EXTENSIONS:
+        if other != ext:
+            try:
+                os.remove(link_path(logos_dir, brand, store_id, other))
+            except FileNotFoundError:
+                pass
+
+async def fetch_logo(session, url, headers, logo_file):
+    """GET `url` with `session`, streaming the image to `logo_file` unless it is a 304.
+
+    The file is only replaced once the whole image has been received.
+    Returns the response."""
+    import asyncio
+    import http.client
+    try:
+        r = await session.get(url, headers=headers, timeout=TIMEOUT, stream=True)
+        if r.status_code == 200:
+            await r.save_to_path(logo_file)
+        else:
+            # read to the end, so the connection can be reused
+            await r.content()
+    except (OSError, asyncio.TimeoutError, http.client.HTTPException) as e:
+        raise DownloadError(f'{url}: {e}', retry=True)
+    if r.status_code not in (200, 304):
+        retry = r.status_code == 429 or r.status_code >= 500
+        raise DownloadError(f'{url}: HTTP {r.status_code}', retry=retry)
+    return r
+
+async def download_logo(session, semaphore, url, logo_file, headers, validators=None):
+    """Download `url` to `logo_file`, retrying transient failures with backoff.
+
+    Requests are made while holding `semaphore`. With `validators` from
+    an earlier download the request is conditional. Returns the
+    validators of the stored file, or None if the server says it
+    hasn't changed."""
+    import asyncio
+    headers = dict(headers)
+    if validators and os.path.exists(logo_file):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    for attempt in range(RETRIES):
+        try:
+            async with semaphore:
+                r = await fetch_logo(session, url, headers, logo_file)
+            break
+        except DownloadError as e:
+            if not e.retry or attempt == RETRIES - 1:
+                raise
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+    if r.status_code == 304:
+        return None
+    return {
+        'etag': r.headers.get('etag'),
+        'last_modified': r.headers.get('last-modified')
+    }
+
+def download_logos(jobs, headers, meta, workers=MAX_WORKERS, progress=None):
+    """Download `(url, logo_file)` jobs concurrently.
+
+    `meta` maps logo hashes to the validators of the stored images and
+    is updated in place. `progress` is called with `(done, total, url,
+    error)` after every job. Returns the number of logos downloaded and
+    a list of `(url, error)` for the ones that failed."""
+    import asyncio
+    return asyncio.run(download_all(jobs, headers, meta, workers, progress))
+
+async def download_all(jobs, headers, meta, workers, progress):
+    """Run the downloads of `download_logos`, `workers` at a time."""
+    import asyncio
+    from workflow import aioweb
+    semaphore = asyncio.Semaphore(workers)
+    failed = []
+    downloaded = 0
+    done = 0
+    async with aioweb.Session(max_connections=workers, max_redirects=MAX_REDIRECTS) as session:
+        async def download(url, logo_file):
+            try:
+                validators = await download_logo(session, semaphore, url, logo_file, headers,
+                                                 meta.get(logo_hash(url)))
+                return url, validators, None
+            except Exception as e:
+                return url, None, e
+        for job in asyncio.as_completed([download(url, logo_file) for url, logo_file in jobs]):
+            url, validators, error = await job
+            if error is not None:
+                failed.append((url, error))
+            elif validators is not None:
+                meta[logo_hash(url)] = validators
+                downloaded += 1
+            done += 1
+            if progress:
+                progress(done, len(jobs), url, error)
+    return downloaded, failed
+
+def is_stale_partial_file(entry, now):
+    """Whether the `<name>.<pid>.tmp` file of `entry` is left over from a process that died.
+
+    A file still being written is skipped: its process is alive and it
+    was written to within STALE_PARTIAL_AGE."""
+    try:
+        pid = int(entry.name.rsplit('.', 2)[1])
+        os.kill(pid, 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return True
+    except PermissionError:
+        # the process exists, but is another user's
+        pass
+    try:
+        return now - entry.stat().st_mtime > STALE_PARTIAL_AGE
+    except OSError:
+        return False
+
+def remove_partial_files(objects_dir):
+    """Remove the temporary files of downloads and thumbnails whose process died before finishing."""
+    now = time.time()
+    for entry in os.scandir(objects_dir):
+        if entry.name.endswith('.tmp') and is_stale_partial_file(entry, now):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def make_thumbnails(logos_dir, urls):
+    """Make the thumbnail of every stored image of `urls` that has none or an older one.
+
+    Images that can't be decoded get no thumbnail, and any error making
+    one is logged and skipped, so the stores are still linked to their
+    images. Returns the number of thumbnails made."""
+    import thumbnails
+    thumbs_dir = os.path.join(logos_dir, THUMBS_DIR)
+    os.makedirs(thumbs_dir, exist_ok=True)
+    remove_partial_files(thumbs_dir)
+    made = 0
+    for url in set(urls):
+        path = object_path(logos_dir, url)
+        thumbnail = thumbnail_path(logos_dir, url)
+        try:
+            if os.path.getmtime(thumbnail) >= os.path.getmtime(path):
+                continue
+        except OSError:
+            if not os.path.exists(path):
+                continue
+        try:
+            if thumbnails.make_thumbnail(path, thumbnail):
+                made += 1
+        except Exception as e:
+            log.error(f'Error making the thumbnail of {url}: {e}')
+    return made
+
+def sync_logos(logos_dir, brand, stores, headers, meta, progress=None):
+    """Make sure every store of `brand` has its logo linked.
+
+    Each distinct image is fetched once, however many stores or brands
+    use it. Images whose URL carries their hash are never fetched
+    again; others are revalidated with conditional requests. Stores are
+    linked to the thumbnails of the images. Returns the number of logos
+    downloaded and the failures."""
+    objects_dir = os.path.join(logos_dir, OBJECTS_DIR)
+    os.makedirs(objects_dir, exist_ok=True)
+    remove_partial_files(objects_dir)
+    links = []
+    jobs = {}
+    for store in stores:
+        url = store.get('logoUrls', {}).get('_120x60')
+        if not url:
+            continue
+        links.append((store['id'], url))
+        path = object_path(logos_dir, url)
+        if not os.path.exists(path) or not is_immutable(url):
+            jobs[path] = url
+    downloaded, failed = download_logos([(url, path) for path, url in jobs.items()], headers, meta,
+                                        progress=progress)
+    make_thumbnails(logos_dir, [url for _, url in links])
+    for store_id, url in links:
+        if os.path.exists(object_path(logos_dir, url)):
+            link_logo(logos_dir, brand, store_id, url)
+    return downloaded, failed
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+"""Cross-brand merchant table.
+
+The portals in BRANDS mostly list the same merchants under the same
+names. The table joins the catalogues of every brand on the normalized
+merchant name and keeps one row per merchant: the full store of the
+brand paying the best rebate, with a `brand` key naming that brand and
+an `offers` list of every brand's rebate, best first. It is written as
+a catalogue of its own, so the script filter searches it exactly like
+a brand's catalogue.
+
+Rebates per dollar spent, like 'miles/$', and flat amounts, like a
+'500 miles' bonus, can't be compared without the price, so a rate
+always ranks above a flat amount, and each kind is ranked by value.
+Within a kind, a mile, a point and a percent count the same.
+"""
+
+from catalogue import format_value
+from search_index import normalize
+
+# Pseudo-brand the merchant table is stored under
+ALL_BRANDS = 'all'
+
+def merchant_key(name):
+    """Get the name merchants are joined on."""
+    return normalize(name)
+
+def is_rate(currency):
+    """Whether a rebate in `currency` is earned per dollar spent rather than once."""
+    return '/$' in currency or currency.endswith('%')
+
+def rank_offer(catalogue, pos):
+    return (is_rate(catalogue.currency[pos]), catalogue.value[pos], catalogue.elevation[pos], catalogue.bonus[pos])
+
+def merchant_stores(catalogues):
+    """Iterate over the rows of the merchant table, ordered by name.
+
+    `catalogues` maps brands to their catalogues. Only the columns are
+    read to pick the best offers; the details of the winning stores are
+    loaded at the end."""
+    offers = {}
+    names = {}
+    for brand, catalogue in catalogues.items():
+        for pos in catalogue.live_positions():
+            name = catalogue.name[pos]
+            key = merchant_key(name)
+            if not key:
+                continue
+            names.setdefault(key, name)
+            offers.setdefault(key, []).append((rank_offer(catalogue, pos), brand, pos))
+    merchants = [sorted(offers[key], key=lambda offer: offer[0], reverse=True)
+                 for key in sorted(offers, key=lambda key: names[key].lower())]
+    # each brand's details file is opened once for all of its winners
+    winners = {}
+    for brand, catalogue in catalogues.items():
+        positions = [ranked[0][2] for ranked in merchants if ranked[0][1] == brand]
+        winners[brand] = dict(zip(positions, catalogue.stores(positions)))
+    for ranked in merchants:
+        _, brand, pos = ranked[0]
+        store = winners[brand][pos]
+        store['brand'] = brand
+        store['offers'] = [{
+            'brand': other,
+            'value': format_value(catalogues[other].value[other_pos]),
+            'currency': catalogues[other].currency[other_pos],
+            'isElevation': catalogues[other].elevation[other_pos]
+        } for _, other, other_pos in ranked]
+        yield store
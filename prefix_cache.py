@@ -0,0 +1,72 @@
+# encoding: utf-8
+
+"""Candidate rows of the words typed so far.
+
+Alfred reruns the script filter on every keystroke, so a query is
+usually the last one plus a character. Every row a word can match has
+the chars of the word in order in its search text, and so has the
+chars of any prefix of the word: the rows found for a prefix narrow
+the search for the word to themselves instead of the whole catalogue.
+The rows a word's typos can match are kept too, as the earlier words
+of a query are looked up again on every keystroke of the last one.
+
+The rows of the last MAX_WORDS words are kept in the cache dir per
+brand, least recently used first. They belong to one catalogue
+snapshot and are dropped once the stamp changes. Patching rows in
+place doesn't touch the searched text, so it keeps them valid. The
+cache is only written back when a word is added, so a query of kept
+words writes nothing.
+"""
+
+from array import array
+from collections import OrderedDict
+from search_index import lookup_fuzzy_word
+
+# Words whose candidate rows are kept per brand
+MAX_WORDS = 64
+
+class PrefixCache:
+    """Candidate rows of words of queries on one brand's catalogue."""
+
+    def __init__(self, wf, brand, catalogue):
+        self.wf = wf
+        self.name = f'prefixes.{brand}'
+        self.catalogue = catalogue
+        cached = wf.cached_data(self.name, max_age=0)
+        if not cached or cached['stamp'] != catalogue.stamp:
+            cached = {'stamp': catalogue.stamp, 'chars': OrderedDict(), 'fuzzy': OrderedDict()}
+        self.chars = cached['chars']
+        self.fuzzy = cached['fuzzy']
+        self.changed = False
+
+    def remember(self, words, word, find):
+        """Get the rows of `word` in `words`, calling `find` for them if they aren't kept."""
+        positions = words.get(word)
+        if positions is None:
+            positions = words[word] = array('I', sorted(find()))
+            while len(words) > MAX_WORDS:
+                words.popitem(last=False)
+            self.changed = True
+        else:
+            # a hit only reorders the words, which is saved with the next
+            # insert rather than rewriting the cache for it
+            words.move_to_end(word)
+        return positions
+
+    def match_chars(self, word):
+        """Get `catalogue.match_chars(word)`, narrowed from the longest kept prefix."""
+        word = word.lower()
+        def find():
+            prefix = max((other for other in self.chars if word.startswith(other)), key=len, default=None)
+            return self.catalogue.match_chars(word, None if prefix is None else self.chars[prefix])
+        return self.remember(self.chars, word, find)
+
+    def lookup_fuzzy_word(self, index, word):
+        """Get `lookup_fuzzy_word(index, word)` as a sorted array."""
+        return self.remember(self.fuzzy, word.lower(), lambda: lookup_fuzzy_word(index, word))
+
+    def save(self):
+        """Write the cache back if a word was added."""
+        if self.changed:
+            self.wf.cache_data(self.name, {'stamp': self.catalogue.stamp, 'chars': self.chars, 'fuzzy': self.fuzzy})
+            self.changed = False
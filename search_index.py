@@ -0,0 +1,173 @@
+# encoding: utf-8
+
+import re
+from bisect import bisect_left
+from workflow import Workflow
+from workflow.workflow import FUZZY_MIN_LENGTH, INITIALS, edit_distance, fuzzy_limit, split_on_delimiters
+
+# Bump whenever the layout of the persisted index changes
+INDEX_VERSION = 4
+
+def get_categories(x):
+    categories = [c['name'] for c in (x['categories'] if 'categories' in x else [])]
+    return (', '.join(categories)) if categories else ''
+
+def search_key_for_store(x):
+    categories = get_categories(x)
+    return x['name']+(' '+categories if categories else '')
+
+def normalize(text):
+    """Reduce a name or synonym to its lowercase ASCII letters and digits."""
+    return re.sub(r'[^a-z0-9]', '', Workflow.fold_to_ascii(text).lower())
+
+def bigrams(word):
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+def is_fuzzy_token(token):
+    """Whether typos of `token` are looked up: atoms a MATCH_FUZZY query can be a typo of."""
+    # a query of FUZZY_MIN_LENGTH chars may have one char too many
+    return len(token) >= FUZZY_MIN_LENGTH - 1 and token.isalnum()
+
+def add_fuzzy_token(fuzzy, token):
+    if is_fuzzy_token(token):
+        for gram in bigrams(token):
+            fuzzy.setdefault(gram, []).append(token)
+
+def tokens_for_key(key):
+    """Get the index tokens for a search key.
+
+    These mirror the cheap rules of `Workflow.filter`: the whole key
+    (MATCH_STARTSWITH), its capitals (MATCH_CAPITALS), its atoms
+    (MATCH_ATOM and atom prefixes) and the initials of its atoms
+    (MATCH_INITIALS_STARTSWITH)."""
+    value = Workflow.fold_to_ascii(key.strip())
+    atoms = [s.lower() for s in split_on_delimiters(value) if s]
+    tokens = set(atoms)
+    tokens.add(value.lower())
+    capitals = ''.join([c for c in value if c in INITIALS]).lower()
+    if capitals:
+        tokens.add(capitals)
+    initials = ''.join([s[0] for s in atoms])
+    if initials:
+        tokens.add(initials)
+    return tokens
+
+def add_synonyms(synonyms, text, pos):
+    """Map each normalized synonym in the comma-separated `text` to `pos`."""
+    for synonym in text.split(','):
+        synonym = normalize(synonym)
+        if synonym:
+            positions = synonyms.setdefault(synonym, [])
+            if not positions or positions[-1] != pos:
+                positions.append(pos)
+
+def build_index(keys, stamp=None, synonyms=()):
+    """Build a prefix index over the search `keys` of a catalogue.
+
+    The index also maps each normalized store synonym in `synonyms` (the
+    comma-separated synonyms of each row) to its rows, and the bigrams
+    of the atoms to the atoms, to find typos of them. Postings are row
+    positions, so the index is only valid for the catalogue snapshot
+    `stamp` it was built from."""
+    postings = {}
+    for pos, key in enumerate(keys):
+        for token in tokens_for_key(key):
+            postings.setdefault(token, []).append(pos)
+    synonym_map = {}
+    for pos, text in enumerate(synonyms):
+        add_synonyms(synonym_map, text, pos)
+    tokens = sorted(postings)
+    fuzzy = {}
+    for token in tokens:
+        add_fuzzy_token(fuzzy, token)
+    return {
+        'version': INDEX_VERSION,
+        'stamp': stamp,
+        'tokens': tokens,
+        'postings': [postings[t] for t in tokens],
+        'synonyms': synonym_map,
+        'fuzzy': fuzzy
+    }
+
+def add_to_index(index, keys, positions, stamp, synonyms=None):
+    """Add the search keys and `synonyms` of the rows at `positions` to `index` in place.
+
+    The rows must come after every row already indexed, which keeps the
+    postings sorted. `stamp` is the snapshot the index now belongs to."""
+    tokens = index['tokens']
+    postings = index['postings']
+    for pos in positions:
+        for token in tokens_for_key(keys[pos]):
+            i = bisect_left(tokens, token)
+            if i < len(tokens) and tokens[i] == token:
+                postings[i].append(pos)
+            else:
+                tokens.insert(i, token)
+                postings.insert(i, [pos])
+                add_fuzzy_token(index['fuzzy'], token)
+        if synonyms is not None:
+            add_synonyms(index['synonyms'], synonyms[pos], pos)
+    index['stamp'] = stamp
+    return index
+
+def is_valid_index(index, catalogue):
+    return bool(index) and index.get('version') == INDEX_VERSION and index.get('stamp') == catalogue.stamp
+
+def lookup_word(index, word):
+    """Get the set of row positions with a token starting with `word`."""
+    tokens = index['tokens']
+    postings = index['postings']
+    word = Workflow.fold_to_ascii(word).lower()
+    result = set()
+    i = bisect_left(tokens, word)
+    while i < len(tokens) and tokens[i].startswith(word):
+        result.update(postings[i])
+        i += 1
+    return result
+
+def lookup_synonym(index, query):
+    """Get the row positions of the stores that have `query` as a synonym."""
+    return index['synonyms'].get(normalize(query), [])
+
+def lookup_fuzzy_word(index, word):
+    """Get the set of row positions with a token within MATCH_FUZZY's reach of `word`.
+
+    Tokens sharing too few bigrams with `word` to be that close are
+    never compared with it."""
+    word = Workflow.fold_to_ascii(word).lower()
+    limit = fuzzy_limit(word)
+    if not limit:
+        return set()
+    grams = bigrams(word)
+    counts = {}
+    for gram in grams:
+        for token in index['fuzzy'].get(gram, ()):
+            counts[token] = counts.get(token, 0) + 1
+    # an edit changes at most three bigrams (a transposition does)
+    need = len(grams) - 3 * limit
+    # and so does every char of `word` missing from the token
+    chars = set(word)
+    tokens = index['tokens']
+    result = set()
+    for token, count in counts.items():
+        if count < need or len(token) + limit < len(word) or len(chars.difference(token)) > limit:
+            continue
+        if edit_distance(word, token, limit) > limit and (
+                len(token) <= len(word) or edit_distance(word, token[:len(word)], limit) > limit):
+            continue
+        result.update(index['postings'][bisect_left(tokens, token)])
+    return result
+
+def lookup(index, query):
+    """Get the sorted row positions matching every word of `query`.
+
+    Returns an empty list if any word has no candidates, in which case
+    the caller should fall back to a full scan (substring and
+    all-characters matches are not indexed)."""
+    candidates = None
+    for word in query.split():
+        found = lookup_word(index, word)
+        candidates = found if candidates is None else candidates & found
+        if not candidates:
+            return []
+    return sorted(candidates) if candidates else []
@@ -0,0 +1,158 @@
+# encoding: utf-8
+
+"""Incremental catalogue sync.
+
+A refresh diffs the stores the API returned against the current
+catalogue by merchant id and applies only what changed:
+
+- stores whose rebate (or anything else outside the searched columns)
+  changed are patched into the mapped catalogue in place;
+- stores that left the API are marked deleted in place;
+- new stores, and stores whose name, categories, URL or currency
+  changed, are appended as new rows, the old row of a changed store
+  being marked deleted. Only the appended rows are added to the index.
+
+Once too many rows are marked deleted the catalogue and its index are
+rewritten from scratch, which also restores the API's ordering.
+"""
+
+import datetime
+import itertools
+from catalogue import (
+    STRING_COLUMNS, StaleCatalogue, append_stores, encode_store, format_value, load_catalogue, parse_value,
+    patch_catalogue, store_columns, write_catalogue
+)
+from search_index import add_to_index, build_index, is_valid_index
+
+# Rewrite everything once this share of the rows is marked deleted
+COMPACT_RATIO = 0.25
+
+def diff_stores(catalogue, stores):
+    """Compare raw API `stores` with the live rows of `catalogue` by id.
+
+    `stores` is consumed once, and only changed stores are kept.
+    Returns a dict of `added` (stores needing a new row), `replaced`
+    (positions of the rows those supersede), `patched` (positions
+    mapped to stores that can be updated in place), `removed`
+    (positions of stores the API no longer returns) and `rows` (the
+    stores in API order, as the position of unchanged ones or the new
+    store)."""
+    positions = {catalogue.id[pos]: pos for pos in catalogue.live_positions()}
+    seen = set()
+    added = []
+    replaced = []
+    patched = {}
+    rows = []
+    for store in stores:
+        if store['id'] in seen:
+            # pages shifted while they were fetched
+            continue
+        seen.add(store['id'])
+        pos = positions.pop(store['id'], None)
+        if pos is None:
+            added.append(store)
+            rows.append(store)
+            continue
+        values = store_columns(store, encode_store(store))
+        if values['digest'] == catalogue.digest[pos]:
+            rows.append(pos)
+            continue
+        rows.append(store)
+        if any(values[name] != getattr(catalogue, name)[pos] for name in STRING_COLUMNS):
+            added.append(store)
+            replaced.append(pos)
+        else:
+            patched[pos] = store
+    return {
+        'added': added,
+        'replaced': replaced,
+        'patched': patched,
+        'removed': sorted(positions.values()),
+        'rows': rows
+    }
+
+def describe_changes(catalogue, diff):
+    """Get the change log entry of a diff."""
+    replaced = {catalogue.id[pos]: pos for pos in diff['replaced']}
+    rebates = []
+    for pos, store in list(diff['patched'].items()) + [(replaced[s['id']], s) for s in diff['added']
+                                                       if s['id'] in replaced]:
+        rebate = store.get('rebate') or {}
+        old = (format_value(catalogue.value[pos]), catalogue.currency[pos])
+        new = (format_value(parse_value(rebate.get('value', 0))), rebate.get('currency', ''))
+        if old != new:
+            rebates.append((store['id'], store['name'], old, new))
+    return {
+        'time': datetime.datetime.now(),
+        'added': [(s['id'], s['name']) for s in diff['added'] if s['id'] not in replaced],
+        'removed': [(catalogue.id[pos], catalogue.name[pos]) for pos in diff['removed']],
+        'rebates': rebates
+    }
+
+def merged_stores(catalogue, rows, details=None):
+    """Get the stores of diffed `rows`, loading unchanged ones from `catalogue`.
+
+    They are read from the open `details` file if given."""
+    for row in rows:
+        if not isinstance(row, int):
+            yield row
+        elif details is None:
+            yield catalogue.store(row)
+        else:
+            yield catalogue.read_store(details, row)
+
+def sync_catalogue(datadir, catalogue, index, stores):
+    """Bring the catalogue in `datadir` and its `index` up to date with raw API `stores`.
+
+    `stores` may be an iterator over a response that is still arriving;
+    nothing is changed until it has been consumed without error.
+    Returns `(catalogue, index, changes)`, where `changes` is the change
+    log entry, or None if nothing changed and nothing was written."""
+    stores = iter(stores)
+    first = next(stores, None)
+    if first is None:
+        # never take an empty response for every store having gone
+        raise ValueError('no stores to sync')
+    stores = itertools.chain([first], stores)
+
+    if catalogue is None:
+        catalogue = write_catalogue(datadir, stores)
+        changes = {
+            'time': datetime.datetime.now(),
+            'added': [(catalogue.id[pos], catalogue.name[pos]) for pos in range(len(catalogue))],
+            'removed': [],
+            'rebates': []
+        }
+        return catalogue, build_index(catalogue.key, catalogue.stamp, catalogue.synonyms), changes
+
+    # keep the details of the diffed rows readable if the catalogue is replaced meanwhile
+    try:
+        details = open(catalogue.details_path, 'rb')
+    except FileNotFoundError:
+        # the catalogue was replaced before it was even read
+        return sync_catalogue(datadir, load_catalogue(datadir), index, stores)
+    with details:
+        diff = diff_stores(catalogue, stores)
+        rows = diff['rows']
+        if not (diff['added'] or diff['patched'] or diff['removed']):
+            return catalogue, index, None
+        changes = describe_changes(catalogue, diff)
+
+        deleted = len(catalogue) - len(rows) + len(diff['added'])
+        if deleted > COMPACT_RATIO * len(rows) or not is_valid_index(index, catalogue):
+            catalogue = write_catalogue(datadir, merged_stores(catalogue, rows, details))
+            return catalogue, build_index(catalogue.key, catalogue.stamp, catalogue.synonyms), changes
+
+        try:
+            patch_catalogue(catalogue, diff['patched'], diff['removed'] + diff['replaced'])
+        except StaleCatalogue:
+            # another process wrote the catalogue since it was read: diff
+            # the same stores against the one it wrote
+            stores = list(merged_stores(catalogue, rows, details))
+            return sync_catalogue(datadir, load_catalogue(datadir), index, stores)
+    if diff['added']:
+        count = len(catalogue)
+        catalogue = append_stores(catalogue, diff['added'])
+        index = add_to_index(index, catalogue.key, range(count, len(catalogue)), catalogue.stamp,
+                             catalogue.synonyms)
+    return catalogue, index, changes
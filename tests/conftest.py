@@ -0,0 +1,34 @@
+# encoding: utf-8
+
+import json
+import os
+import random
+import sys
+import pytest
+
+# the workflow's modules live at the top of the repo, as Alfred runs them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def load_stores():
+    """Get the stores of the sample API response, without the inactive ones."""
+    with open(os.path.join(ROOT, 'stores.json')) as f:
+        return [store for store in json.load(f)['response'] if 'rebate' in store]
+
+def sampled_queries(catalogue, count=100, seed=11):
+    """Get pieces of store names, some with a char dropped."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        name = catalogue.name[rng.randrange(len(catalogue))].lower()
+        start = rng.randrange(len(name))
+        query = name[start:start + rng.randint(1, 8)]
+        if rng.random() < 0.3 and len(query) > 4:
+            query = query[:2] + query[3:]
+        queries.append(query)
+    return queries
+
+@pytest.fixture(scope='module')
+def catalogue(tmp_path_factory):
+    from catalogue import write_catalogue
+    return write_catalogue(str(tmp_path_factory.mktemp('catalogue')), load_stores())
@@ -0,0 +1,27 @@
+# encoding: utf-8
+
+"""The NumPy scorer ranks exactly like `Workflow.filter`."""
+
+import pytest
+from conftest import sampled_queries
+from workflow import MATCH_ALL, MATCH_ALLCHARS, MATCH_FUZZY, Workflow
+from filter import is_weak_match
+import batch_score
+
+pytest.importorskip('numpy')
+
+QUERIES = [
+    's', 'a', 'bb', 'doh', 'best buy', 'walmrt', 'sephroa', 'xq', '1-800', 'hotels.com', 'co', 'hom depot',
+    ' nike ', 'of', 'the', 'mart', 'box',
+]
+
+@pytest.mark.parametrize('match_on', [MATCH_ALL, MATCH_ALL | MATCH_FUZZY, MATCH_ALL ^ MATCH_ALLCHARS])
+@pytest.mark.parametrize('max_results', [0, 50])
+def test_same_ranking_as_workflow_filter(catalogue, match_on, max_results):
+    wf = Workflow()
+    positions = list(range(len(catalogue)))
+    for query in QUERIES + sampled_queries(catalogue):
+        expected = wf.filter(query, positions, key=catalogue.search_key, include_score=True, match_on=match_on,
+                             max_results=max_results, group=is_weak_match)
+        assert batch_score.filter_stores(wf, query, catalogue, positions, match_on, max_results,
+                                         is_weak_match) == expected, query
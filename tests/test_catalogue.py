@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+"""Writing, mapping and syncing the binary store catalogue."""
+
+import copy
+import os
+import struct
+import pytest
+from conftest import load_stores
+from catalogue import (
+    CATALOGUE_FILE, HEADER, SECTION, StaleCatalogue, load_catalogue, patch_catalogue, write_catalogue
+)
+from search_index import build_index, lookup
+from sync import COMPACT_RATIO, diff_stores, sync_catalogue
+
+@pytest.fixture
+def stores():
+    return load_stores()[:200]
+
+def live_stores(catalogue):
+    return {catalogue.id[pos]: catalogue.store(pos) for pos in catalogue.live_positions()}
+
+def changed(stores):
+    """Get a copy of `stores` with one store each patched, renamed, removed and added."""
+    stores = copy.deepcopy(stores)
+    stores[5]['rebate']['value'] = 42
+    stores[6]['name'] = 'Zzqx Renamed'
+    del stores[7]
+    stores.append(dict(copy.deepcopy(stores[8]), id=424242, name='Brand New Shop'))
+    return stores
+
+def test_round_trip(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    assert len(catalogue) == len(stores)
+    assert list(catalogue.id) == [store['id'] for store in stores]
+    assert list(catalogue.name) == [store['name'] for store in stores]
+    assert list(catalogue.stores()) == stores
+    assert catalogue.store(17) == stores[17]
+    row = catalogue.row(17)
+    assert row['rebate']['currency'] == stores[17]['rebate']['currency']
+    assert row['rebate']['value'] == stores[17]['rebate']['value']
+    reloaded = load_catalogue(str(tmp_path))
+    assert reloaded.stamp == catalogue.stamp and list(reloaded.key) == list(catalogue.key)
+
+def rewrite(tmp_path, change):
+    """Change the bytes of the catalogue file in `tmp_path` with `change`, and load it again."""
+    path = os.path.join(str(tmp_path), CATALOGUE_FILE)
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    with open(path, 'wb') as f:
+        f.write(change(data))
+    return load_catalogue(str(tmp_path))
+
+def set_section(data, i, **fields):
+    names = ('name', 'kind', 'offset', 'size')
+    section = dict(zip(names, SECTION.unpack_from(data, HEADER.size + i * SECTION.size)))
+    section.update(fields)
+    SECTION.pack_into(data, HEADER.size + i * SECTION.size, *(section[name] for name in names))
+    return data
+
+@pytest.mark.parametrize('change', [
+    lambda data: data[:HEADER.size],
+    lambda data: data[:HEADER.size + SECTION.size],
+    lambda data: data[:len(data) // 2],
+    lambda data: data[:-1],
+    lambda data: set_section(data, 0, offset=len(data)),
+    lambda data: set_section(data, 0, size=1),
+    lambda data: set_section(data, 11, size=8),
+    lambda data: set_section(data, 1, kind=ord('q')),
+    lambda data: set_section(data, 2, name=b'bogus'),
+    lambda data: struct.pack_into('<I', data, HEADER.size - 12, 10 ** 6) or data,
+], ids=['header', 'table', 'half', 'last byte', 'offset', 'strings size', 'numbers size', 'kind', 'name',
+        'count'])
+def test_corrupt_file_not_loaded(tmp_path, stores, change):
+    write_catalogue(str(tmp_path), stores)
+    assert rewrite(tmp_path, lambda data: data) is not None
+    assert rewrite(tmp_path, change) is None
+
+def test_diff(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    new = changed(stores)
+    diff = diff_stores(catalogue, new)
+    assert list(diff['patched']) == [5]
+    assert [store['id'] for store in diff['added']] == [stores[6]['id'], 424242]
+    assert diff['replaced'] == [6]
+    assert diff['removed'] == [7]
+    # unchanged stores are kept as their position
+    rows = [row if isinstance(row, int) else row['id'] for row in diff['rows']]
+    assert rows[:8] == [0, 1, 2, 3, 4, stores[5]['id'], stores[6]['id'], 8]
+
+def test_sync_in_place(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+    new = changed(stores)
+    catalogue, index, changes = sync_catalogue(str(tmp_path), catalogue, index, new)
+    # the two rows added are appended, and the old ones kept in place
+    assert len(catalogue) == len(stores) + 2
+    assert catalogue.id[5] == stores[5]['id'] and catalogue.value[5] == 42
+    assert catalogue.deleted[6] and catalogue.deleted[7]
+    assert live_stores(catalogue) == {store['id']: store for store in new}
+    assert live_stores(load_catalogue(str(tmp_path))) == live_stores(catalogue)
+    assert [catalogue.name[pos] for pos in lookup(index, 'zzqx')] == ['Zzqx Renamed']
+    assert [catalogue.name[pos] for pos in lookup(index, 'brand new')] == ['Brand New Shop']
+    assert changes['added'] == [(424242, 'Brand New Shop')]
+    assert changes['removed'] == [(stores[7]['id'], stores[7]['name'])]
+    assert [rebate[0] for rebate in changes['rebates']] == [stores[5]['id']]
+
+def test_sync_unchanged(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+    assert sync_catalogue(str(tmp_path), catalogue, index, copy.deepcopy(stores)) == (catalogue, index, None)
+    with pytest.raises(ValueError):
+        sync_catalogue(str(tmp_path), catalogue, index, [])
+
+def test_sync_compacts(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+    kept = stores[:int(len(stores) / (1 + COMPACT_RATIO)) - 1]
+    catalogue, index, changes = sync_catalogue(str(tmp_path), catalogue, index, kept)
+    assert len(catalogue) == len(kept)
+    assert not any(catalogue.deleted[pos] for pos in range(len(catalogue)))
+    assert list(catalogue.stores()) == kept
+    assert index['stamp'] == catalogue.stamp
+    assert len(changes['removed']) == len(stores) - len(kept)
+
+def test_stale_catalogue(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+    # another process writes a catalogue of its own meanwhile
+    write_catalogue(str(tmp_path), list(reversed(stores)))
+    new = changed(stores)
+    with pytest.raises(StaleCatalogue):
+        patch_catalogue(catalogue, {5: new[5]})
+    catalogue, index, changes = sync_catalogue(str(tmp_path), catalogue, index, new)
+    assert live_stores(catalogue) == {store['id']: store for store in new}
+    assert live_stores(load_catalogue(str(tmp_path))) == live_stores(catalogue)
+    assert [rebate[0] for rebate in changes['rebates']] == [stores[5]['id']]
+
+def test_replaced_while_stores_arrive(tmp_path, stores):
+    catalogue = write_catalogue(str(tmp_path), stores)
+    index = build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+    new = changed(stores)
+
+    def arriving():
+        for i, store in enumerate(new):
+            if i == 100:
+                write_catalogue(str(tmp_path), list(reversed(stores)))
+            yield store
+
+    # the patch finds the catalogue replaced, and the stores are diffed again
+    catalogue, index, changes = sync_catalogue(str(tmp_path), catalogue, index, arriving())
+    assert live_stores(catalogue) == {store['id']: store for store in new}
+    assert live_stores(load_catalogue(str(tmp_path))) == live_stores(catalogue)
+    assert index['stamp'] == catalogue.stamp
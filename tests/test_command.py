@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+"""Logo downloads started from the command line and the script filter."""
+
+import pytest
+from workflow import Workflow
+import command
+
+@pytest.fixture
+def wf(tmp_path, monkeypatch):
+    monkeypatch.setenv('alfred_workflow_bundleid', 'test.command')
+    monkeypatch.setenv('alfred_workflow_cache', str(tmp_path / 'cache'))
+    monkeypatch.setenv('alfred_workflow_data', str(tmp_path / 'data'))
+    return Workflow()
+
+def test_concurrent_validators_kept(wf, monkeypatch):
+    wf.store_data('logo_meta', {'old': {'etag': '"1"'}, 'changed': {'etag': '"1"'}})
+
+    def sync_logos(logos_dir, brand, stores, headers, meta, progress=None):
+        # a background download stores its validators meanwhile
+        wf.store_data('logo_meta', dict(wf.stored_data('logo_meta'), other={'etag': '"2"'}))
+        meta['changed'] = {'etag': '"3"'}
+        meta['new'] = {'etag': '"4"'}
+        return 2, []
+
+    monkeypatch.setattr(command, 'sync_logos', sync_logos)
+    assert command.get_logos(wf, []) == (2, [])
+    assert wf.stored_data('logo_meta') == {
+        'old': {'etag': '"1"'},
+        'changed': {'etag': '"3"'},
+        'new': {'etag': '"4"'},
+        'other': {'etag': '"2"'},
+    }
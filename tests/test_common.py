@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+"""Background store updates."""
+
+import os
+import time
+import pytest
+from workflow import Workflow
+from workflow import background
+import common
+
+@pytest.fixture
+def wf(tmp_path, monkeypatch):
+    monkeypatch.setenv('alfred_workflow_bundleid', 'test.common')
+    monkeypatch.setenv('alfred_workflow_cache', str(tmp_path / 'cache'))
+    monkeypatch.setenv('alfred_workflow_data', str(tmp_path / 'data'))
+    return Workflow()
+
+@pytest.fixture
+def started(monkeypatch):
+    started = []
+    monkeypatch.setattr(background, 'is_running', lambda name: False)
+    monkeypatch.setattr(background, 'run_in_background', lambda name, args: started.append(name))
+    return started
+
+def offline(wf, brand, session=None):
+    raise OSError('network is unreachable')
+
+def test_failed_update_backs_off(wf, started, monkeypatch):
+    monkeypatch.setattr(common, 'update_stores', offline)
+    with pytest.raises(OSError):
+        common.get_stores(force_update=True, brand='american')
+    assert common.has_update_failed(wf, 'american')
+    assert not common.has_update_failed(wf, 'united')
+    common.update_stores_in_background(wf)
+    assert started == []
+
+def test_retried_after_interval(wf, started):
+    common.set_update_failed(wf, 'american')
+    then = time.time() - common.UPDATE_RETRY_INTERVAL - 1
+    for name in os.listdir(wf.cachedir):
+        if name.startswith('update_failed.american'):
+            os.utime(os.path.join(wf.cachedir, name), (then, then))
+    common.update_stores_in_background(wf)
+    assert started == [common.UPDATE_JOB]
+
+def test_success_clears_failure(wf, started):
+    common.set_update_failed(wf, 'american')
+    common.set_update_failed(wf, 'american', False)
+    assert not common.has_update_failed(wf, 'american')
+    common.update_stores_in_background(wf)
+    assert started == [common.UPDATE_JOB]
@@ -0,0 +1,39 @@
+# encoding: utf-8
+
+"""Searching through the index ranks like `Workflow.filter` over every store."""
+
+import pytest
+from conftest import sampled_queries
+from workflow import MATCH_ALL, Workflow
+from search_index import build_index, lookup
+from filter import add_synonym_stores, get_query_stores, is_weak_match
+
+QUERIES = ['no', 'mart', 'box', 'book', 'x', 'target', 'best buy', 'co', 'the', 'of', '1-800', 'hotels.com']
+
+@pytest.fixture(scope='module')
+def index(catalogue):
+    return build_index(catalogue.key, catalogue.stamp, catalogue.synonyms)
+
+def filter_every_store(wf, query, catalogue, index, max_results):
+    """Get the stores `get_query_stores` should show, scoring every row."""
+    result = wf.filter(query, range(len(catalogue)), key=catalogue.search_key, include_score=True,
+                       match_on=MATCH_ALL, max_results=max_results, group=is_weak_match)
+    result = add_synonym_stores(query, catalogue, result, [], {}, index)
+    if result and catalogue.name[result[0]].lower() == query.lower():
+        result = result[0:1]
+    return result[:max_results] if max_results else result
+
+@pytest.mark.parametrize('max_results', [0, 10, 50])
+def test_same_ranking_as_every_store(catalogue, index, max_results):
+    wf = Workflow()
+    for query in QUERIES + sampled_queries(catalogue):
+        if not lookup(index, query):
+            # typos are only matched through the index
+            continue
+        assert (get_query_stores(wf, query, catalogue, [], {}, index, max_results=max_results)
+                == filter_every_store(wf, query, catalogue, index, max_results)), query
+
+def test_substring_ranks_by_score(catalogue, index):
+    names = [catalogue.name[pos] for pos in get_query_stores(Workflow(), 'no', catalogue, [], {}, index)]
+    # Canon isn't a prefix hit, but a shorter key with `no` in it scores higher
+    assert names.index('Canon') < names.index('Stop Aging Now')
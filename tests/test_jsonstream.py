@@ -0,0 +1,57 @@
+# encoding: utf-8
+
+"""Parsing the stores of an API response as its chunks arrive."""
+
+import json
+import pytest
+from jsonstream import JSONStream
+
+RESPONSE = {
+    'metadata': {'total': 3, 'offset': 0},
+    'response': [
+        {'id': 12345, 'name': 'Café "Quotes" \\ Backslash', 'rebate': {'value': 1.5, 'currency': 'miles/$'}},
+        {'id': 6, 'name': 'Tab\tNew\nline ☃ \U0001f6eb', 'categories': [], 'flags': {'tracksMobile': True}},
+        {'id': -7, 'name': '', 'rebate': None, 'value': 1e-3},
+    ],
+    'status': 'ok',
+}
+
+def parse(chunks):
+    stream = JSONStream(chunks, 'response')
+    return list(stream), stream.members
+
+def split(body, *cuts):
+    cuts = (0,) + cuts + (len(body),)
+    return [body[start:end] for start, end in zip(cuts, cuts[1:])]
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_every_split(indent):
+    body = json.dumps(RESPONSE, indent=indent, ensure_ascii=False).encode('utf-8')
+    members = {name: value for name, value in RESPONSE.items() if name != 'response'}
+    # cut inside strings, escapes, multibyte chars and numbers alike
+    for cut in range(1, len(body)):
+        assert parse(split(body, cut)) == (RESPONSE['response'], members), body[:cut]
+
+def test_byte_chunks():
+    body = json.dumps(RESPONSE, ensure_ascii=False).encode('utf-8')
+    assert parse(body[i:i + 1] for i in range(len(body)))[0] == RESPONSE['response']
+
+def test_escaped_unicode():
+    body = json.dumps(RESPONSE).encode('ascii')
+    # split inside a \\uXXXX escape
+    cut = body.index(b'\\u2603') + 3
+    assert parse(split(body, cut))[0] == RESPONSE['response']
+
+def test_number_at_chunk_end():
+    # 12 must not be taken for the whole of 12345
+    body = b'{"response": [12345, 6]}'
+    assert parse(split(body, body.index(b'345')))[0] == [12345, 6]
+
+@pytest.mark.parametrize('body', [b'{}', b'{"response": []}', b'{"total": 0}'])
+def test_empty(body):
+    assert parse([body])[0] == []
+
+@pytest.mark.parametrize('body', [b'{"response": [1, 2', b'{"response": [{"id": 1}', b'[1, 2]'])
+def test_truncated_or_invalid(body):
+    with pytest.raises(ValueError):
+        parse(split(body, 5))
@@ -0,0 +1,72 @@
+# encoding: utf-8
+
+"""Downloading logos and linking stores to them."""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import logos
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(FIXTURES, os.path.basename(self.path))
+        if not os.path.exists(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def store(server, store_id, name):
+    return {'id': store_id, 'logoUrls': {'_120x60': f'{server.url}/logos/{name}'}}
+
+def test_links_named_after_target(server, tmp_path):
+    logos_dir = str(tmp_path)
+    stores = [store(server, 1, 'baseline.jpg'), store(server, 2, 'progressive.jpg'), store(server, 3, 'missing.jpg')]
+    downloaded, failed = logos.sync_logos(logos_dir, 'american', stores, {}, {})
+    assert downloaded == 2 and len(failed) == 1
+    # a thumbnail is a PNG, and a logo that can't be scaled is shown as it is
+    link = logos.find_link(logos_dir, 'american', 1)
+    assert link == logos.link_path(logos_dir, 'american', 1, '.png')
+    assert os.path.realpath(link) == os.path.realpath(logos.thumbnail_path(logos_dir, stores[0]['logoUrls']['_120x60']))
+    link = logos.find_link(logos_dir, 'american', 2)
+    assert link == logos.link_path(logos_dir, 'american', 2, '.jpg')
+    assert os.path.realpath(link) == os.path.realpath(logos.object_path(logos_dir, stores[1]['logoUrls']['_120x60']))
+    assert logos.find_link(logos_dir, 'american', 3) is None
+    assert logos.find_link(logos_dir, 'united', 1) is None
+
+def test_link_to_other_file_replaced(server, tmp_path):
+    logos_dir = str(tmp_path)
+    stores = [store(server, 1, 'rgba.png'), store(server, 2, 'logo.gif')]
+    # as linked before the store got a thumbnail
+    os.makedirs(tmp_path / 'american')
+    os.symlink('nowhere', logos.link_path(logos_dir, 'american', 1, '.jpg'))
+    logos.sync_logos(logos_dir, 'american', stores, {}, {})
+    assert sorted(os.listdir(tmp_path / 'american')) == ['1.png', '2.png']
+
+def test_unknown_extension_stored_as_jpg(tmp_path):
+    path = logos.object_path(str(tmp_path), 'https://example.com/logo.webp?size=2')
+    assert path.endswith('.jpg')
+    assert logos.object_path(str(tmp_path), 'https://example.com/LOGO.GIF').endswith('.gif')
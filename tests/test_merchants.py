@@ -0,0 +1,41 @@
+# encoding: utf-8
+
+"""The cross-brand merchant table shown for `:all`."""
+
+from conftest import load_stores
+from catalogue import write_catalogue
+from merchants import merchant_stores
+from filter import get_subtitle
+
+def with_rebate(store, **rebate):
+    return dict(store, rebate=dict(store['rebate'], **rebate))
+
+def write_brand(tmp_path, brand, stores):
+    datadir = tmp_path / brand
+    datadir.mkdir()
+    return write_catalogue(str(datadir), stores)
+
+def test_best_offer_first(tmp_path):
+    stores = load_stores()[:20]
+    catalogues = {
+        'american': write_brand(tmp_path, 'american', stores),
+        'united': write_brand(tmp_path, 'united', [with_rebate(store, value=store['rebate']['value'] * 2)
+                                                   for store in stores[:10]]),
+        'delta': write_brand(tmp_path, 'delta', [with_rebate(store, value=1000, currency='miles')
+                                                 for store in stores[:5]]),
+    }
+    rows = list(merchant_stores(catalogues))
+    assert len(rows) == 20
+    assert [row['name'].lower() for row in rows] == sorted(store['name'].lower() for store in stores)
+    by_id = {row['id']: row for row in rows}
+    for i, store in enumerate(stores):
+        row = by_id[store['id']]
+        # a flat bonus never beats a rebate per dollar
+        assert row['brand'] == ('united' if i < 10 else 'american')
+        brands = ['united', 'american', 'delta'] if i < 5 else ['united', 'american'] if i < 10 else ['american']
+        assert [offer['brand'] for offer in row['offers']] == brands
+        assert row['name'] == store['name']
+
+def test_subtitle_without_rebate():
+    # inactive merchants come without a rebate
+    assert get_subtitle({'id': 1, 'name': 'Gone'}, {}).startswith('💰 0')
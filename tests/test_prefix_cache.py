@@ -0,0 +1,78 @@
+# encoding: utf-8
+
+"""Candidate rows kept across keystrokes."""
+
+import copy
+import pytest
+from conftest import load_stores
+from workflow import Workflow
+from catalogue import append_stores, load_catalogue, patch_catalogue, write_catalogue
+import prefix_cache
+from prefix_cache import PrefixCache
+
+KEYSTROKES = ['b', 'bo', 'boo', 'book', 'books', 'x', 'xq', 'ma', 'mar', 'mart', 'mat']
+
+@pytest.fixture
+def wf(tmp_path, monkeypatch):
+    monkeypatch.setenv('alfred_workflow_bundleid', 'test.prefixes')
+    monkeypatch.setenv('alfred_workflow_cache', str(tmp_path / 'cache'))
+    monkeypatch.setenv('alfred_workflow_data', str(tmp_path / 'data'))
+    return Workflow()
+
+@pytest.fixture
+def catalogue(tmp_path):
+    datadir = tmp_path / 'catalogue'
+    datadir.mkdir()
+    return write_catalogue(str(datadir), load_stores()[:300])
+
+def type_words(wf, catalogue, words):
+    """Look `words` up one keystroke at a time, as the script filter does."""
+    for word in words:
+        prefixes = PrefixCache(wf, 'american', catalogue)
+        assert list(prefixes.match_chars(word)) == catalogue.match_chars(word), word
+        prefixes.save()
+
+def test_same_rows_as_catalogue(wf, catalogue):
+    type_words(wf, catalogue, KEYSTROKES)
+    assert list(PrefixCache(wf, 'american', catalogue).chars) == KEYSTROKES
+
+def test_kept_across_patches(wf, catalogue):
+    type_words(wf, catalogue, KEYSTROKES)
+    stores = {pos: copy.deepcopy(catalogue.store(pos)) for pos in (1, 2)}
+    for store in stores.values():
+        store['rebate']['value'] = 42
+    patch_catalogue(catalogue, stores, removed=[3])
+    patched = load_catalogue(catalogue.datadir)
+    assert patched.stamp == catalogue.stamp
+    assert list(PrefixCache(wf, 'american', patched).chars) == KEYSTROKES
+    type_words(wf, patched, KEYSTROKES)
+
+def test_dropped_when_appended(wf, catalogue):
+    type_words(wf, catalogue, KEYSTROKES)
+    store = dict(catalogue.store(0), id=424242, name='Bookmart Xq')
+    appended = append_stores(catalogue, [store])
+    assert not PrefixCache(wf, 'american', appended).chars
+    type_words(wf, appended, KEYSTROKES)
+    assert len(appended) - 1 in PrefixCache(wf, 'american', appended).match_chars('bookm')
+
+def test_least_recently_used_dropped(wf, catalogue, monkeypatch):
+    monkeypatch.setattr(prefix_cache, 'MAX_WORDS', 3)
+    prefixes = PrefixCache(wf, 'american', catalogue)
+    for word in ('a', 'b', 'c'):
+        prefixes.match_chars(word)
+    prefixes.match_chars('a')
+    prefixes.match_chars('d')
+    assert list(prefixes.chars) == ['c', 'a', 'd']
+
+def test_saved_only_when_a_word_is_added(wf, catalogue, monkeypatch):
+    type_words(wf, catalogue, ['bo', 'ma'])
+    saved = []
+    monkeypatch.setattr(wf, 'cache_data', lambda name, data: saved.append(name))
+    prefixes = PrefixCache(wf, 'american', catalogue)
+    prefixes.match_chars('bo')
+    prefixes.match_chars('ma')
+    prefixes.save()
+    assert saved == []
+    prefixes.match_chars('mar')
+    prefixes.save()
+    assert saved == ['prefixes.american']
@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+"""Decoding and scaling of logos.
+
+The fixtures are a 48x24 logo saved by Pillow in each format; the
+`.rgba` file next to an image holds the pixels Pillow decodes it to.
+"""
+
+import os
+import struct
+import zlib
+import pytest
+import thumbnails
+from thumbnails import UnsupportedImage
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+def differences(pixels, expected):
+    return [abs(a - b) for a, b in zip(pixels, expected)]
+
+def set_png_header(data, **fields):
+    """Get PNG `data` with the IHDR fields changed and its CRC fixed."""
+    names = ('width', 'height', 'depth', 'color', 'compression', 'filter', 'interlace')
+    header = dict(zip(names, struct.unpack_from('>IIBBBBB', data, 16)))
+    header.update(fields)
+    body = b'IHDR' + struct.pack('>IIBBBBB', *(header[name] for name in names))
+    return data[:12] + body + struct.pack('>I', zlib.crc32(body)) + data[33:]
+
+def set_jpeg_frame(data, **fields):
+    """Get JPEG `data` with the size or the sampling factors of its first component changed."""
+    data = bytearray(data)
+    sof = data.index(b'\xff\xc0')
+    if 'size' in fields:
+        struct.pack_into('>HH', data, sof + 5, *fields['size'])
+    if 'sampling' in fields:
+        data[sof + 11] = fields['sampling']
+    return bytes(data)
+
+@pytest.mark.parametrize('name, tolerance', [
+    ('baseline.jpg', 2),
+    ('restart.jpg', 2),
+    ('gray.jpg', 2),
+    ('palette.png', 0),
+    ('rgba.png', 0),
+    ('logo.gif', 0),
+])
+def test_decode_like_pillow(name, tolerance):
+    width, height, pixels = thumbnails.decode(fixture(name))
+    assert (width, height) == (48, 24)
+    assert len(pixels) == 48 * 24 * 4
+    assert max(differences(pixels, fixture(name.rsplit('.', 1)[0] + '.rgba'))) <= tolerance
+
+def luma(pixels):
+    return [0.299 * pixels[i] + 0.587 * pixels[i + 1] + 0.114 * pixels[i + 2] for i in range(0, len(pixels), 4)]
+
+def test_decode_subsampled_jpeg():
+    # Pillow smooths the chroma it upsamples, which differs at the sharp
+    # color edges of the logo; the luma doesn't depend on it but where
+    # colors are clamped
+    width, height, pixels = thumbnails.decode(fixture('subsampled.jpg'))
+    assert (width, height) == (48, 24)
+    expected = fixture('subsampled.rgba')
+    diffs = differences(luma(pixels), luma(expected))
+    assert sum(diffs) / len(diffs) < 1.5
+    diffs = differences(pixels, expected)
+    assert sum(diffs) / len(diffs) < 5
+
+def test_palette_transparency():
+    _, _, pixels = thumbnails.decode(fixture('palette.png'))
+    assert 0 in pixels[3::4]
+
+@pytest.mark.parametrize('data', [
+    fixture('progressive.jpg'),
+    set_png_header(fixture('rgba.png'), interlace=1),
+    b'<html>not found</html>',
+], ids=['progressive', 'interlaced', 'html'])
+def test_unsupported_formats(data):
+    with pytest.raises(UnsupportedImage):
+        thumbnails.decode(data)
+
+@pytest.mark.parametrize('data', [
+    set_jpeg_frame(fixture('baseline.jpg'), sampling=0x01),
+    set_jpeg_frame(fixture('baseline.jpg'), sampling=0x51),
+    set_jpeg_frame(fixture('baseline.jpg'), size=(60000, 60000)),
+    set_png_header(fixture('rgba.png'), width=1 << 20, height=1 << 20),
+], ids=['zero sampling', 'sampling over 4', 'huge jpeg', 'huge png'])
+def test_corrupt_headers(data):
+    with pytest.raises(UnsupportedImage):
+        thumbnails.decode(data)
+
+def test_make_thumbnail(tmp_path):
+    target = str(tmp_path / 'thumb.png')
+    assert thumbnails.make_thumbnail(os.path.join(FIXTURES, 'rgba.png'), target, size=32)
+    with open(target, 'rb') as f:
+        width, height, pixels = thumbnails.decode(f.read())
+    assert (width, height) == (32, 32)
+    alpha = pixels[3::4]
+    # the 2:1 logo is scaled to 32x16 and centered between transparent bands
+    assert set(alpha[:8 * 32]) == {0} and set(alpha[24 * 32:]) == {0}
+    assert set(alpha[8 * 32:24 * 32]) == {255}
+
+def test_make_thumbnail_of_unsupported_image(tmp_path):
+    target = tmp_path / 'thumb.png'
+    assert not thumbnails.make_thumbnail(os.path.join(FIXTURES, 'progressive.jpg'), str(target))
+    assert not target.exists()
@@ -0,0 +1,148 @@
+# encoding: utf-8
+
+"""Kept-alive sessions and the HTTP cache, against a local server."""
+
+import asyncio
+import gzip
+import http.client
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from workflow import aioweb, web
+
+LAST_MODIFIED = 'Wed, 01 Jan 2025 00:00:00 GMT'
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path))
+        body = self.path.encode('utf-8') * 10
+        headers = {}
+        if self.path.startswith('/gzip'):
+            body = gzip.compress(body * 100)
+            headers['Content-Encoding'] = 'gzip'
+        if 'short' in self.path:
+            # promise more than is sent, then hang up
+            self.respond(200, body, headers, len(body) + 100)
+            self.close_connection = True
+            return
+        etag = f'"{self.server.version}-{self.path}"'
+        if self.path.startswith('/modified'):
+            fresh = self.headers.get('If-Modified-Since') == LAST_MODIFIED
+            headers['Last-Modified'] = LAST_MODIFIED
+        else:
+            fresh = self.headers.get('If-None-Match') == etag
+            headers['ETag'] = etag
+        if fresh:
+            self.server.revalidated += 1
+            self.respond(304, b'', {})
+            return
+        self.respond(200, body, headers)
+
+    def respond(self, status, body, headers, length=None):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.revalidated = 0
+    server.version = 1
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_connection_reused(server):
+    with web.Session() as session:
+        for page in range(5):
+            assert session.get(server.url + '/page', params={'n': page}).content == f'/page?n={page}'.encode() * 10
+    assert len(server.requests) == 5
+    assert len({address for address, _ in server.requests}) == 1
+
+@pytest.mark.parametrize('path', ['/etag', '/modified'])
+def test_revalidated_from_cache(server, tmp_path, path):
+    cache = web.HTTPCache(str(tmp_path))
+    with web.Session(cache=cache) as session:
+        first = session.get(server.url + path)
+        assert first.content == path.encode() * 10 and not first.from_cache
+        second = session.get(server.url + path)
+        assert second.status_code == 200 and second.from_cache
+        assert second.content == first.content
+    assert server.revalidated == 1
+    assert len(server.requests) == 2
+
+def test_changed_response_replaces_stored_one(server, tmp_path):
+    cache = web.HTTPCache(str(tmp_path))
+    with web.Session(cache=cache) as session:
+        session.get(server.url + '/etag').content
+        server.version = 2
+        changed = session.get(server.url + '/etag')
+        assert not changed.from_cache and changed.content
+        assert session.get(server.url + '/etag').from_cache
+    assert server.revalidated == 1
+
+def test_unread_response_not_stored(server, tmp_path):
+    cache = web.HTTPCache(str(tmp_path))
+    with web.Session(cache=cache) as session:
+        session.get(server.url + '/etag', stream=True).raw.read(5)
+        assert cache.get(server.url + '/etag') is None
+
+def test_least_recently_used_evicted(server, tmp_path):
+    cache = web.HTTPCache(str(tmp_path), max_entries=2)
+    urls = [f'{server.url}/page{n}' for n in range(3)]
+    with web.Session(cache=cache) as session:
+        for url in urls[:2]:
+            session.get(url).content
+            time.sleep(0.01)
+        # revalidating the first page marks it as used
+        assert session.get(urls[0]).from_cache
+        time.sleep(0.01)
+        session.get(urls[2]).content
+    assert cache.get(urls[1]) is None
+    for url in (urls[0], urls[2]):
+        stored = cache.get(url)
+        assert stored is not None
+        stored.close()
+
+def test_save_to_path_checks_length(server, tmp_path):
+    target = tmp_path / 'logo.jpg'
+    r = web.get(server.url + '/short', stream=True)
+    with pytest.raises(http.client.IncompleteRead):
+        r.save_to_path(str(target))
+    assert not target.exists()
+    assert list(tmp_path.iterdir()) == []
+    web.get(server.url + '/full', stream=True).save_to_path(str(target))
+    assert target.read_bytes() == b'/full' * 10
+
+def test_save_gzipped_to_path(server, tmp_path):
+    target = tmp_path / 'stores.json'
+    web.get(server.url + '/gzip', stream=True).save_to_path(str(target))
+    assert target.read_bytes() == b'/gzip' * 1000
+    # the length checked is that of the compressed body
+    with pytest.raises(http.client.IncompleteRead):
+        web.get(server.url + '/gzip-short', stream=True).save_to_path(str(tmp_path / 'short.json'))
+    assert not (tmp_path / 'short.json').exists()
+
+def test_async_save_gzipped_to_path(server, tmp_path):
+    target = tmp_path / 'stores.json'
+
+    async def save():
+        async with aioweb.Session() as session:
+            response = await session.get(server.url + '/gzip', stream=True)
+            await response.save_to_path(str(target))
+
+    asyncio.run(save())
+    assert target.read_bytes() == b'/gzip' * 1000
@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+"""Typo distance, search keys and bounded ranking of `Workflow.filter`."""
+
+import random
+import pytest
+from conftest import load_stores
+from workflow import MATCH_ALL, MATCH_FUZZY, Workflow
+from workflow.workflow import SearchKey, edit_distance
+
+QUERIES = ['a', 'ma', 'mart', 'best buy', 'walmrt', 'sephroa', 'the', 'co', 'xq', 'hom depot', 'of']
+
+def osa_distance(a, b):
+    """Unbounded optimal string alignment distance, for reference."""
+    d = [[i + j if not i or not j else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1, d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[len(a)][len(b)]
+
+@pytest.mark.parametrize('a, b, limit, distance', [
+    ('walmart', 'walmart', 2, 0),
+    ('walmart', 'walmrat', 1, 1),
+    ('sephora', 'sephroa', 1, 1),
+    ('ab', 'ba', 1, 1),
+    ('walmart', 'walmrt', 1, 1),
+    ('target', 'targte', 2, 1),
+    ('kitten', 'sitting', 3, 3),
+    # a distance over the limit comes back as limit + 1
+    ('kitten', 'sitting', 2, 3),
+    ('kitten', 'sitting', 0, 1),
+    ('abc', 'abcdef', 2, 3),
+    ('', 'abc', 5, 3),
+    # a transposed pair isn't edited again, unlike the Damerau distance
+    ('ca', 'abc', 3, 3),
+])
+def test_edit_distance(a, b, limit, distance):
+    assert edit_distance(a, b, limit) == distance
+    assert edit_distance(b, a, limit) == distance
+
+def test_edit_distance_like_unbounded():
+    rng = random.Random(5)
+    for _ in range(2000):
+        a = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 7)))
+        b = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 7)))
+        limit = rng.randint(0, 3)
+        assert edit_distance(a, b, limit) == min(osa_distance(a, b), limit + 1), (a, b, limit)
+
+@pytest.fixture(scope='module')
+def names():
+    return [store['name'] for store in load_stores()]
+
+def test_fuzzy_only_when_asked(names):
+    wf = Workflow()
+    assert 'Sephora.com' not in wf.filter('sephroa', names, match_on=MATCH_ALL)
+    assert 'Sephora.com' in wf.filter('sephroa', names, match_on=MATCH_ALL | MATCH_FUZZY)
+    # too short to tell a typo from another word
+    assert wf.filter('wlm', names, match_on=MATCH_FUZZY) == []
+
+@pytest.mark.parametrize('match_on', [MATCH_ALL, MATCH_ALL | MATCH_FUZZY])
+def test_search_key_like_string(names, match_on):
+    wf = Workflow()
+    keys = {name: SearchKey(name) for name in names}
+    for query in QUERIES:
+        assert (wf.filter(query, names, key=keys.get, include_score=True, match_on=match_on)
+                == wf.filter(query, names, include_score=True, match_on=match_on)), query
+
+def is_short(match):
+    return len(match[0]) < 8
+
+@pytest.mark.parametrize('group', [None, is_short])
+@pytest.mark.parametrize('max_results', [1, 5, 50])
+def test_max_results_like_unbounded(names, group, max_results):
+    wf = Workflow()
+    for query in QUERIES:
+        everything = wf.filter(query, names, include_score=True, match_on=MATCH_ALL | MATCH_FUZZY, group=group)
+        best = wf.filter(query, names, include_score=True, match_on=MATCH_ALL | MATCH_FUZZY, group=group,
+                         max_results=max_results)
+        assert best == everything[:max_results], query
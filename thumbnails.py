@@ -0,0 +1,688 @@
+# encoding: utf-8
+
+"""Square PNG thumbnails of store logos, in pure Python.
+
+Logos come as JPEGs of 120x60 pixels. Alfred decodes every icon of a
+result list when it shows it, so each logo is scaled once, after it is
+downloaded, to fit a SIZE pixel square, centered on a transparent
+background and saved as a PNG.
+
+Baseline JPEG, PNG and GIF images are decoded here, with only the
+standard library, so thumbnails are made wherever the logos are
+downloaded. Images in other formats, like progressive JPEGs or
+interlaced PNGs, raise `UnsupportedImage` and are shown as they are.
+"""
+
+import math
+import struct
+import zlib
+from workflow.util import atomic_writer
+
+# Alfred shows result icons at 32 points, which is 64 pixels on Retina
+# displays
+SIZE = 64
+
+# Most pixels of an image decoded here; logos are 7200, and the header
+# of a corrupt file can claim billions
+MAX_PIXELS = 1024 * 1024
+
+class UnsupportedImage(ValueError):
+    """The image is in a format that can't be decoded here."""
+
+def check_size(width, height):
+    """Raise UnsupportedImage unless an image of `width` by `height` pixels can be decoded here."""
+    if width * height > MAX_PIXELS:
+        raise UnsupportedImage(f'{width}x{height} image is too large')
+
+def decode(data):
+    """Decode a JPEG, PNG or GIF image.
+
+    Returns `(width, height, pixels)`, the pixels as RGBA bytes, row by
+    row."""
+    if data[:2] == b'\xff\xd8':
+        return decode_jpeg(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return decode_png(data)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return decode_gif(data)
+    raise UnsupportedImage('not a JPEG, PNG or GIF image')
+
+# JPEG
+
+# Position in the block of each coefficient, in the order they are coded
+ZIGZAG = (
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+)
+
+# IDCT_COS[x][u] is the weight of frequency u at sample x
+IDCT_COS = [[(math.sqrt(0.5) if u == 0 else 1.0) * math.cos((2 * x + 1) * u * math.pi / 16) / 2
+             for u in range(8)] for x in range(8)]
+
+# Lookup tables of the Huffman tables seen so far; most JPEGs use the
+# same few
+_huffman_tables = {}
+
+def huffman_table(counts, symbols):
+    """Get a table of `(code length, symbol)` by the next 16 bits of data."""
+    key = bytes(counts) + bytes(symbols)
+    table = _huffman_tables.get(key)
+    if table is None:
+        table = [(16, 0)] * 65536
+        code = 0
+        i = 0
+        for length in range(1, 17):
+            for _ in range(counts[length - 1]):
+                start = code << (16 - length)
+                end = (code + 1) << (16 - length)
+                table[start:end] = [(length, symbols[i])] * (end - start)
+                code += 1
+                i += 1
+            code <<= 1
+        _huffman_tables[key] = table
+    return table
+
+class BitReader:
+    """Read the entropy-coded data between two restart markers."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.bits = 0
+
+    def fill(self):
+        """Have at least 16 bits ready, padding the end of the data with ones."""
+        data = self.data
+        acc = self.acc & ((1 << self.bits) - 1)
+        while self.bits < 16:
+            acc = (acc << 8) | (data[self.pos] if self.pos < len(data) else 0xFF)
+            self.pos += 1
+            self.bits += 8
+        self.acc = acc
+
+    def symbol(self, table):
+        if self.bits < 16:
+            self.fill()
+        length, value = table[(self.acc >> (self.bits - 16)) & 0xFFFF]
+        self.bits -= length
+        return value
+
+    def receive(self, size):
+        """Read a `size` bit coefficient."""
+        if self.bits < size:
+            self.fill()
+        self.bits -= size
+        value = (self.acc >> self.bits) & ((1 << size) - 1)
+        if value < 1 << (size - 1):
+            value -= (1 << size) - 1
+        return value
+
+def scan_segments(data, pos):
+    """Split the entropy-coded data from `pos` at its restart markers.
+
+    Returns the segments, with stuffed bytes removed, and the position
+    of the marker that ends the scan."""
+    segments = []
+    segment = bytearray()
+    while True:
+        end = data.find(b'\xff', pos)
+        if end < 0 or end + 1 >= len(data):
+            raise ValueError('JPEG data ends in a scan')
+        segment += data[pos:end]
+        marker = data[end + 1]
+        if marker == 0:
+            segment.append(0xFF)
+            pos = end + 2
+        elif marker == 0xFF:
+            pos = end + 1
+        elif 0xD0 <= marker <= 0xD7:
+            segments.append(segment)
+            segment = bytearray()
+            pos = end + 2
+        else:
+            segments.append(segment)
+            return segments, end
+
+def idct_block(coefs, quant, out, offset, stride):
+    """Dequantize and inverse transform the zigzag ordered `coefs` into `out`."""
+    block = [0] * 64
+    for k, coef in enumerate(coefs):
+        if coef:
+            block[ZIGZAG[k]] = coef * quant[k]
+    # rows first, skipping the ones without any coefficient
+    rows = []
+    for v in range(8):
+        row = block[v * 8:v * 8 + 8]
+        if any(row[1:]):
+            rows.append((v, [sum(c * f for c, f in zip(cos, row)) for cos in IDCT_COS]))
+        elif row[0]:
+            rows.append((v, [row[0] * IDCT_COS[0][0]] * 8))
+    for y in range(8):
+        cos = IDCT_COS[y]
+        base = offset + y * stride
+        samples = [128.0] * 8
+        for v, row in rows:
+            weight = cos[v]
+            samples = [s + weight * r for s, r in zip(samples, row)]
+        out[base:base + 8] = bytes(0 if s < 0 else 255 if s > 255 else int(s + 0.5) for s in samples)
+
+def decode_jpeg(data):
+    quant = {}
+    dc_tables = {}
+    ac_tables = {}
+    components = None
+    width = height = 0
+    restart_interval = 0
+    adobe_transform = None
+    pos = 2
+    while pos < len(data):
+        if data[pos] != 0xFF:
+            raise ValueError('bad JPEG marker')
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            break
+        if 0xD0 <= marker <= 0xD8 or marker == 0x01:
+            pos += 2
+            continue
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+        segment = data[pos + 4:pos + 2 + length]
+        pos += 2 + length
+        if marker == 0xDB:
+            i = 0
+            while i < len(segment):
+                precision, table_id = segment[i] >> 4, segment[i] & 15
+                if precision:
+                    quant[table_id] = struct.unpack_from('>64H', segment, i + 1)
+                    i += 129
+                else:
+                    quant[table_id] = tuple(segment[i + 1:i + 65])
+                    i += 65
+        elif marker == 0xC4:
+            i = 0
+            while i < len(segment):
+                table_class, table_id = segment[i] >> 4, segment[i] & 15
+                counts = segment[i + 1:i + 17]
+                symbols = segment[i + 17:i + 17 + sum(counts)]
+                (ac_tables if table_class else dc_tables)[table_id] = huffman_table(counts, symbols)
+                i += 17 + sum(counts)
+        elif marker in (0xC0, 0xC1):
+            if segment[0] != 8:
+                raise UnsupportedImage('JPEG with 12 bit samples')
+            height, width, count = struct.unpack_from('>HHB', segment, 1)
+            check_size(width, height)
+            components = []
+            for i in range(count):
+                component_id, sampling, table_id = segment[6 + 3 * i:9 + 3 * i]
+                h, v = sampling >> 4, sampling & 15
+                if not (1 <= h <= 4 and 1 <= v <= 4):
+                    raise UnsupportedImage(f'JPEG sampling factors {h}x{v}')
+                components.append({'id': component_id, 'h': h, 'v': v, 'quant': table_id})
+        elif 0xC2 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            raise UnsupportedImage('progressive or lossless JPEG')
+        elif marker == 0xDD:
+            restart_interval = struct.unpack_from('>H', segment)[0]
+        elif marker == 0xEE and segment[:5] == b'Adobe':
+            adobe_transform = segment[11]
+        elif marker == 0xDA:
+            if components is None:
+                raise ValueError('JPEG scan before its frame')
+            if not width or not height:
+                raise UnsupportedImage('JPEG without its height')
+            if len(components) not in (1, 3):
+                raise UnsupportedImage('CMYK JPEG')
+            by_id = {component['id']: component for component in components}
+            scan = []
+            for i in range(segment[0]):
+                component = by_id[segment[1 + 2 * i]]
+                tables = segment[2 + 2 * i]
+                scan.append((component, dc_tables[tables >> 4], ac_tables[tables & 15]))
+            segments, pos = scan_segments(data, pos)
+            decode_scan(scan, components, width, height, quant, restart_interval, segments)
+    if components is None or 'plane' not in components[0]:
+        raise ValueError('JPEG without image data')
+    return width, height, jpeg_rgba(components, width, height, adobe_transform)
+
+def component_layout(components, width, height):
+    """Set the size of the sample plane of every component, padded to whole MCUs."""
+    h_max = max(component['h'] for component in components)
+    v_max = max(component['v'] for component in components)
+    mcus_x = -(-width // (8 * h_max))
+    mcus_y = -(-height // (8 * v_max))
+    for component in components:
+        if 'plane' not in component:
+            component['stride'] = mcus_x * component['h'] * 8
+            component['rows'] = mcus_y * component['v'] * 8
+            component['plane'] = bytearray(component['stride'] * component['rows'])
+            # blocks with samples of the image, for non-interleaved scans
+            component['blocks_x'] = -(-(-(-width * component['h'] // h_max)) // 8)
+            component['blocks_y'] = -(-(-(-height * component['v'] // v_max)) // 8)
+    return h_max, v_max, mcus_x, mcus_y
+
+def decode_scan(scan, components, width, height, quant, restart_interval, segments):
+    _, _, mcus_x, mcus_y = component_layout(components, width, height)
+    if len(scan) == 1:
+        # one block per MCU, over the blocks of the component alone
+        component = scan[0][0]
+        blocks = [(bx, by) for by in range(component['blocks_y']) for bx in range(component['blocks_x'])]
+        mcus = [[(0, bx, by)] for bx, by in blocks]
+    else:
+        mcus = [[(i, mx * component['h'] + bx, my * component['v'] + by)
+                 for i, (component, _, _) in enumerate(scan)
+                 for by in range(component['v']) for bx in range(component['h'])]
+                for my in range(mcus_y) for mx in range(mcus_x)]
+    interval = restart_interval or len(mcus)
+    for start in range(0, len(mcus), interval):
+        segment = start // interval
+        if segment >= len(segments):
+            break
+        bits = BitReader(segments[segment])
+        predictions = [0] * len(scan)
+        for mcu in mcus[start:start + interval]:
+            for i, bx, by in mcu:
+                component, dc_table, ac_table = scan[i]
+                coefs = [0] * 64
+                size = bits.symbol(dc_table)
+                predictions[i] += bits.receive(size) if size else 0
+                coefs[0] = predictions[i]
+                k = 1
+                while k < 64:
+                    run_size = bits.symbol(ac_table)
+                    size = run_size & 15
+                    if not size:
+                        if run_size != 0xF0:
+                            break
+                        k += 16
+                        continue
+                    k += run_size >> 4
+                    if k > 63:
+                        break
+                    coefs[k] = bits.receive(size)
+                    k += 1
+                stride = component['stride']
+                idct_block(coefs, quant[component['quant']], component['plane'], by * 8 * stride + bx * 8, stride)
+
+def jpeg_rgba(components, width, height, adobe_transform):
+    """Convert the sample planes of a decoded JPEG to RGBA pixels."""
+    h_max = max(component['h'] for component in components)
+    v_max = max(component['v'] for component in components)
+    planes = []
+    for component in components:
+        # repeat subsampled samples to fill the whole image
+        sx = h_max // component['h']
+        sy = v_max // component['v']
+        stride = component['stride']
+        plane = component['plane']
+        columns = [x // sx for x in range(width)]
+        rows = []
+        for y in range(height):
+            start = (y // sy) * stride
+            row = plane[start:start + stride]
+            rows.append(row[:width] if sx == 1 else bytes(row[x] for x in columns))
+        planes.append(rows)
+    pixels = bytearray(width * height * 4)
+    i = 0
+    if len(planes) == 1:
+        for row in planes[0]:
+            for luma in row:
+                pixels[i:i + 4] = bytes((luma, luma, luma, 255))
+                i += 4
+        return pixels
+    rgb = adobe_transform == 0 and [component['id'] for component in components] != [1, 2, 3]
+    for y in range(height):
+        for a, b, c in zip(planes[0][y], planes[1][y], planes[2][y]):
+            if rgb:
+                red, green, blue = a, b, c
+            else:
+                cb = b - 128
+                cr = c - 128
+                red = a + 1.402 * cr
+                green = a - 0.344136 * cb - 0.714136 * cr
+                blue = a + 1.772 * cb
+            pixels[i] = 0 if red < 0 else 255 if red > 255 else int(red + 0.5)
+            pixels[i + 1] = 0 if green < 0 else 255 if green > 255 else int(green + 0.5)
+            pixels[i + 2] = 0 if blue < 0 else 255 if blue > 255 else int(blue + 0.5)
+            pixels[i + 3] = 255
+            i += 4
+    return pixels
+
+# PNG
+
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def png_chunks(data):
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack_from('>I4s', data, pos)
+        yield kind, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+def unfilter(raw, stride, height, step):
+    """Undo the PNG filter of every row."""
+    out = bytearray(stride * height)
+    prior = bytearray(stride)
+    pos = 0
+    for y in range(height):
+        kind = raw[pos]
+        row = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if kind == 1:
+            for i in range(step, stride):
+                row[i] = (row[i] + row[i - step]) & 0xFF
+        elif kind == 2:
+            row = bytearray((a + b) & 0xFF for a, b in zip(row, prior))
+        elif kind == 3:
+            for i in range(stride):
+                left = row[i - step] if i >= step else 0
+                row[i] = (row[i] + ((left + prior[i]) >> 1)) & 0xFF
+        elif kind == 4:
+            for i in range(stride):
+                left = row[i - step] if i >= step else 0
+                up = prior[i]
+                up_left = prior[i - step] if i >= step else 0
+                estimate = left + up - up_left
+                dl = abs(estimate - left)
+                du = abs(estimate - up)
+                dul = abs(estimate - up_left)
+                if dl <= du and dl <= dul:
+                    predictor = left
+                elif du <= dul:
+                    predictor = up
+                else:
+                    predictor = up_left
+                row[i] = (row[i] + predictor) & 0xFF
+        elif kind:
+            raise ValueError(f'bad PNG filter {kind}')
+        out[y * stride:(y + 1) * stride] = row
+        prior = row
+    return out
+
+def decode_png(data):
+    header = None
+    palette = b''
+    transparency = None
+    compressed = []
+    for kind, body in png_chunks(data):
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == b'PLTE':
+            palette = body
+        elif kind == b'tRNS':
+            transparency = body
+        elif kind == b'IDAT':
+            compressed.append(body)
+        elif kind == b'IEND':
+            break
+    if header is None:
+        raise ValueError('PNG without header')
+    width, height, depth, color, _, _, interlace = header
+    if interlace:
+        raise UnsupportedImage('interlaced PNG')
+    if color not in PNG_CHANNELS:
+        raise ValueError(f'bad PNG color type {color}')
+    if depth not in (1, 2, 4, 8, 16):
+        raise ValueError(f'bad PNG bit depth {depth}')
+    check_size(width, height)
+    channels = PNG_CHANNELS[color]
+    stride = -(-width * channels * depth // 8)
+    # inflate no more than the rows of the header
+    raw = zlib.decompressobj().decompress(b''.join(compressed), (stride + 1) * height)
+    raw = unfilter(raw, stride, height, max(1, channels * depth // 8))
+
+    # the color of a gray or RGB image that is transparent, in samples
+    key = None
+    if transparency and color in (0, 2):
+        key = struct.unpack_from(f'>{channels}H', transparency)
+    # samples are scaled to 8 bits after the transparent color is found
+    mask = (1 << depth) - 1
+    levels = bytes(sample * 255 // mask for sample in range(mask + 1)) if depth < 8 else None
+
+    pixels = bytearray(width * height * 4)
+    i = 0
+    for y in range(height):
+        row = raw[y * stride:(y + 1) * stride]
+        if depth == 16:
+            samples = struct.unpack_from(f'>{width * channels}H', row)
+        elif depth < 8:
+            per_byte = 8 // depth
+            samples = [(byte >> (8 - depth * (k + 1))) & mask for byte in row for k in range(per_byte)]
+        else:
+            samples = row
+        for x in range(width):
+            pixel = samples[x * channels:(x + 1) * channels]
+            if color == 3:
+                index = pixel[0]
+                alpha = transparency[index] if transparency and index < len(transparency) else 255
+                pixels[i:i + 4] = palette[index * 3:index * 3 + 3] + bytes((alpha,))
+                i += 4
+                continue
+            alpha = 0 if key is not None and tuple(pixel) == key else 255
+            if depth == 16:
+                pixel = [sample >> 8 for sample in pixel]
+            elif depth < 8:
+                pixel = [levels[sample] for sample in pixel]
+            if color == 0:
+                pixels[i:i + 4] = bytes((pixel[0], pixel[0], pixel[0], alpha))
+            elif color == 2:
+                pixels[i:i + 4] = bytes((pixel[0], pixel[1], pixel[2], alpha))
+            elif color == 4:
+                pixels[i:i + 4] = bytes((pixel[0], pixel[0], pixel[0], pixel[1]))
+            else:
+                pixels[i:i + 4] = bytes(pixel)
+            i += 4
+    return width, height, pixels
+
+def encode_png(width, height, pixels):
+    """Encode RGBA pixels as a PNG."""
+    stride = width * 4
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0)
+        raw += pixels[y * stride:(y + 1) * stride]
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 9))
+            + chunk(b'IEND', b''))
+
+# GIF
+
+def gif_blocks(data, pos):
+    """Join the data sub-blocks at `pos`. Returns the data and the position after them."""
+    out = bytearray()
+    while True:
+        size = data[pos]
+        pos += 1
+        if not size:
+            return out, pos
+        out += data[pos:pos + size]
+        pos += size
+
+def lzw_decode(data, min_size, count):
+    """Decode the GIF LZW `data` to `count` color indices."""
+    clear = 1 << min_size
+    end = clear + 1
+    size = min_size + 1
+    table = [bytes((i,)) for i in range(clear)] + [b'', b'']
+    out = bytearray()
+    previous = None
+    acc = 0
+    bits = 0
+    for byte in data:
+        acc |= byte << bits
+        bits += 8
+        while bits >= size:
+            code = acc & ((1 << size) - 1)
+            acc >>= size
+            bits -= size
+            if code == clear:
+                size = min_size + 1
+                del table[clear + 2:]
+                previous = None
+                continue
+            if code == end:
+                return out[:count]
+            if previous is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                table.append(previous + entry[:1])
+            elif code == len(table):
+                entry = previous + previous[:1]
+                table.append(entry)
+            else:
+                raise ValueError('bad GIF code')
+            out += entry
+            previous = entry
+            if len(table) == 1 << size and size < 12:
+                size += 1
+    return out[:count]
+
+def decode_gif(data):
+    """Decode the first frame of a GIF."""
+    width, height, flags = struct.unpack_from('<HHB', data, 6)
+    check_size(width, height)
+    pos = 13
+    colors = b''
+    if flags & 0x80:
+        colors = data[pos:pos + 3 * (2 << (flags & 7))]
+        pos += len(colors)
+    transparent = None
+    while pos < len(data):
+        kind = data[pos]
+        if kind == 0x21:
+            label = data[pos + 1]
+            body, pos = gif_blocks(data, pos + 2)
+            if label == 0xF9 and len(body) >= 4 and body[0] & 1:
+                transparent = body[3]
+        elif kind == 0x2C:
+            left, top, frame_width, frame_height, frame_flags = struct.unpack_from('<HHHHB', data, pos + 1)
+            pos += 10
+            if frame_flags & 0x80:
+                colors = data[pos:pos + 3 * (2 << (frame_flags & 7))]
+                pos += 3 * (2 << (frame_flags & 7))
+            min_size = data[pos]
+            if not 1 <= min_size <= 8:
+                raise ValueError(f'bad GIF code size {min_size}')
+            check_size(frame_width, frame_height)
+            body, pos = gif_blocks(data, pos + 1)
+            indices = lzw_decode(body, min_size, frame_width * frame_height)
+            rows = list(range(frame_height))
+            if frame_flags & 0x40:
+                rows = (list(range(0, frame_height, 8)) + list(range(4, frame_height, 8))
+                        + list(range(2, frame_height, 4)) + list(range(1, frame_height, 2)))
+            pixels = bytearray(width * height * 4)
+            for i, y in enumerate(rows):
+                if top + y >= height:
+                    continue
+                for x in range(min(frame_width, width - left)):
+                    if i * frame_width + x >= len(indices):
+                        break
+                    index = indices[i * frame_width + x]
+                    if index == transparent or index * 3 + 3 > len(colors):
+                        continue
+                    at = ((top + y) * width + left + x) * 4
+                    pixels[at:at + 4] = colors[index * 3:index * 3 + 3] + b'\xff'
+            return width, height, pixels
+        elif kind == 0x3B:
+            break
+        else:
+            raise ValueError('bad GIF block')
+    raise ValueError('GIF without image')
+
+# Scaling
+
+def weights(source, target):
+    """Get the source pixels covered by each target pixel, with how much of each."""
+    scale = source / target
+    result = []
+    for i in range(target):
+        start = i * scale
+        end = start + scale
+        covered = []
+        for j in range(int(start), min(source, math.ceil(end))):
+            overlap = min(end, j + 1) - max(start, j)
+            if overlap > 0:
+                covered.append((j, overlap / scale))
+        result.append(covered)
+    return result
+
+def scale(width, height, pixels, target_width, target_height):
+    """Scale RGBA pixels down by averaging the area each target pixel covers."""
+    # premultiply, so transparent pixels don't bleed their color
+    premultiplied = []
+    for i in range(0, len(pixels), 4):
+        alpha = pixels[i + 3]
+        premultiplied.append((pixels[i] * alpha, pixels[i + 1] * alpha, pixels[i + 2] * alpha, alpha))
+    columns = weights(width, target_width)
+    rows = []
+    for y in range(height):
+        row = premultiplied[y * width:(y + 1) * width]
+        scaled = []
+        for covered in columns:
+            r = g = b = a = 0.0
+            for x, weight in covered:
+                pr, pg, pb, pa = row[x]
+                r += pr * weight
+                g += pg * weight
+                b += pb * weight
+                a += pa * weight
+            scaled.append((r, g, b, a))
+        rows.append(scaled)
+    out = bytearray(target_width * target_height * 4)
+    i = 0
+    for covered in weights(height, target_height):
+        for x in range(target_width):
+            r = g = b = a = 0.0
+            for y, weight in covered:
+                pr, pg, pb, pa = rows[y][x]
+                r += pr * weight
+                g += pg * weight
+                b += pb * weight
+                a += pa * weight
+            if a > 0:
+                out[i] = min(255, int(r / a + 0.5))
+                out[i + 1] = min(255, int(g / a + 0.5))
+                out[i + 2] = min(255, int(b / a + 0.5))
+                out[i + 3] = min(255, int(a + 0.5))
+            i += 4
+    return out
+
+def square(width, height, pixels, size=SIZE):
+    """Scale an image to fit a `size` pixel square and center it on a transparent one.
+
+    Images smaller than the square keep their size."""
+    ratio = min(1.0, size / width, size / height)
+    target_width = max(1, round(width * ratio))
+    target_height = max(1, round(height * ratio))
+    if (target_width, target_height) != (width, height):
+        pixels = scale(width, height, pixels, target_width, target_height)
+    out = bytearray(size * size * 4)
+    left = (size - target_width) // 2
+    top = (size - target_height) // 2
+    for y in range(target_height):
+        start = ((top + y) * size + left) * 4
+        out[start:start + target_width * 4] = pixels[y * target_width * 4:(y + 1) * target_width * 4]
+    return out
+
+def make_thumbnail(source, target, size=SIZE):
+    """Save the thumbnail of the image file `source` as the PNG `target`.
+
+    Returns False, and writes nothing, if the image can't be decoded."""
+    with open(source, 'rb') as f:
+        data = f.read()
+    try:
+        width, height, pixels = decode(data)
+    except (ValueError, IndexError, KeyError, struct.error, zlib.error):
+        return False
+    if not width or not height:
+        return False
+    with atomic_writer(target, 'wb') as f:
+        f.write(encode_png(size, size, square(width, height, pixels, size)))
+    return True
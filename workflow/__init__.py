@@ -4,7 +4,7 @@
 import os
 
 # Workflow objects
-from .workflow import Workflow, manager, Variables
+from .workflow import Workflow, manager, Variables, SearchKey
 
 # Exceptions
 from .workflow import PasswordNotFound, KeychainError
@@ -41,6 +41,7 @@ from .workflow import (
     MATCH_ALLCHARS,
     MATCH_ATOM,
     MATCH_CAPITALS,
+    MATCH_FUZZY,
     MATCH_INITIALS,
     MATCH_INITIALS_CONTAIN,
     MATCH_INITIALS_STARTSWITH,
@@ -61,6 +62,7 @@ __all__ = [
     "Variables",
     "Workflow",
     "manager",
+    "SearchKey",
     "PasswordNotFound",
     "KeychainError",
     "ICON_ACCOUNT",
@@ -89,6 +91,7 @@ __all__ = [
     "MATCH_ALLCHARS",
     "MATCH_ATOM",
     "MATCH_CAPITALS",
+    "MATCH_FUZZY",
     "MATCH_INITIALS",
     "MATCH_INITIALS_CONTAIN",
     "MATCH_INITIALS_STARTSWITH",
@@ -0,0 +1,633 @@
+"""Asynchronous counterpart of :mod:`workflow.web` on :mod:`asyncio` streams.
+
+Requests are made with the same arguments as :func:`workflow.web.request`,
+but are awaited, so many of them can run at once in one event loop::
+
+    async def fetch(urls):
+        semaphore = asyncio.Semaphore(8)
+        async with Session() as session:
+
+            async def get(url):
+                async with semaphore:
+                    r = await session.get(url)
+                    return await r.content()
+
+            return await asyncio.gather(*(get(url) for url in urls))
+
+The body of a :class:`Response` is read with the coroutines
+:meth:`~Response.content`, :meth:`~Response.text` and
+:meth:`~Response.json`, or streamed with ``async for`` over
+:meth:`~Response.iter_content`. Requests go straight to the server:
+proxies aren't supported.
+"""
+
+import asyncio
+import codecs
+import http.client
+import json
+import os
+import ssl
+import unicodedata
+import urllib.error
+import urllib.parse
+import zlib
+
+from .util import atomic_writer
+from .web import REDIRECT_CODES, RESPONSES, CaseInsensitiveDictionary, _build_request
+
+# Bytes read from a connection at a time
+CHUNK_SIZE = 64 * 1024
+
+# Longest status or header line accepted
+MAX_LINE = 64 * 1024
+
+
+class Response:
+    """
+    Returned by :func:`request` / :func:`get` and :class:`Session`.
+
+    Like :class:`workflow.web.Response`, except that reading the body is
+    awaited.
+
+    >>> r = await get('http://www.google.com')
+    >>> r.status_code  # int
+    200
+    >>> await r.content()  # bytes
+    <html> ...
+    >>> await r.text()  # str
+    <html> ...
+
+    """
+
+    def __init__(self, url, status_code, headers, body, stream=False):
+        """Create a new :class:`Response`.
+
+        :param url: URL of the response, after any redirects
+        :type url: str
+        :param status_code: HTTP status
+        :type status_code: int
+        :param headers: Response headers
+        :type headers: :class:`~workflow.web.CaseInsensitiveDictionary`
+        :param body: Function returning an async iterator over the raw
+            body in chunks of at most the size it is passed
+        :type body: callable
+        :param stream: Whether the body is streamed
+        :type stream: bool
+
+        """
+        self.url = url
+        self.status_code = status_code
+        self.reason = RESPONSES.get(status_code)
+        self.headers = headers
+        self.mimetype = headers.get("content-type")
+        self.error = None
+        self._body = body
+        self._stream = stream
+        self._encoding = None
+        self._content = None
+        self._content_loaded = False
+        self._gzipped = "gzip" in headers.get("content-encoding", "")
+        # Bytes of the body received, before decompression
+        self._received = 0
+
+        if not 200 <= status_code < 300:
+            message = http.client.HTTPMessage()
+            for key, value in headers.items():
+                message[key] = value
+
+            self.error = urllib.error.HTTPError(url, status_code, self.reason, message, None)
+
+    @property
+    def stream(self):
+        """Whether response is streamed.
+
+        Returns:
+            bool: `True` if response is streamed.
+
+        """
+        return self._stream
+
+    @stream.setter
+    def stream(self, value):
+        if self._content_loaded:
+            raise RuntimeError("`content` has already been read from this Response.")
+
+        self._stream = value
+
+    @property
+    def encoding(self):
+        """Text encoding of document or ``None``.
+
+        Taken from the ``Content-Type`` header, defaulting to UTF-8 for
+        JSON and XML.
+
+        :returns: Text encoding if found.
+        :rtype: str or ``None``
+
+        """
+        if not self._encoding:
+            mimetype, _, params = (self.mimetype or "").partition(";")
+            for param in params.split(";"):
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "charset":
+                    self._encoding = value.strip().strip("\"'").lower()
+
+            if not self._encoding and mimetype.strip() in ("application/json", "application/xml"):
+                self._encoding = "utf-8"
+
+        return self._encoding
+
+    async def content(self):
+        """Read the whole body of the response.
+
+        :returns: Body of HTTP response
+        :rtype: bytes
+
+        """
+        if not self._content_loaded:
+            chunks = []
+            async for chunk in self._chunks(CHUNK_SIZE):
+                chunks.append(chunk)
+
+            self._content = b"".join(chunks)
+            self._content_loaded = True
+
+        return self._content
+
+    async def text(self):
+        """Read the body of the response as unicode.
+
+        If no encoding can be determined from the HTTP headers, the
+        encoded response body will be returned instead.
+
+        :returns: Body of HTTP response
+        :rtype: str or bytes
+
+        """
+        content = await self.content()
+        if self.encoding:
+            return unicodedata.normalize("NFC", str(content, self.encoding))
+
+        return content
+
+    async def json(self):
+        """Read the body of the response and decode it as JSON.
+
+        :returns: object decoded from JSON
+        :rtype: list, dict or str
+
+        """
+        return json.loads(await self.content())
+
+    def iter_content(self, chunk_size=4096, decode_unicode=False):
+        """Iterate over response data with ``async for``.
+
+        :param chunk_size: Number of bytes to read into memory
+        :type chunk_size: int
+        :param decode_unicode: Decode to Unicode using detected encoding
+        :type decode_unicode: bool
+        :returns: async iterator
+
+        """
+        if not self.stream:
+            raise RuntimeError(
+                "You cannot call `iter_content` on a Response unless you passed `stream=True` to `get()`/`request()`."
+            )
+
+        if self._content_loaded:
+            raise RuntimeError("`content` has already been read from this Response.")
+
+        chunks = self._chunks(chunk_size)
+
+        if decode_unicode and self.encoding:
+            return self._decode(chunks)
+
+        return chunks
+
+    async def save_to_path(self, filepath):
+        """Save retrieved data to file at ``filepath``.
+
+        The data is streamed to a temporary file, which only replaces
+        ``filepath`` once the whole body has been received.
+
+        :param filepath: Path to save retrieved data.
+        :raises: :class:`http.client.IncompleteRead` if the body is
+            shorter or longer than its ``Content-Length``
+
+        """
+        filepath = os.path.abspath(filepath)
+        dirname = os.path.dirname(filepath)
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.stream = True
+        expected = self.headers.get("content-length")
+
+        with atomic_writer(filepath, "wb") as fileobj:
+            async for data in self.iter_content(CHUNK_SIZE):
+                fileobj.write(data)
+
+            # the length is that of the body as sent, compressed or not
+            if expected is not None and self._received != int(expected):
+                raise http.client.IncompleteRead(b"", int(expected) - self._received)
+
+    def raise_for_status(self):
+        """Raise stored error if one occurred.
+
+        error will be instance of :class:`urllib.error.HTTPError`
+        """
+        if self.error is not None:
+            raise self.error
+
+    async def _chunks(self, chunk_size):
+        """Iterate over the body, decompressed if need be."""
+        self._content_loaded = True
+        self._received = 0
+
+        if self._gzipped:
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        async for chunk in self._body(chunk_size):
+            self._received += len(chunk)
+            if self._gzipped:
+                chunk = decoder.decompress(chunk)
+
+            if chunk:
+                yield chunk
+
+        if self._gzipped:
+            chunk = decoder.flush()
+            if chunk:
+                yield chunk
+
+    async def _decode(self, chunks):
+        dec = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+
+        async for chunk in chunks:
+            data = dec.decode(chunk)
+
+            if data:
+                yield data
+
+        data = dec.decode(b"", final=True)
+
+        if data:
+            yield data
+
+
+class Session:
+    """Make requests over kept-alive connections pooled per host.
+
+    A connection is returned to the pool once the body of its response
+    has been read to the end, and the next request to the same host
+    reuses it. A session belongs to the event loop it is used in, and
+    its requests can run concurrently: each one has a connection of its
+    own while it runs. Bound how many run at once with a semaphore.
+
+    Timeouts apply to connecting and to every read of a request.
+
+    """
+
+    def __init__(self, max_connections=10, max_redirects=5):
+        """Create a new :class:`Session`.
+
+        :param max_connections: Idle connections kept per host
+        :type max_connections: int
+        :param max_redirects: Redirects followed per request
+        :type max_redirects: int
+
+        """
+        self.max_connections = max_connections
+        self.max_redirects = max_redirects
+        # (scheme, netloc) -> [(reader, writer), ...]
+        self._connections = {}
+        self._ssl = None
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the pooled connections.
+
+        Connections of responses still being read are closed once
+        they have been read."""
+        self._closed = True
+        connections, self._connections = self._connections, {}
+
+        for pool in connections.values():
+            for _, writer in pool:
+                writer.close()
+
+    async def request(
+        self,
+        method,
+        url,
+        params=None,
+        data=None,
+        json_data=None,
+        headers=None,
+        files=None,
+        timeout=60,
+        allow_redirects=True,
+        stream=False,
+    ):
+        """Initiate an HTTP(S) request. Returns :class:`Response` object.
+
+        Arguments as for :func:`workflow.web.request`, except `auth`.
+        Without `stream`, the body has been read when this returns.
+
+        :returns: Response object
+        :rtype: :class:`Response`
+
+        """
+        req = _build_request(method, url, params, data, json_data, headers, files)
+        method = req.get_method()
+        url = req.full_url
+        data = req.data
+        headers = dict(req.header_items())
+        if data and "Content-type" not in headers:
+            headers["Content-type"] = "application/x-www-form-urlencoded"
+
+        for _ in range(self.max_redirects + 1):
+            response = await self._send(method, url, data, headers, timeout, stream)
+            location = response.headers.get("location")
+            if not allow_redirects or response.status_code not in REDIRECT_CODES or not location:
+                break
+
+            # read the body to free the connection for the next request
+            await response.content()
+            url = urllib.parse.urljoin(url, location)
+            if response.status_code == 303 or (
+                response.status_code in (301, 302) and method not in ("GET", "HEAD")
+            ):
+                method = "GET"
+                data = None
+                headers = {
+                    k: v for k, v in headers.items()
+                    if k.lower() not in ("content-type", "content-length")
+                }
+        else:
+            response.error = urllib.error.HTTPError(
+                url, response.status_code, "Too many redirects", response.error.hdrs, None
+            )
+
+        if not stream:
+            await response.content()
+
+        return response
+
+    async def get(
+        self,
+        url,
+        params=None,
+        headers=None,
+        timeout=60,
+        allow_redirects=True,
+        stream=False,
+    ):
+        """Initiate a GET request. Arguments as for :meth:`request`.
+
+        :returns: :class:`Response` instance
+
+        """
+        return await self.request(
+            "GET",
+            url,
+            params,
+            headers=headers,
+            timeout=timeout,
+            allow_redirects=allow_redirects,
+            stream=stream,
+        )
+
+    async def _send(self, method, url, data, headers, timeout, stream):
+        """Send one request over a pooled connection and get its response."""
+        scheme, netloc, path, query, _ = urllib.parse.urlsplit(url)
+        key = (scheme, netloc)
+        target = urllib.parse.urlunsplit(("", "", path or "/", query, ""))
+
+        lines = [f"{method} {target} HTTP/1.1"]
+        names = {name.lower() for name in headers}
+        if "host" not in names:
+            lines.append(f"Host: {netloc}")
+
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        if data is not None and "content-length" not in names:
+            lines.append(f"Content-Length: {len(data)}")
+
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        while True:
+            (reader, writer), reused = await self._checkout(key, timeout)
+            try:
+                writer.write(head)
+                if data is not None:
+                    writer.write(data)
+
+                await asyncio.wait_for(writer.drain(), timeout)
+                version, status, response_headers = await self._read_head(reader, timeout)
+            except (ConnectionError, http.client.BadStatusLine):
+                writer.close()
+                # the server closed the idle connection, so try another
+                if reused:
+                    continue
+
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            break
+
+        keep_alive = version == "HTTP/1.1" and (
+            response_headers.get("connection", "").lower() != "close"
+        )
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            length = 0
+        elif "chunked" in response_headers.get("transfer-encoding", "").lower():
+            length = None
+        elif "content-length" in response_headers:
+            length = int(response_headers["content-length"])
+        else:  # the body ends when the server closes the connection
+            length = -1
+            keep_alive = False
+
+        def body(chunk_size):
+            return self._read_body(key, reader, writer, length, keep_alive, chunk_size, timeout)
+
+        return Response(url, status, response_headers, body, stream)
+
+    async def _read_head(self, reader, timeout):
+        """Read the status line and headers of a response."""
+        while True:
+            line = await self._read_line(reader, timeout)
+            if not line:
+                raise http.client.RemoteDisconnected(
+                    "Remote end closed connection without response"
+                )
+
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+                raise http.client.BadStatusLine(line)
+
+            version, status = parts[0], int(parts[1])
+            headers = CaseInsensitiveDictionary()
+            while True:
+                line = await self._read_line(reader, timeout)
+                if not line:
+                    break
+
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            # skip informational responses like 100 Continue
+            if status >= 200 or status == 101:
+                return version, status, headers
+
+    async def _read_line(self, reader, timeout):
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if len(line) > MAX_LINE:
+            raise http.client.LineTooLong("header line")
+
+        return line.decode("latin-1").rstrip("\r\n")
+
+    async def _read_body(self, key, reader, writer, length, keep_alive, chunk_size, timeout):
+        """Iterate over the raw body, then pool or close its connection."""
+        done = False
+        try:
+            if length is None:
+                while True:
+                    line = await self._read_line(reader, timeout)
+                    size = int(line.split(";", 1)[0], 16)
+                    if not size:
+                        while await self._read_line(reader, timeout):  # trailers
+                            pass
+
+                        break
+
+                    while size:
+                        chunk = await self._read_exactly(reader, min(size, chunk_size), timeout)
+                        size -= len(chunk)
+                        yield chunk
+
+                    await self._read_line(reader, timeout)
+            elif length >= 0:
+                while length:
+                    chunk = await self._read_exactly(reader, min(length, chunk_size), timeout)
+                    length -= len(chunk)
+                    yield chunk
+            else:
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(chunk_size), timeout)
+                    if not chunk:
+                        break
+
+                    yield chunk
+
+            done = True
+        finally:
+            if done and keep_alive and not self._closed:
+                self._checkin(key, reader, writer)
+            else:
+                writer.close()
+
+    async def _read_exactly(self, reader, size, timeout):
+        try:
+            return await asyncio.wait_for(reader.readexactly(size), timeout)
+        except asyncio.IncompleteReadError as err:
+            raise http.client.IncompleteRead(err.partial, err.expected)
+
+    async def _checkout(self, key, timeout):
+        """Get a connection to `key` and whether it was used before."""
+        pool = self._connections.get(key)
+        while pool:
+            reader, writer = pool.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer), True
+
+            writer.close()
+
+        scheme, netloc = key
+        parts = urllib.parse.urlsplit(f"//{netloc}")
+        if scheme == "https":
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+
+            port = parts.port or 443
+            connect = asyncio.open_connection(parts.hostname, port, ssl=self._ssl, limit=MAX_LINE)
+        else:
+            port = parts.port or 80
+            connect = asyncio.open_connection(parts.hostname, port, limit=MAX_LINE)
+
+        return await asyncio.wait_for(connect, timeout), False
+
+    def _checkin(self, key, reader, writer):
+        pool = self._connections.setdefault(key, [])
+        if len(pool) < self.max_connections:
+            pool.append((reader, writer))
+        else:
+            writer.close()
+
+
+async def request(
+    method,
+    url,
+    params=None,
+    data=None,
+    json_data=None,
+    headers=None,
+    files=None,
+    timeout=60,
+    allow_redirects=False,
+    stream=False,
+):
+    """Initiate an HTTP(S) request on a connection of its own.
+
+    Arguments as for :meth:`Session.request`.
+
+    :returns: Response object
+    :rtype: :class:`Response`
+
+    """
+    async with Session() as session:
+        return await session.request(
+            method,
+            url,
+            params,
+            data,
+            json_data,
+            headers,
+            files,
+            timeout,
+            allow_redirects,
+            stream,
+        )
+
+
+async def get(
+    url,
+    params=None,
+    headers=None,
+    timeout=60,
+    allow_redirects=True,
+    stream=False,
+):
+    """Initiate a GET request. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await request(
+        "GET",
+        url,
+        params,
+        headers=headers,
+        timeout=timeout,
+        allow_redirects=allow_redirects,
+        stream=stream,
+    )
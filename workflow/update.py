@@ -15,12 +15,13 @@ import json
 import os
 import re
 import subprocess
-import tempfile
 from collections import defaultdict
 from functools import total_ordering
 from itertools import zip_longest
 
-from . import Workflow, web
+# `web` and `tempfile` are imported where updates are downloaded, as
+# workflows import this module for `Version` on every run
+from . import Workflow
 
 
 RELEASES_BASE = "https://api.github.com/repos/{}/releases"
@@ -384,6 +385,10 @@ def retrieve_download(dl):
     if not match_workflow(dl.filename):
         raise ValueError(f"attachment not a workflow: {dl.filename}")
 
+    import tempfile
+
+    from . import web
+
     path = os.path.join(tempfile.gettempdir(), dl.filename)
     wf.logger.debug("downloading update from %r to %r ...", dl.url, path)
 
@@ -422,6 +427,8 @@ def get_downloads(repo):
     url = build_api_url(repo)
 
     def _fetch():
+        from . import web
+
         wf.logger.info("retrieving releases for %r ...", repo)
         r = web.get(url)
         r.raise_for_status()
@@ -14,7 +14,7 @@ import sys
 import time
 from collections import namedtuple
 from contextlib import contextmanager
-from threading import Event
+from threading import Event, current_thread, main_thread
 
 
 # JXA scripts to call Alfred's API via the Scripting Bridge
@@ -486,7 +486,9 @@ class LockFile:
 class uninterruptible:  # pylint: disable=invalid-name
     """Decorator that postpones SIGTERM until wrapped function returns.
 
-    .. important:: This decorator is NOT thread-safe.
+    .. important:: This decorator is NOT thread-safe. Only the main
+        thread can set signal handlers, so in other threads the wrapped
+        function is simply called.
 
     As of version 2.7, Alfred allows Script Filters to be killed. If
     your workflow is killed in the middle of critical code (e.g.
@@ -516,6 +518,10 @@ class uninterruptible:  # pylint: disable=invalid-name
 
     def __call__(self, *args, **kwargs):
         """Trap ``SIGTERM`` and call wrapped function."""
+        if current_thread() is not main_thread():
+            self.func(*args, **kwargs)
+            return
+
         self._caught_signal = None
         # Register handler for SIGTERM, then call `self.func`
         self.old_signal_handler = signal.getsignal(signal.SIGTERM)
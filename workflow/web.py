@@ -1,13 +1,18 @@
 """Lightweight HTTP library with a requests-like interface."""
 
+import base64
 import codecs
+import hashlib
+import http.client
+import io
 import json
 import mimetypes
 import os
 import re
 import secrets
-import socket
 import string
+import threading
+import time
 import unicodedata
 import urllib.request
 import urllib.parse
@@ -68,6 +73,9 @@ RESPONSES = {
     505: "HTTP Version Not Supported",
 }
 
+# Responses :class:`Session` follows to the `Location` header
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
 
 class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
     """Prevent redirections."""
@@ -183,12 +191,15 @@ class Response:
 
     """
 
-    def __init__(self, request, stream=False):  # pylint: disable=redefined-outer-name
+    def __init__(self, request, stream=False, opener=None):  # pylint: disable=redefined-outer-name
         """Call `request` with :mod:`urllib` and process results.
 
         :param request: :class:`Request` instance
         :param stream: Whether to stream response or retrieve it all at once
         :type stream: bool
+        :param opener: Function that opens `request` like
+            :func:`urllib.request.urlopen`, which is the default
+        :type opener: callable
 
         """
         self.request = request
@@ -203,11 +214,15 @@ class Response:
         self._content = None
         self._content_loaded = False
         self._gzipped = False
+        # Bytes of the body received, before decompression
+        self._received = 0
+        # Whether the response was served by an :class:`HTTPCache`
+        self.from_cache = False
 
         # Execute query
         try:
             # pylint: disable=consider-using-with
-            self.raw = urllib.request.urlopen(request)
+            self.raw = (opener or urllib.request.urlopen)(request)
         except urllib.error.HTTPError as err:
             self.error = err
 
@@ -352,6 +367,7 @@ class Response:
                 yield data
 
         def generate():
+            self._received = 0
             if self._gzipped:
                 decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
@@ -361,11 +377,17 @@ class Response:
                 if not chunk:
                     break
 
+                self._received += len(chunk)
                 if self._gzipped:
                     chunk = decoder.decompress(chunk)
 
                 yield chunk
 
+            if self._gzipped:
+                chunk = decoder.flush()
+                if chunk:
+                    yield chunk
+
         chunks = generate()
 
         if decode_unicode and self.encoding:
@@ -376,9 +398,16 @@ class Response:
     def save_to_path(self, filepath):
         """Save retrieved data to file at ``filepath``.
 
+        The data is streamed to a temporary file, which only replaces
+        ``filepath`` once the whole body has been received.
+
         :param filepath: Path to save retrieved data.
+        :raises: :class:`http.client.IncompleteRead` if the body is
+            shorter or longer than its ``Content-Length``
 
         """
+        from .util import atomic_writer
+
         filepath = os.path.abspath(filepath)
         dirname = os.path.dirname(filepath)
 
@@ -386,11 +415,16 @@ class Response:
             os.makedirs(dirname)
 
         self.stream = True
+        expected = self.headers.get("content-length")
 
-        with open(filepath, "wb") as fileobj:
+        with atomic_writer(filepath, "wb") as fileobj:
             for data in self.iter_content():
                 fileobj.write(data)
 
+            # the length is that of the body as sent, compressed or not
+            if expected is not None and self._received != int(expected):
+                raise http.client.IncompleteRead(b"", int(expected) - self._received)
+
     def raise_for_status(self):
         """Raise stored error if one occurred.
 
@@ -506,8 +540,6 @@ def request(
       will be used.
 
     """
-    socket.setdefaulttimeout(timeout)
-
     # Default handlers
     openers = [urllib.request.ProxyHandler(urllib.request.getproxies())]
 
@@ -521,10 +553,21 @@ def request(
         auth_manager = urllib.request.HTTPBasicAuthHandler(password_manager)
         openers.append(auth_manager)
 
-    # Install our custom chain of openers
+    # Open with our custom chain of openers, leaving the global one and
+    # the default socket timeout alone
     opener = urllib.request.build_opener(*openers)
-    urllib.request.install_opener(opener)
 
+    req = _build_request(method, url, params, data, json_data, headers, files)
+    return Response(req, stream, lambda req: opener.open(req, timeout=timeout))
+
+
+def _build_request(method, url, params, data, json_data, headers, files):
+    """Build the :class:`Request` of a call to :func:`request`.
+
+    :returns: Request with the default headers and encoded data
+    :rtype: :class:`Request`
+
+    """
     if not headers:
         headers = CaseInsensitiveDictionary()
     else:
@@ -568,8 +611,7 @@ def request(
         query = urllib.parse.urlencode(params, doseq=True)
         url = urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
 
-    req = Request(url, data, headers, method=method)
-    return Response(req, stream)
+    return Request(url, data, headers, method=method)
 
 
 def get(
@@ -679,6 +721,456 @@ def put(
     )
 
 
+
+class Session:
+    """Make requests over kept-alive connections pooled per host.
+
+    Where :func:`request` opens a new connection for every call, a
+    session returns each connection to its pool once the response on it
+    has been read to the end, and the next request to the same host
+    reuses it. A session may be used by several threads at once: each
+    request has a connection of its own for as long as it runs.
+
+    Timeouts apply to the connections of a single request; the default
+    socket timeout and the global :mod:`urllib` opener are left alone.
+
+    With an :class:`HTTPCache`, GET requests are revalidated against the
+    responses stored in it.
+
+    >>> with Session() as session:
+    ...     for page in range(3):
+    ...         r = session.get(url, params={'page': page}, timeout=10)
+
+    """
+
+    def __init__(self, max_connections=10, max_redirects=5, cache=None):
+        """Create a new :class:`Session`.
+
+        :param max_connections: Idle connections kept per host
+        :type max_connections: int
+        :param max_redirects: Redirects followed per request
+        :type max_redirects: int
+        :param cache: Cache of GET responses, none by default
+        :type cache: :class:`HTTPCache`
+
+        """
+        self.max_connections = max_connections
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self.proxies = urllib.request.getproxies()
+        self._proxied = {}
+        # (scheme, netloc) -> [(connection, its last response), ...]
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the pooled connections."""
+        with self._lock:
+            connections, self._connections = self._connections, {}
+
+        for pool in connections.values():
+            for conn, _ in pool:
+                conn.close()
+
+    def request(
+        self,
+        method,
+        url,
+        params=None,
+        data=None,
+        json_data=None,
+        headers=None,
+        files=None,
+        auth=None,
+        timeout=60,
+        allow_redirects=True,
+        stream=False,
+    ):
+        """Initiate an HTTP(S) request. Arguments as for :func:`request`.
+
+        ``auth`` is sent with the first request rather than in answer to
+        a challenge.
+
+        :returns: :class:`Response` instance
+
+        """
+        if auth is not None:
+            headers = CaseInsensitiveDictionary(headers or {})
+            token = base64.b64encode(":".join(auth).encode("utf-8")).decode("ascii")
+            headers["Authorization"] = f"Basic {token}"
+
+        req = _build_request(method, url, params, data, json_data, headers, files)
+        stored = None
+        if self.cache is not None and req.get_method() == "GET":
+            stored = self.cache.get(req.full_url)
+
+        if stored is not None:  # only send what has changed since
+            if stored.etag and not req.has_header("If-none-match"):
+                req.add_header("If-None-Match", stored.etag)
+
+            if stored.last_modified and not req.has_header("If-modified-since"):
+                req.add_header("If-Modified-Since", stored.last_modified)
+
+        response = Response(
+            req, stream, lambda req: self._open(req, timeout, allow_redirects)
+        )
+        if stored is not None and response.status_code == 304:
+            response = Response(req, stream, lambda req: stored)
+            response.from_cache = True
+            return response
+
+        if stored is not None:
+            stored.close()
+
+        if self.cache is not None and req.get_method() == "GET" and response.status_code == 200:
+            response.raw = self.cache.store(req.full_url, response.raw)
+
+        return response
+
+    def get(
+        self,
+        url,
+        params=None,
+        headers=None,
+        auth=None,
+        timeout=60,
+        allow_redirects=True,
+        stream=False,
+    ):
+        """Initiate a GET request. Arguments as for :func:`request`.
+
+        :returns: :class:`Response` instance
+
+        """
+        return self.request(
+            "GET",
+            url,
+            params,
+            headers=headers,
+            auth=auth,
+            timeout=timeout,
+            allow_redirects=allow_redirects,
+            stream=stream,
+        )
+
+    def _open(self, req, timeout, allow_redirects):
+        """Open `req` like :func:`urllib.request.urlopen` does.
+
+        :returns: the response, with the final URL as its ``url``
+        :rtype: :class:`http.client.HTTPResponse`
+        :raises: :class:`urllib.error.HTTPError` if the status isn't 2xx
+
+        """
+        method = req.get_method()
+        url = req.full_url
+        data = req.data
+        headers = dict(req.header_items())
+        if data and "Content-type" not in headers:
+            headers["Content-type"] = "application/x-www-form-urlencoded"
+
+        for _ in range(self.max_redirects + 1):
+            response = self._send(method, url, data, headers, timeout)
+            location = response.getheader("Location")
+            if not allow_redirects or response.status not in REDIRECT_CODES or not location:
+                break
+
+            # read the body to free the connection for the next request
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303 or (
+                response.status in (301, 302) and method not in ("GET", "HEAD")
+            ):
+                method = "GET"
+                data = None
+                headers = {
+                    k: v for k, v in headers.items()
+                    if k.lower() not in ("content-type", "content-length")
+                }
+        else:
+            raise urllib.error.HTTPError(
+                url, response.status, "Too many redirects", response.msg, io.BytesIO()
+            )
+
+        response.url = url
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.msg,
+                io.BytesIO(response.read()),
+            )
+
+        return response
+
+    def _send(self, method, url, data, headers, timeout):
+        """Send one request over a pooled connection and get its response."""
+        scheme, netloc, path, query, _ = urllib.parse.urlsplit(url)
+        key = (scheme, netloc)
+        if scheme == "http" and self._proxy(scheme, netloc):
+            target = url
+        else:
+            target = urllib.parse.urlunsplit(("", "", path or "/", query, ""))
+
+        while True:
+            conn, reused = self._checkout(key)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+            try:
+                conn.request(method, target, data, headers)
+                response = conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                # the server closed the idle connection, so try another
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            self._checkin(key, conn, response)
+            return response
+
+    def _proxy(self, scheme, netloc):
+        """Get the ``host:port`` of the proxy for `netloc`, if there is one."""
+        if (scheme, netloc) not in self._proxied:
+            proxy = self.proxies.get(scheme)
+            if proxy and not urllib.request.proxy_bypass(netloc.rsplit(":", 1)[0]):
+                proxy = urllib.parse.urlsplit(proxy).netloc or proxy
+            else:
+                proxy = None
+
+            self._proxied[(scheme, netloc)] = proxy
+
+        return self._proxied[(scheme, netloc)]
+
+    def _checkout(self, key):
+        """Get a connection to `key` and whether it was used before."""
+        with self._lock:
+            pool = self._connections.get(key, [])
+            for i, (conn, response) in enumerate(pool):
+                if response.isclosed():
+                    del pool[i]
+                    return conn, True
+
+        scheme, netloc = key
+        proxy = self._proxy(scheme, netloc)
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(proxy or netloc)
+            if proxy:
+                conn.set_tunnel(netloc)
+        else:
+            conn = http.client.HTTPConnection(proxy or netloc)
+
+        return conn, False
+
+    def _checkin(self, key, conn, response):
+        """Pool `conn`, to be reused once `response` has been read."""
+        if response.will_close:  # the response has taken over the socket
+            return
+
+        with self._lock:
+            pool = self._connections.setdefault(key, [])
+            if len(pool) < self.max_connections:
+                pool.append((conn, response))
+
+
+class HTTPCache:
+    """On-disk cache of GET responses for :class:`Session`.
+
+    A ``200`` response with an ``ETag`` or ``Last-Modified`` header is
+    stored as its body is read, and later requests for the same URL ask
+    the server for it only if it has changed. On ``304 Not Modified``
+    the stored response is returned, with ``from_cache`` set, and
+    nothing is downloaded. A response that isn't read to the end, or
+    that says ``Cache-Control: no-store``, isn't stored.
+
+    Responses are stored under the hash of their URL, so headers that
+    vary the response aren't taken into account. Once the cache is over
+    `max_size` bytes or `max_entries` responses, the least recently
+    used ones are removed.
+
+    >>> cache = HTTPCache(wf.cachefile('http'))
+    >>> with Session(cache=cache) as session:
+    ...     r = session.get(url)
+
+    """
+
+    def __init__(self, dirpath, max_size=50 * 1024 * 1024, max_entries=1000):
+        """Create a new :class:`HTTPCache`.
+
+        :param dirpath: Directory to store responses in
+        :type dirpath: str
+        :param max_size: Bytes of responses kept
+        :type max_size: int
+        :param max_entries: Responses kept
+        :type max_entries: int
+
+        """
+        self.dirpath = dirpath
+        self.max_size = max_size
+        self.max_entries = max_entries
+        os.makedirs(dirpath, exist_ok=True)
+
+    def path(self, url):
+        """Path of the stored response of `url`."""
+        return os.path.join(self.dirpath, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def get(self, url):
+        """Open the stored response of `url`.
+
+        :returns: The response, or ``None`` if there isn't one
+        :rtype: :class:`CachedResponse`
+
+        """
+        path = self.path(url)
+        try:
+            fileobj = open(path, "rb")  # pylint: disable=consider-using-with
+        except OSError:
+            return None
+
+        try:
+            meta = json.loads(fileobj.readline())
+        except ValueError:
+            meta = None
+
+        if not meta or meta.get("url") != url:
+            fileobj.close()
+            return None
+
+        # mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return CachedResponse(url, meta, fileobj)
+
+    def store(self, url, raw):
+        """Store the response `raw` of `url` as it is read.
+
+        :returns: `raw`, wrapped to copy what is read from it if it can
+            be stored
+        :rtype: file-like
+
+        """
+        headers = raw.info()
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "headers": list(headers.items()),
+        }
+        if not meta["etag"] and not meta["last_modified"]:
+            return raw
+
+        if "no-store" in headers.get("Cache-Control", ""):
+            return raw
+
+        return _StoringResponse(self, self.path(url), meta, raw)
+
+    def evict(self):
+        """Remove the least recently used responses until the cache is within its limits."""
+        entries = []
+        for entry in os.scandir(self.dirpath):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            if entry.name.endswith(".tmp"):
+                # left over by a response that was never read to the end
+                if stat.st_mtime < time.time() - 3600:
+                    _remove(entry.path)
+
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        while entries and (size > self.max_size or len(entries) > self.max_entries):
+            _, entry_size, path = entries.pop(0)
+            _remove(path)
+            size -= entry_size
+
+    def clear(self):
+        """Remove every stored response."""
+        for entry in os.scandir(self.dirpath):
+            _remove(entry.path)
+
+
+class CachedResponse:
+    """A response stored in an :class:`HTTPCache`.
+
+    It is read like the response :func:`urllib.request.urlopen` returns.
+    """
+
+    def __init__(self, url, meta, fileobj):
+        self.url = url
+        self.etag = meta.get("etag")
+        self.last_modified = meta.get("last_modified")
+        self.headers = http.client.HTTPMessage()
+        for key, value in meta["headers"]:
+            self.headers[key] = value
+
+        self._fileobj = fileobj
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return 200
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self._fileobj.read(-1 if amt is None else amt)
+
+    def close(self):
+        self._fileobj.close()
+
+
+class _StoringResponse:
+    """Response that copies its body to an :class:`HTTPCache` as it is read."""
+
+    def __init__(self, cache, path, meta, raw):
+        self._cache = cache
+        self._path = path
+        self._raw = raw
+        self._temppath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._fileobj = open(self._temppath, "wb")  # pylint: disable=consider-using-with
+        self._fileobj.write(json.dumps(meta).encode("utf-8") + b"\n")
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def read(self, amt=None):
+        data = self._raw.read() if amt is None else self._raw.read(amt)
+        if self._fileobj is not None:
+            self._fileobj.write(data)
+            if amt is None or not data:  # the whole body has been read
+                self._fileobj.close()
+                self._fileobj = None
+                os.replace(self._temppath, self._path)
+                self._cache.evict()
+
+        return data
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 def _encode_multipart_formdata(fields, files):
     """Encode form data (``fields``) and ``files`` for POST request.
 
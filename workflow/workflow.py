@@ -12,12 +12,12 @@ up your Python script to best utilise the :class:`Workflow` object.
 """
 
 import binascii
+import heapq
 import json
 import logging
 import logging.handlers
 import os
 import pickle
-import plistlib
 import re
 import shutil
 import string
@@ -28,7 +28,6 @@ import unicodedata
 from contextlib import contextmanager
 from copy import deepcopy
 from typing import Optional
-from uuid import uuid4
 
 from .util import atomic_writer, LockFile, uninterruptible, set_config
 
@@ -368,6 +367,54 @@ MATCH_SUBSTRING = 32
 MATCH_ALLCHARS = 64
 #: Combination of all other ``MATCH_*`` constants
 MATCH_ALL = 127
+#: Match items with an atom within a small edit distance of ``query``,
+#: or starting with such a near-miss of ``query``. Not part of
+#: :const:`MATCH_ALL`
+MATCH_FUZZY = 128
+
+#: Shortest ``query`` :const:`MATCH_FUZZY` tolerates typos in
+FUZZY_MIN_LENGTH = 4
+
+
+def fuzzy_limit(query):
+    """Get the number of typos :const:`MATCH_FUZZY` tolerates in ``query``."""
+    if len(query) < FUZZY_MIN_LENGTH:
+        return 0
+    return 1 if len(query) < 8 else 2
+
+
+def edit_distance(a, b, limit):
+    """Get the edit distance between ``a`` and ``b``, or ``limit + 1`` if it is larger.
+
+    Insertions, deletions, substitutions and transpositions of adjacent
+    characters count as one edit each (optimal string alignment). Gives
+    up as soon as the distance is known to exceed ``limit``.
+
+    """
+    over = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return over
+
+    # only cells within ``limit`` of the diagonal can stay within reach
+    before = None
+    previous = [min(j, over) for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        for j in range(low, high + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost, over)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                distance = min(distance, before[j - 2] + 1)
+            current[j] = distance
+        if min(current[low - 1:high + 1]) > limit:
+            return over
+        before, previous = previous, current
+
+    return min(previous[-1], over)
 
 ####################################################################
 # Used by `Workflow.check_update`
@@ -611,6 +658,57 @@ manager.register("pickle", PickleSerializer)
 manager.register("json", JSONSerializer)
 
 
+class SearchKey:
+    """Search key of an item with the forms :meth:`Workflow.filter` tests.
+
+    A ``key`` function passed to :meth:`Workflow.filter` may return a
+    :class:`SearchKey` instead of a ``str``, so the lowercase form, the
+    set of characters, the capitals, the atoms and the initials of an
+    item that is filtered over and over are worked out only once.
+    Forms that are already known (e.g. stored along with the items) can
+    be passed in.
+
+    :param value: search key
+    :type value: ``str``
+    :param folded: :class:`SearchKey` of ``value`` with diacritics
+        folded to ASCII, worked out when first needed if not given
+
+    """
+
+    __slots__ = ("value", "lower", "chars", "capitals", "atoms", "initials", "_folded")
+
+    def __init__(
+        self, value, lower=None, capitals=None, atoms=None, initials=None, folded=None
+    ):
+        """Create a new :class:`SearchKey`."""
+        self.value = value.strip()
+        self.lower = self.value.lower() if lower is None else lower
+        self.chars = frozenset(self.lower)
+        if capitals is None:
+            capitals = "".join([c for c in self.value if c in INITIALS]).lower()
+        self.capitals = capitals
+        if atoms is None:
+            atoms = [s.lower() for s in split_on_delimiters(self.value)]
+        self.atoms = atoms
+        if initials is None:
+            initials = "".join([s[0] for s in atoms if s])
+        self.initials = initials
+        self._folded = folded
+
+    @property
+    def folded(self):
+        """:class:`SearchKey` of the key with diacritics folded to ASCII.
+
+        :returns: this key if it is ASCII already
+        :rtype: :class:`SearchKey`
+
+        """
+        if self._folded is None:
+            value = Workflow.fold_to_ascii(self.value)
+            self._folded = self if value == self.value else SearchKey(value)
+        return self._folded
+
+
 class Item:
     """Represents a feedback item for Alfred.
 
@@ -1983,6 +2081,7 @@ class Workflow:
         max_results=0,
         match_on=MATCH_ALL,
         fold_diacritics=True,
+        group=None,
     ):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
@@ -1997,8 +2096,8 @@ class Workflow:
         :param items: iterable of items to test
         :type items: ``list`` or ``tuple``
         :param key: function to get comparison key from ``items``.
-            Must return ``str``. The default simply returns
-            the item.
+            Must return ``str`` or :class:`SearchKey`. The default
+            simply returns the item.
         :type key: ``callable``
         :param ascending: set to ``True`` to get worst matches first
         :type ascending: ``Boolean``
@@ -2010,6 +2109,9 @@ class Workflow:
             than this.
         :type min_score: ``int``
         :param max_results: If non-zero, prune results list to this length.
+            Only this many of the best matches are kept while the items
+            are scored, so the cost of ranking doesn't grow with the
+            number of matches.
         :type max_results: ``int``
         :param match_on: Filter option flags. Bitwise-combined list of
             ``MATCH_*`` constants (see below).
@@ -2017,6 +2119,10 @@ class Workflow:
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param group: function called with the ``(item, score, rule)``
+            of each match to get its group. Results are ordered by group
+            first and by score within a group.
+        :type group: ``callable``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_*`` rule that matched the item.
@@ -2052,6 +2158,13 @@ class Workflow:
         9. :const:`MATCH_ALL`
             Combination of all the above.
 
+        :const:`MATCH_FUZZY` is not part of :const:`MATCH_ALL`. When
+        given, it is tested after :const:`MATCH_SUBSTRING`: an atom of
+        the search key, or its first ``len(query)`` characters, is at
+        most 1 edit away from a ``query`` of 4-7 characters, or 2 edits
+        from a longer one (see :func:`edit_distance`). Items missing some
+        characters of ``query`` can only match this way.
+
 
         :const:`MATCH_ALLCHARS` is considerably slower than the other
         tests and provides much less accurate results.
@@ -2094,49 +2207,54 @@ class Workflow:
             "__workflow_diacritic_folding", fold_diacritics
         )
 
-        results = []
-
-        for item in items:
-            skip = False
-            score = 0
-            words = [s.strip() for s in query.split(" ")]
-            value = key(item).strip()
-
-            if value == "":
-                continue
+        def matches():
+            for item in items:
+                skip = False
+                score = 0
+                words = [s.strip() for s in query.split(" ")]
+                value = key(item)
+                if not isinstance(value, SearchKey):
+                    value = value.strip()
 
-            for word in words:
-                if word == "":
+                if not (value.value if isinstance(value, SearchKey) else value):
                     continue
 
-                score_, rule = self._filter_item(value, word, match_on, fold_diacritics)
+                for word in words:
+                    if word == "":
+                        continue
 
-                if not score_:  # Skip items that don't match part of the query
-                    skip = True
+                    score_, rule = self._filter_item(
+                        value, word, match_on, fold_diacritics
+                    )
 
-                score += score_
+                    if not score_:  # Skip items that don't match part of the query
+                        skip = True
 
-            if skip:
-                continue
+                    score += score_
 
-            if score:
-                # use "reversed" `score` (i.e. highest becomes lowest) and
-                # `value` as sort key. This means items with the same score
-                # will be sorted in alphabetical not reverse alphabetical order
-                results.append(
-                    ((100.0 / score, value.lower(), score), (item, score, rule))
-                )
+                if skip:
+                    continue
 
-        # sort on keys, then discard the keys
-        results.sort(reverse=ascending)
+                if score and not (min_score and score <= min_score):
+                    # use "reversed" `score` (i.e. highest becomes lowest) and
+                    # `value` as sort key. This means items with the same score
+                    # will be sorted in alphabetical not reverse alphabetical order
+                    lower = value.lower if isinstance(value, SearchKey) else value.lower()
+                    sort_key = (100.0 / score, lower, score)
+                    if group:
+                        sort_key = (group((item, score, rule)),) + sort_key
+                    yield (sort_key, (item, score, rule))
+
+        # sort on keys, then discard the keys. With `max_results`, a heap
+        # of that many matches is kept instead of sorting every match
+        if not max_results:
+            results = sorted(matches(), reverse=ascending)
+        elif ascending:
+            results = heapq.nlargest(max_results, matches())
+        else:
+            results = heapq.nsmallest(max_results, matches())
         results = [result[1] for result in results]
 
-        if min_score:
-            results = [result for result in results if result[1] > min_score]
-
-        if max_results and len(results) > max_results:
-            results = results[:max_results]
-
         # return list of ``(item, score, rule)``
         if include_score:
             return results
@@ -2147,6 +2265,8 @@ class Workflow:
     def _filter_item(self, value, query, match_on, fold_diacritics):
         """Filter ``value`` against ``query`` using rules ``match_on``.
 
+        ``value`` is a ``str`` or a :class:`SearchKey`.
+
         :returns: ``(score, rule)``
 
         """
@@ -2155,39 +2275,41 @@ class Workflow:
         if not isascii(query):
             fold_diacritics = False
 
-        if fold_diacritics:
-            value = self.fold_to_ascii(value)
+        if isinstance(value, SearchKey):
+            key = value.folded if fold_diacritics else value
+        else:
+            if fold_diacritics:
+                value = self.fold_to_ascii(value)
+            # run the pre-filter below before working out the other forms
+            if not match_on & MATCH_FUZZY and not set(query) <= set(value.lower()):
+                return (0, None)
+            key = SearchKey(value)
+        value = key.value
 
         # pre-filter any items that do not contain all characters
-        # of ``query`` to save on running several more expensive tests
-        if not set(query) <= set(value.lower()):
-            return (0, None)
+        # of ``query`` to save on running several more expensive tests.
+        # Only a fuzzy match can accept those.
+        if not key.chars.issuperset(query):
+            if not match_on & MATCH_FUZZY:
+                return (0, None)
+            match_on = MATCH_FUZZY
 
         # item starts with query
-        if match_on & MATCH_STARTSWITH and value.lower().startswith(query):
+        if match_on & MATCH_STARTSWITH and key.lower.startswith(query):
             score = 100.0 - (len(value) / len(query))
 
             return (score, MATCH_STARTSWITH)
 
         # query matches capitalised letters in item,
         # e.g. of = OmniFocus
-        if match_on & MATCH_CAPITALS:
-            initials = "".join([c for c in value if c in INITIALS])
-
-            if initials.lower().startswith(query):
-                score = 100.0 - (len(initials) / len(query))
-                return (score, MATCH_CAPITALS)
-
-        # split the item into "atoms", i.e. words separated by
-        # spaces or other non-word characters
-        if (
-            match_on & MATCH_ATOM
-            or match_on & MATCH_INITIALS_CONTAIN
-            or match_on & MATCH_INITIALS_STARTSWITH
-        ):
-            atoms = [s.lower() for s in split_on_delimiters(value)]
-            # initials of the atoms
-            initials = "".join([s[0] for s in atoms if s])
+        if match_on & MATCH_CAPITALS and key.capitals.startswith(query):
+            score = 100.0 - (len(key.capitals) / len(query))
+            return (score, MATCH_CAPITALS)
+
+        # the item split into "atoms", i.e. words separated by
+        # spaces or other non-word characters, and their initials
+        atoms = key.atoms
+        initials = key.initials
 
         if match_on & MATCH_ATOM:
             # is `query` one of the atoms in item?
@@ -2212,10 +2334,26 @@ class Workflow:
             return (score, MATCH_INITIALS_CONTAIN)
 
         # `query` is a substring of item
-        if match_on & MATCH_SUBSTRING and query in value.lower():
+        if match_on & MATCH_SUBSTRING and query in key.lower:
             score = 90.0 - (len(value) / len(query))
             return (score, MATCH_SUBSTRING)
 
+        # an atom, or its start, is within a few typos of `query`
+        if match_on & MATCH_FUZZY:
+            limit = fuzzy_limit(query)
+            distance = limit + 1
+            for atom in atoms:
+                if len(atom) + limit < len(query):
+                    continue
+                distance = min(
+                    distance,
+                    edit_distance(query, atom, limit),
+                    edit_distance(query, atom[: len(query)], limit),
+                )
+            if limit and distance <= limit:
+                score = 80.0 - 10.0 * distance - (len(value) / len(query))
+                return (score, MATCH_FUZZY)
+
         # finally, assign a score based on how close together the
         # characters in `query` are in item.
         if match_on & MATCH_ALLCHARS:
@@ -2351,6 +2489,8 @@ class Workflow:
 
         """
         if not self._session_id:
+            from uuid import uuid4
+
             self._session_id = uuid4().hex
             self.setvar("_WF_SESSION_ID", self._session_id)
 
@@ -3088,6 +3228,8 @@ class Workflow:
 
     def _load_info_plist(self):
         """Load workflow info from ``info.plist``."""
+        import plistlib
+
         # info.plist should be in the directory above this one
         with open(self.workflowfile("info.plist"), "rb") as file_obj:
             self._info = plistlib.load(file_obj)